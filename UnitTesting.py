@@ -1,8 +1,15 @@
+import socket
+import asyncio
+import itertools
+import mmap
+import os
+import tempfile
 import struct
 import subprocess
 import time
 import unittest
 import api
+import async_api
 
 # Used for testing the client - MagicMock is used to mock the socket ("read" and "write" to socket without actually needing a socket and connection)
 from client import Client
@@ -11,7 +18,29 @@ import threading
 
 # Used for testing the server
 import data_generator
+import scheduler
 from server import Server
+import server
+import reliability
+import congestion
+import reassembly
+import flowcontrol
+import metrics
+import tracing
+import logging
+import json
+import urllib.request
+import main
+import emulator
+import pmtud
+import frames
+import compression
+import concurrent.futures
+import fec
+import profiling
+import handshake
+import contextlib
+import io
 
 # helpers to start server and client in another process
 def start_server(port=9997):
@@ -31,7 +60,7 @@ class TestQuicPacket(unittest.TestCase):
         self.assertEqual(packet.header_form, api.SHORT_HEADER)
         self.assertEqual(packet.source_connection_id, 1)
         self.assertEqual(packet.destination_connection_id, 2)
-        self.assertEqual(packet.payload, "test")
+        self.assertEqual(packet.payload, b"test")      # text payloads are encoded once, at creation
         self.assertEqual(packet.packet_type, api.DATA)
 
     def test_pack_unpack_long(self):
@@ -71,10 +100,1385 @@ class TestQuicPacket(unittest.TestCase):
         self.assertEqual(packet.packet_type, api.DATA)
         self.assertEqual(packet.header_form, api.SHORT_HEADER)
 
+    def test_binary_payload(self):
+        # Not valid UTF-8, used to crash the decode in the old codec
+        payload = bytes(range(256))
+        packet = api.QuicPacket(1, 2, payload, 3, 4, api.DATA)
+        packet_unpacked = api.QuicPacket(0, 0, b"", 0, 0)
+        view = packet_unpacked.unpack(packet.pack())
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(bytes(view), payload)
+        self.assertEqual(packet_unpacked.stream_id, 3)
+        self.assertEqual(packet_unpacked.pos_in_stream, 4)
+
+    def test_packet_type_in_header(self):
+        # The type comes from the header, even if the payload looks like a control marker
+        packet = api.QuicPacket(1, 2, b"end_stream", 1, 0, api.DATA)
+        packet_unpacked = api.QuicPacket(0, 0, b"", 0, 0)
+        packet_unpacked.unpack(packet.pack())
+        self.assertEqual(packet_unpacked.packet_type, api.DATA)
+
+        packet = api.QuicPacket(1, 2, b"", 1, 7, api.END_STREAM)
+        packet_unpacked.unpack(packet.pack())
+        self.assertEqual(packet_unpacked.packet_type, api.END_STREAM)
+        self.assertEqual(packet_unpacked.header_form, api.LONG_HEADER)
+        self.assertEqual(packet_unpacked.pos_in_stream, 7)
+
+    def test_pack_into(self):
+        payload = b"x" * 100
+        packet = api.QuicPacket(1, 2, memoryview(payload), 1, 0, api.DATA)
+        buffer = bytearray(256)
+        written = packet.pack_into(memoryview(buffer), 10)
+        self.assertEqual(written, packet.size())
+        self.assertEqual(written, api.SHORT_HEADER_SIZE + 4 + len(payload))     # 1 byte stream ID and offset, 2 byte length
+        self.assertEqual(bytes(buffer[10:10 + written]), bytes(packet.pack()))
+
+    def test_varint(self):
+        # RFC 9000 Appendix A.1 examples
+        examples = {
+            151288809941952652: "c2197c5eff14e88c",
+            494878333: "9d7f3e7d",
+            15293: "7bbd",
+            37: "25",
+        }
+        for value, encoded in examples.items():
+            self.assertEqual(api.encode_varint(value).hex(), encoded)
+            self.assertEqual(api.decode_varint(bytes.fromhex(encoded)), (value, len(encoded) // 2))
+        self.assertEqual(api.decode_varint(bytes.fromhex("4025")), (37, 2))     # Not the shortest encoding, still valid
+        with self.assertRaises(ValueError):
+            api.encode_varint(api.VARINT_MAX + 1)
+        with self.assertRaises(ValueError):
+            api.decode_varint(bytes.fromhex("9d7f3e"))
+
+    def test_large_stream(self):
+        # Offsets and stream IDs past the old 8 / 16 bit fields
+        packet = api.QuicPacket(1, 2, b"x" * 1000, 70000, 5 * 1024 ** 3, api.DATA)
+        packet_unpacked = api.QuicPacket(0, 0, b"", 0, 0)
+        packet_unpacked.unpack(packet.pack())
+        self.assertEqual((packet_unpacked.stream_id, packet_unpacked.pos_in_stream, packet_unpacked.payload_length), (70000, 5 * 1024 ** 3, 1000))
+
+    def test_truncated_packet(self):
+        packed = api.QuicPacket(1, 2, b"abcdef", 1, 0, api.DATA).pack()
+        with self.assertRaises(ValueError):
+            api.QuicPacket(0, 0, b"", 0, 0).unpack(packed[:-1])
+
+
+class FakeDatagramSocket:
+    # Stands in for a UDP socket that always has the same datagram waiting
+    def __init__(self, datagram):
+        self.datagram = bytes(datagram)
+        self.address = ("127.0.0.1", 9997)
+
+    def recvfrom(self, bufsize):
+        # A real socket returns a new bytes object for every datagram
+        return bytearray(self.datagram), self.address
+
+    def recvfrom_into(self, buffer):
+        buffer[:len(self.datagram)] = self.datagram
+        return len(self.datagram), self.address
+
+
+class TestPacketPool(unittest.TestCase):
+    def test_slots(self):
+        packet = api.QuicPacket(1, 2, b"test", 1, 0, api.DATA)
+        self.assertFalse(hasattr(packet, "__dict__"))
+        self.assertEqual(packet.version, 0)
+
+    def test_pool_reuses_packets(self):
+        sock = FakeDatagramSocket(api.QuicPacket(0, 1, b"a" * 1000, 5, 9, api.DATA).pack())
+        pool = api.PacketPool(max_size=4)
+        for _ in range(100):
+            packet, _ = api.recv_packet(sock, pool)
+            self.assertEqual(packet.stream_id, 5)
+            self.assertEqual(bytes(packet.payload), b"a" * 1000)
+            pool.release(packet)
+        self.assertEqual(pool.allocated, 1)
+
+    def test_pool_allocations(self):
+        # Without the pool every datagram allocates a packet and a receive buffer, with it one packet and buffer serve them all
+        sock = FakeDatagramSocket(api.QuicPacket(0, 1, b"a" * 1500, 1, 0, api.DATA).pack())
+        debug, api.DEBUG = api.DEBUG, False
+        try:
+            packets = [api.recv_packet(sock)[0] for _ in range(100)]
+            self.assertEqual(len({id(packet) for packet in packets}), 100)
+            pool = api.PacketPool()
+            buffers = set()
+            for _ in range(100):
+                packet, _ = api.recv_packet(sock, pool)
+                buffers.add(id(packet.buffer))
+                pool.release(packet)
+        finally:
+            api.DEBUG = debug
+        self.assertEqual((pool.allocated, len(buffers)), (1, 1))
+        # Packets held at the same time each need their own, the free list keeps at most max_size of them
+        pool = api.PacketPool(max_size=2)
+        held = [pool.acquire() for _ in range(3)]
+        for packet in held:
+            pool.release(packet)
+        self.assertEqual((pool.allocated, len(pool.free)), (3, 2))
+
+
+class TestBatchReceiver(unittest.TestCase):
+    def setUp(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server_socket.bind(("127.0.0.1", 0))
+        self.server_socket.settimeout(1)
+        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.server_socket.close()
+        self.client_socket.close()
+
+    def receive_all(self, use_recvmmsg):
+        receiver = api.BatchReceiver(self.server_socket, 8, use_recvmmsg=use_recvmmsg)
+        for i in range(20):
+            api.QuicPacket(0, 1, bytes([i]) * 100, 1, i, api.DATA).sendto(self.client_socket, self.server_socket.getsockname())
+        received = []
+        while len(received) < 20:
+            batch = receiver.recv_batch()
+            self.assertLessEqual(len(batch), 8)
+            for packet, address in batch:
+                self.assertEqual(address[1], self.client_socket.getsockname()[1])
+                received.append((packet.pos_in_stream, bytes(packet.payload)))
+        self.assertEqual(received, [(i, bytes([i]) * 100) for i in range(20)])
+        # Nothing left, the socket's timeout applies
+        self.server_socket.settimeout(0.1)
+        with self.assertRaises(socket.timeout):
+            receiver.recv_batch()
+
+    def test_recvmmsg(self):
+        self.receive_all(True)
+
+    def test_fallback_loop(self):
+        self.receive_all(False)
+
+
+class TestSendQueue(unittest.TestCase):
+    def setUp(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server_socket.bind(("127.0.0.1", 0))
+        self.server_socket.settimeout(1)
+        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.server_socket.close()
+        self.client_socket.close()
+
+    def send_and_receive(self, use_gso, use_sendmmsg):
+        send_queue = api.SendQueue(self.client_socket, self.server_socket.getsockname(), 16, use_sendmmsg=use_sendmmsg, use_gso=use_gso)
+        # Equal sized packets and a short last one, like a stream
+        expected = [(i, bytes([i]) * (1000 if i < 39 else 10)) for i in range(40)]
+        for pos, payload in expected:
+            send_queue.append(api.QuicPacket(0, 1, payload, 1, pos, api.DATA))
+        send_queue.flush()
+        self.assertEqual(send_queue.packets_sent, 40)
+        receiver = api.BatchReceiver(self.server_socket, 64)
+        received = []
+        while len(received) < 40:
+            received += [(packet.pos_in_stream, bytes(packet.payload)) for packet, _ in receiver.recv_batch()]
+        self.assertEqual(received, expected)
+        return send_queue
+
+    def test_gso(self):
+        send_queue = self.send_and_receive(True, True)
+        if send_queue.use_gso:
+            self.assertLess(send_queue.syscalls, 40)
+
+    def test_sendmmsg(self):
+        send_queue = self.send_and_receive(False, True)
+        if send_queue.use_sendmmsg:
+            self.assertEqual(send_queue.syscalls, 3)        # 40 packets in batches of 16
+
+    def test_fallback_loop(self):
+        send_queue = self.send_and_receive(False, False)
+        self.assertEqual(send_queue.syscalls, 40)
+
+    def test_gso_mmap_payloads(self):
+        # Payloads are views of an mmapped file, sent scatter-gather without being copied into the queue
+        with tempfile.TemporaryFile() as file:
+            file.write(bytes(range(256)) * 40)
+            file.flush()
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+                view = memoryview(mapping)
+                send_queue = api.SendQueue(self.client_socket, self.server_socket.getsockname(), 16)
+                for offset in range(0, len(view), 1000):
+                    send_queue.append(api.QuicPacket(0, 1, view[offset:offset + 1000], 1, offset, api.DATA))
+                send_queue.flush()
+                expected = [(offset, bytes(view[offset:offset + 1000])) for offset in range(0, len(view), 1000)]
+                view.release()
+        receiver = api.BatchReceiver(self.server_socket, 64)
+        received = []
+        while len(received) < len(expected):
+            received += [(packet.pos_in_stream, bytes(packet.payload)) for packet, _ in receiver.recv_batch()]
+        self.assertEqual(received, expected)
+
+    def test_not_a_socket(self):
+        # Anything that isn't a real socket (like a MagicMock) gets the plain loop
+        sock = MagicMock()
+        send_queue = api.SendQueue(sock, ("127.0.0.1", 9997))
+        send_queue.append(api.QuicPacket(0, 1, b"test", 1, 0, api.DATA))
+        send_queue.flush()
+        self.assertEqual(sock.sendto.call_count, 1)
+
+
+class TestStreamScheduler(unittest.TestCase):
+    def test_round_robin(self):
+        stream_scheduler = scheduler.StreamScheduler(quantum=100)
+        stream_scheduler.add_stream(1, iter([b"a" * 100] * 3))
+        stream_scheduler.add_stream(2, iter([b"b" * 100] * 2))
+        order = [(stream.stream_id, data) for stream, data in stream_scheduler]
+        self.assertEqual(order, [(1, b"a" * 100), (2, b"b" * 100), (1, b"a" * 100), (2, b"b" * 100), (2, None), (1, b"a" * 100), (1, None)])
+
+    def test_weighted(self):
+        # Stream 2 has twice the weight, it should get twice the bytes while both are active
+        stream_scheduler = scheduler.StreamScheduler(quantum=100)
+        stream_scheduler.add_stream(1, iter([b"a" * 50] * 100))
+        stream_scheduler.add_stream(2, iter([b"b" * 50] * 100), weight=2)
+        first = [stream.stream_id for stream, data in itertools.islice(stream_scheduler, 60)]
+        self.assertEqual(first.count(2), 2 * first.count(1))
+
+    def test_fair_by_bytes(self):
+        # Smaller packets don't mean less bandwidth
+        stream_scheduler = scheduler.StreamScheduler(quantum=1000)
+        stream_scheduler.add_stream(1, iter([b"a" * 1000] * 100))
+        stream_scheduler.add_stream(2, iter([b"b" * 250] * 400))
+        sent = {1: 0, 2: 0}
+        for stream, data in itertools.islice(stream_scheduler, 100):
+            sent[stream.stream_id] += len(data)
+        self.assertLessEqual(abs(sent[1] - sent[2]), 1000)
+
+    def test_flow_control(self):
+        # Stream 1 is blocked by its own limit, then both by the connection's - the writer is told to wait for credit
+        stream_scheduler = scheduler.StreamScheduler(quantum=100, max_data=300, max_stream_data=200)
+        stream_scheduler.add_stream(1, iter([b"a" * 100] * 3))
+        stream_scheduler.add_stream(2, iter([b"b" * 100] * 2))
+        frames = iter(stream_scheduler)
+        order = [(stream and stream.stream_id, data and len(data)) for stream, data in itertools.islice(frames, 4)]
+        self.assertEqual(order, [(1, 100), (2, 100), (1, 100), (None, None)])
+        self.assertTrue(stream_scheduler.blocked)
+        stream_scheduler.update_max_data(500)
+        stream_scheduler.update_max_data(400)           # Out of order update, ignored
+        order = [(stream and stream.stream_id, data and len(data)) for stream, data in itertools.islice(frames, 3)]
+        self.assertEqual(order, [(2, 100), (2, None), (None, None)])
+        self.assertEqual(stream_scheduler.streams[1].blocked_count, 1)
+        stream_scheduler.update_max_stream_data(1, 300)
+        self.assertEqual([(stream.stream_id, data and len(data)) for stream, data in frames], [(1, 100), (1, None)])
+
+
+class TestFlowControl(unittest.TestCase):
+    def test_receive_window(self):
+        window = flowcontrol.ReceiveWindow(1000, 4000)
+        self.assertTrue(window.allows(1000))
+        self.assertFalse(window.allows(1001))
+        self.assertEqual(window.on_received(600), 600)
+        self.assertEqual(window.on_received(500), 0)
+        # Credit is given back once half of the window is used
+        window.on_consumed(400)
+        self.assertIsNone(window.update(0.0, 0.1))
+        window.on_consumed(600)
+        self.assertEqual(window.update(0.0, 0.1), 1600)
+        # The next window was used up within 2 RTTs - it limits the sender and is doubled
+        window.on_consumed(1200)
+        self.assertEqual(window.update(0.1, 0.1), 3200)
+        self.assertEqual(window.window, 2000)
+        # Used slowly, stays the same
+        window.on_consumed(2400)
+        self.assertEqual(window.update(10.0, 0.1), 4400)
+        self.assertEqual(window.window, 2000)
+
+    def test_transfer(self):
+        # Files bigger than the initial windows go through only with the server's credit updates
+        debug, api.DEBUG = api.DEBUG, False
+        server_address = ("127.0.0.1", 9966)
+        servers = []
+        server_thread = threading.Thread(target=lambda: servers.append(Server(server_address, api.DEFAULT_BATCH_SIZE, 1)))
+        server_thread.start()
+        try:
+            client = Client(server_address, cc="reno")
+            files = data_generator.generate_num_of_files(3, 1500000)
+            client.send_files([(stream_id, file) for stream_id, file in enumerate(files, 1)])
+        finally:
+            server_thread.join()
+            api.DEBUG = debug
+        stats = servers[0].stats
+        self.assertEqual(stats['streams_completed'], 3)
+        self.assertEqual(stats['flow_control_violations'], 0)
+        self.assertGreater(stats['credit_updates'], 0)
+        self.assertGreater(client.connection_stats['max_data'], flowcontrol.INITIAL_MAX_DATA)
+        for stream_id in (1, 2, 3):
+            self.assertGreater(client.streams_stats[stream_id]['max_stream_data'], flowcontrol.INITIAL_MAX_STREAM_DATA)
+
+    def test_blocked(self):
+        # A blocked sender is answered with the current limits, in case an update was lost
+        debug, api.DEBUG = api.DEBUG, False
+        server_address = ("127.0.0.1", 9967)
+        server_thread = threading.Thread(target=Server, args=(server_address, api.DEFAULT_BATCH_SIZE, 0.5))
+        server_thread.start()
+        time.sleep(0.2)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(1)
+        try:
+            api.QuicPacket(5, 6, b"", 0, 0, api.HANDSHAKE).sendto(sock, server_address)
+            handshake, _ = api.recv_packet(sock)
+            server_connection_id = handshake.source_connection_id
+            api.QuicPacket(5, server_connection_id, b"", 3, 0, api.STREAM_DATA_BLOCKED).sendto(sock, server_address)
+            [answer] = frames.iter_frames(api.recv_packet(sock)[0])
+            self.assertEqual((answer.frame_type, answer.stream_id, answer.offset), (frames.MAX_STREAM_DATA, 3, flowcontrol.INITIAL_MAX_STREAM_DATA))
+            api.QuicPacket(5, server_connection_id, b"", 0, 0, api.DATA_BLOCKED).sendto(sock, server_address)
+            [answer] = frames.iter_frames(api.recv_packet(sock)[0])
+            self.assertEqual((answer.frame_type, answer.offset), (frames.MAX_DATA, flowcontrol.INITIAL_MAX_DATA))
+        finally:
+            sock.close()
+            server_thread.join()
+            api.DEBUG = debug
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        histogram = metrics.Histogram()
+        for value in range(1, 100001):
+            histogram.record(value)
+        self.assertEqual((histogram.count, histogram.max), (100000, 100000))
+        self.assertAlmostEqual(histogram.percentile(0.5), 50000, delta=50000 / 32)
+        self.assertAlmostEqual(histogram.percentile(0.99), 99000, delta=99000 / 32)
+        self.assertEqual(histogram.percentile(1), 100000)
+        # The buckets are contiguous and their values are within the relative error
+        previous = 0
+        for value in range(1, 1 << 16):
+            index = metrics.bucket_index(value)
+            self.assertIn(index - previous, (0, 1))
+            self.assertLessEqual(abs(metrics.bucket_value(index) - value), value / 32)
+            previous = index
+        self.assertEqual(metrics.bucket_index(1 << 50), metrics.BUCKETS - 1)
+
+    def test_stream_metrics(self):
+        stream_metrics = metrics.StreamMetrics()
+        stream_metrics.on_data(0.0, 0, 100, False)
+        self.assertEqual(stream_metrics.on_data(0.001, 200, 100, False), (True, 0))       # 100..200 is missing
+        self.assertEqual(stream_metrics.on_data(0.003, 100, 100, False), (False, 200))    # Filled it, 200 bytes behind
+        stream_metrics.on_data(0.003, 100, 100, True)
+        snapshot = stream_metrics.snapshot()
+        self.assertEqual({key: snapshot[key] for key in ('packets', 'bytes', 'duplicates', 'gaps', 'reordered')},
+                         {'packets': 4, 'bytes': 400, 'duplicates': 1, 'gaps': 1, 'reordered': 1})
+        self.assertEqual(snapshot['inter_arrival'].count, 2)         # The last two arrived in the same batch
+        self.assertEqual(snapshot['reorder_distance'].max, 200)
+
+    def test_server_metrics(self):
+        debug, api.DEBUG = api.DEBUG, False
+        server_address = ("127.0.0.1", 9968)
+        servers = []
+        server_thread = threading.Thread(target=lambda: servers.append(Server(server_address, api.DEFAULT_BATCH_SIZE, 1, metrics_address=("127.0.0.1", 0))))
+        server_thread.start()
+        try:
+            client = Client(server_address, cc="reno")
+            files = data_generator.generate_num_of_files(2, 100000)
+            client.send_files([(1, files[0]), (2, files[1])])
+        finally:
+            server_thread.join()
+            api.DEBUG = debug
+        # The connection was closed at shutdown, its metrics are in the totals
+        totals = servers[0].metrics_snapshot()['totals']
+        self.assertEqual(totals['delivered'], 200000)
+        self.assertGreaterEqual(totals['bytes'], 200000)
+        # One gap per receive batch, not per packet - the packets of a batch would all read as 0 µs apart
+        self.assertLess(totals['inter_arrival'].count, totals['packets'] - 1)
+        self.assertGreater(totals['inter_arrival'].percentile(0.5), 0)
+
+    def test_endpoint(self):
+        connection = metrics.TransferMetrics()
+        connection.on_packet(0.0, 1000)
+        connection.on_packet(0.002, 1000)
+        connection.delivered = 2000
+        snapshot = {'time': 0, 'worker': 0, 'server': {'pid': 1, 'packets_received': 2}, 'totals': connection.snapshot(),
+                    'connections': {'00000000000000ab': {**connection.snapshot(), 'streams': {1: connection.snapshot()}}}}
+        metrics_server = metrics.MetricsServer(("127.0.0.1", 0))
+        try:
+            metrics_server.publish(snapshot)
+            base = f"http://127.0.0.1:{metrics_server.address[1]}"
+            with urllib.request.urlopen(base + "/metrics") as response:
+                text = response.read().decode()
+            self.assertIn('quic_received_bytes_total{worker="0",connection="00000000000000ab",stream="1"} 2000', text)
+            self.assertIn('quic_goodput_bytes_per_second{worker="0"} 1000000.0', text)
+            self.assertIn('quic_server_packets_received{worker="0"} 2', text)
+            with urllib.request.urlopen(base + "/metrics.json") as response:
+                data = json.loads(response.read())
+            self.assertEqual(data['connections']['00000000000000ab']['streams']['1']['inter_arrival']['p50'], 2000)
+        finally:
+            metrics_server.close()
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, "test.trace")
+
+    def tearDown(self):
+        tracing.configure(logging.INFO)         # Packet events off again
+        self.folder.cleanup()
+
+    def test_ring_buffer(self):
+        trace = tracing.Trace(self.path, 4, "server")
+        for offset in range(6):
+            trace.record(api.PACKET_RECEIVED, api.QuicPacket(0, 9, b"data", 1, offset * 4, api.DATA))
+        trace.close()
+        header, records = tracing.read_trace(self.path)
+        self.assertEqual((header['vantage_point'], header['written'], header['dropped']), ("server", 6, 2))
+        # The newest records, oldest first
+        self.assertEqual([record['offset'] for record in records], [8, 12, 16, 20])
+        self.assertEqual({(record['stream_id'], record['length'], record['connection_id']) for record in records}, {(1, 4, 9)})
+        self.assertEqual(sorted(record['time_ns'] for record in records), [record['time_ns'] for record in records])
+
+    def test_traced_client(self):
+        # Every packet the client sends is traced and comes out as qlog events
+        tracing.configure(logging.INFO, trace_path=self.path, vantage_point="client")
+        self.assertTrue(api.DEBUG)
+        client = Client(("127.0.0.1", 9997), reliable=False)      # the mocked socket can't send ACKs back
+        files = data_generator.generate_num_of_files(1, 10000)
+        client.socket = MagicMock()
+        client.send_file(files[0], 1)
+        api.TRACE.close()
+        qlog = tracing.to_qlog(*tracing.read_trace(self.path))
+        events = qlog['traces'][0]['events']
+        self.assertEqual(len(events), client.connection_stats['datagrams_sent'] + 1)     # And the handshake
+        self.assertEqual({event['name'] for event in events}, {"transport:packet_sent"})
+        self.assertEqual(events[0]['data']['header']['packet_type'], "initial")
+        # The frames of the coalesced datagrams, the FIN on the last one
+        stream_frames = [frame for event in events[1:] for frame in event['data']['frames']]
+        self.assertEqual(len(stream_frames), client.streams_stats[1]['packets_sent'])
+        self.assertEqual(stream_frames[-1]['offset'] + stream_frames[-1]['length'], 10000)
+        self.assertTrue(stream_frames[-1]['fin'])
+        self.assertEqual(sum(frame['length'] for frame in stream_frames), 10000)
+
+    def test_malformed_datagram(self):
+        # A FRAMES datagram whose frame runs past its end is received and traced as the datagram alone
+        tracing.configure(logging.INFO, trace_path=self.path, vantage_point="server")
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server_socket.bind(("127.0.0.1", 0))
+        server_socket.settimeout(1)
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            payload = bytes([frames.STREAM]) + api.encode_varint(1) + api.encode_varint(0) + api.encode_varint(100) + b"short"
+            api.QuicPacket(0, 1, payload, 0, 0, api.FRAMES).sendto(client_socket, server_socket.getsockname())
+            batch = api.BatchReceiver(server_socket, 8).recv_batch()
+        finally:
+            server_socket.close()
+            client_socket.close()
+        self.assertEqual(len(batch), 1)
+        api.TRACE.close()
+        header, records = tracing.read_trace(self.path)
+        received = [record for record in records if record['event'] & ~tracing.FRAME_RECORD == api.PACKET_RECEIVED]
+        self.assertEqual([(record['event'], record['packet_type']) for record in received], [(api.PACKET_RECEIVED, api.FRAMES)])
+
+    def test_sampling(self):
+        tracing.configure(logging.DEBUG, sample=3)
+        self.assertTrue(api.DEBUG)
+        packet = api.QuicPacket(0, 0, b"data", 1, 0, api.DATA)
+        with self.assertLogs("quic.packets", logging.DEBUG) as logs:
+            for _ in range(6):
+                api.log_packet(api.PACKET_SENT, packet, ("127.0.0.1", 9997))
+        self.assertEqual(len(logs.records), 2)
+        self.assertIn("Sent 127.0.0.1:9997", logs.output[0])
+        tracing.configure(logging.INFO)
+        self.assertFalse(api.DEBUG)
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_confidence_interval(self):
+        self.assertEqual(main.confidence_interval([5.0]), (5.0, 0.0))
+        mean, half_width = main.confidence_interval([1.0, 2.0, 3.0])
+        self.assertEqual(mean, 2.0)
+        self.assertAlmostEqual(half_width, 4.303 / 3 ** 0.5)
+
+    def test_compare(self):
+        def results(goodput, wall_time):
+            return [{'key': "a", 'metrics': {'goodput': {'mean': goodput}, 'wall_time': {'mean': wall_time}}}]
+        baseline = {'results': results(100.0, 1.0)}
+        self.assertEqual(main.compare(results(95.0, 1.05), baseline, 0.1), [])
+        self.assertEqual([regression[1] for regression in main.compare(results(80.0, 1.0), baseline, 0.1)], ['goodput'])
+        self.assertEqual([regression[1] for regression in main.compare(results(100.0, 1.5), baseline, 0.1)], ['wall_time'])
+        # Configurations missing from the baseline aren't compared
+        self.assertEqual(main.compare(results(1.0, 9.0), {'results': []}, 0.1), [])
+
+    def test_run_benchmark(self):
+        config = {'streams': 2, 'size': 0.05, 'packet_sizes': (1000, 2000), 'loss': 0.02, 'delay': 0.001, 'compress': "zlib"}
+        results = main.run_benchmark([config], repetitions=2, warmup=0, port=9969)
+        self.assertEqual(results[0]['key'], main.config_key(config))
+        goodput = results[0]['metrics']['goodput']
+        self.assertEqual(len(goodput['samples']), 2)
+        self.assertGreater(goodput['mean'], 0)
+
+
+class TestAsyncApi(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.debug, api.DEBUG = api.DEBUG, False
+
+    async def asyncTearDown(self):
+        api.DEBUG = self.debug
+
+    async def test_streams(self):
+        received = {}
+
+        async def handle_stream(stream):
+            received[stream.stream_id] = await stream.read()
+
+        files = {stream_id: bytes([stream_id]) * (20000 + stream_id) for stream_id in (1, 2, 3)}
+        async with async_api.QuicServer(("127.0.0.1", 0), handle_stream) as server:
+            async with async_api.QuicClient(server.server_address) as client:
+                async def send(data):
+                    async with client.open_stream() as stream:
+                        await stream.write(data)
+                await asyncio.gather(*(send(files[stream_id]) for stream_id in files))
+            for _ in range(100):
+                if len(received) == len(files):
+                    break
+                await asyncio.sleep(0.01)
+        self.assertEqual(received, files)
+
+    async def test_receive_window(self):
+        # Early chunks are buffered only within the stream's window past the in order data, and the connection's
+        connection = MagicMock(buffered_bytes=0, window=250)
+        stream = async_api.ReceiveStream(connection, 1, window=200)
+        stream.on_data(100, b"x" * 100)
+        stream.on_data(200, b"x" * 100)             # Ends past next_pos + window
+        self.assertEqual((stream.buffered_bytes, stream.dropped), (100, 1))
+        other = async_api.ReceiveStream(connection, 2, window=200)
+        other.on_data(100, b"x" * 100)
+        other.on_data(30, b"x" * 60)                # Over the connection's window
+        self.assertEqual((connection.buffered_bytes, other.dropped), (200, 1))
+        # The gap filled, the window slides on
+        stream.on_data(0, b"x" * 100)
+        stream.on_data(200, b"x" * 100)
+        self.assertEqual((stream.next_pos, stream.buffered_bytes, connection.buffered_bytes), (300, 0, 100))
+
+    async def test_idle_timeout(self):
+        async with async_api.QuicServer(("127.0.0.1", 0), idle_timeout=0.1) as server:
+            client = await async_api.QuicClient(server.server_address).connect()
+            stream = client.open_stream()
+            await stream.write(b"never finished")
+            server_stream = await asyncio.wait_for(server.accept_stream(), 1)
+            # The connection times out on its own, the stream reports it instead of hanging
+            with self.assertRaises(ConnectionError):
+                await asyncio.wait_for(server_stream.read(), 1)
+            client.transport.close()
+
+
+    async def test_other_packets(self):
+        # Packets of the other transport (server.py's) open no connection and no stream
+        async with async_api.QuicServer(("127.0.0.1", 0)) as server:
+            client = await async_api.QuicClient(server.server_address).connect()
+            for packet_type in (api.HANDSHAKE, api.ACK, api.FRAMES):
+                await client.send(api.QuicPacket(client.connection_id, client.server_connection_id, b"", 0, 0, packet_type))
+            stream = client.open_stream()
+            await stream.write(b"data")
+            server_stream = await asyncio.wait_for(server.accept_stream(), 1)
+            self.assertEqual(server_stream.stream_id, stream.stream_id)
+            self.assertEqual(list(server.connections), [client.server_connection_id])
+            self.assertEqual(list(server.connections[client.server_connection_id].streams), [stream.stream_id])
+            client.transport.close()
+
+    async def test_short_datagrams(self):
+        # Datagrams cut anywhere in the header are dropped quietly, the server keeps serving
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        async with async_api.QuicServer(("127.0.0.1", 0)) as server:
+            client = await async_api.QuicClient(server.server_address).connect()
+            header = api.QuicPacket(client.connection_id, client.server_connection_id, b"", 0, 0, api.END_STREAM).pack()
+            for size in range(api.LONG_HEADER_SIZE):
+                client.transport.sendto(bytes(header[:size]))
+            stream = client.open_stream()
+            await stream.write(b"data")
+            server_stream = await asyncio.wait_for(server.accept_stream(), 1)
+            self.assertEqual(server_stream.stream_id, stream.stream_id)
+            self.assertEqual(errors, [])
+            client.transport.close()
+
+class TestEmulator(unittest.TestCase):
+    def test_bernoulli(self):
+        link = emulator.Link(emulator.Bernoulli(0.1), seed=1)
+        for _ in range(10000):
+            link.transmit(0.0, 1000)
+        self.assertAlmostEqual(link.stats['lost'] / 10000, 0.1, delta=0.02)
+        # The same seed drops the same datagrams
+        first, second = emulator.Link(emulator.Bernoulli(0.1), seed=2), emulator.Link(emulator.Bernoulli(0.1), seed=2)
+        self.assertEqual([first.transmit(0.0, 1) for _ in range(100)], [second.transmit(0.0, 1) for _ in range(100)])
+
+    def test_gilbert_elliott(self):
+        model = emulator.GilbertElliott(0.01, 0.25)
+        link = emulator.Link(model, seed=1)
+        lost = [link.transmit(0.0, 1000) is None for _ in range(20000)]
+        self.assertAlmostEqual(sum(lost) / len(lost), model.mean_loss(), delta=0.015)
+        # Losses come in bursts - the mean burst is 1 / r datagrams
+        bursts = [len(list(group)) for is_lost, group in itertools.groupby(lost) if is_lost]
+        self.assertGreater(sum(bursts) / len(bursts), 2)
+
+    def test_delay_and_jitter(self):
+        link = emulator.Link(delay=0.05, jitter=0.01, seed=1)
+        arrivals = [link.transmit(i * 0.001, 1000) for i in range(100)]
+        self.assertTrue(all(0.04 <= arrival - i * 0.001 <= 0.06 or arrival == arrivals[i - 1] for i, arrival in enumerate(arrivals)))
+        self.assertEqual(arrivals, sorted(arrivals))           # Jitter keeps the order
+
+    def test_reorder(self):
+        link = emulator.Link(delay=0.01, reorder=0.2, seed=1)
+        arrivals = [link.transmit(i * 0.001, 1000) for i in range(100)]
+        self.assertGreater(link.stats['reordered'], 0)
+        self.assertNotEqual(arrivals, sorted(arrivals))
+
+    def test_rate_limit(self):
+        # 1 MB/s - after the bucket's burst a 1000 byte datagram leaves every ms, past the queue they are dropped
+        link = emulator.Link(rate=1e6, queue=10500, bucket=2000)
+        arrivals = [link.transmit(0.0, 1000) for _ in range(20)]
+        self.assertEqual(arrivals[:2], [0.0, 0.0])
+        self.assertAlmostEqual(arrivals[5], 0.004)
+        self.assertEqual(link.stats['overflowed'], 8)
+        self.assertEqual(arrivals[-1], None)
+
+    def test_transfer(self):
+        # A transfer through delay, jitter, reordering and loss in both directions
+        server_address = ("127.0.0.1", 9970)
+        server_thread = threading.Thread(target=Server, args=(server_address, api.DEFAULT_BATCH_SIZE, 1))
+        server_thread.start()
+        uplink, downlink = emulator.links(0.02, delay=0.005, jitter=0.002, reorder=0.05, seed=1)
+        proxy = emulator.NetworkEmulator(("127.0.0.1", 0), server_address, uplink, downlink)
+        try:
+            client = Client(proxy.address, window=32, cc="reno")
+            files = data_generator.generate_num_of_files(2, 100000)
+            client.send_files([(1, files[0]), (2, files[1])])
+            for stream_id in (1, 2):
+                self.assertEqual(client.streams_stats[stream_id]['bytes_sent'], 100000)
+            self.assertGreater(uplink.stats['lost'] + downlink.stats['lost'], 0)
+            self.assertGreater(uplink.stats['reordered'], 0)
+        finally:
+            proxy.close()
+            server_thread.join()
+
+
+class TestReliability(unittest.TestCase):
+    def test_range_set(self):
+        received = reliability.RangeSet()
+        for pos in [0, 1, 2, 5, 6, 9, 3]:
+            self.assertTrue(received.add(pos))
+        self.assertFalse(received.add(5))           # duplicate
+        self.assertEqual(list(received), [(0, 4), (5, 7), (9, 10)])
+        received.add(4)
+        self.assertEqual(list(received), [(0, 7), (9, 10)])
+        self.assertIn(6, received)
+        self.assertNotIn(7, received)
+        self.assertEqual(received.last(1), [(9, 10)])
+        # An empty range (a frame without data or FIN) changes nothing, also past the end
+        self.assertFalse(received.add_range(20, 20))
+        self.assertFalse(received.add_range(8, 8))
+        self.assertEqual(list(received), [(0, 7), (9, 10)])
+
+    def test_ack_ranges_codec(self):
+        ranges = [(90000, 100000), (5, 7), (0, 4)]
+        self.assertEqual(api.unpack_ack_ranges(memoryview(api.pack_ack_ranges(ranges))), ranges)
+
+    def test_loss_detection(self):
+        loss_detector = reliability.LossDetector()
+        packets = [api.QuicPacket(0, 1, b"x" * 100, 1, offset, api.DATA) for offset in range(0, 1000, 100)]
+        for packet in packets:
+            loss_detector.on_packet_sent(packet, 0.0)
+        # Everything but the third packet arrived - it is lost by the packet threshold, the RTT is sampled from the newest one
+        acked, lost = loss_detector.on_ack_received(1, [(300, 1000), (0, 200)], 0.05)
+        self.assertEqual(len(acked), 9)
+        self.assertEqual([sent.packet.pos_in_stream for sent in lost], [200])
+        self.assertAlmostEqual(loss_detector.rtt.smoothed_rtt, 0.05)
+        self.assertEqual(loss_detector.bytes_in_flight, 0)
+
+    def test_probe_timeout(self):
+        loss_detector = reliability.LossDetector()
+        loss_detector.on_packet_sent(api.QuicPacket(0, 1, b"x", 1, 0, api.DATA), 0.0)
+        deadline = loss_detector.timeout_deadline()
+        lost, probes = loss_detector.on_timeout(deadline)
+        self.assertEqual(lost, [])
+        self.assertEqual([sent.packet.pos_in_stream for sent in probes], [0])
+        self.assertEqual(loss_detector.pto_count, 1)
+        self.assertEqual(loss_detector.packets_lost, 0)
+
+    def test_transfer_with_loss(self):
+        # A real server behind the emulator dropping 5% of the datagrams to it, everything must still be acknowledged
+        debug, api.DEBUG = api.DEBUG, False
+        server_address = ("127.0.0.1", 9961)
+        output_dir = tempfile.TemporaryDirectory()
+        server_thread = threading.Thread(target=Server, args=(server_address, api.DEFAULT_BATCH_SIZE, 1, output_dir.name))
+        server_thread.start()
+        proxy = emulator.NetworkEmulator(("127.0.0.1", 0), server_address, emulator.Link(emulator.Bernoulli(0.05), seed=1))
+        try:
+            # Fixed packet sizes - no path MTU probes, those aren't retransmitted when lost
+            client = Client(proxy.address, window=32, cc="reno", packet_sizes=(1000, 2000))
+            files = data_generator.generate_num_of_files(2, 200000)
+            client.send_files([(1, files[0]), (2, files[1])])
+            retransmitted = sum(stats['packets_retransmitted'] for stats in client.streams_stats.values())
+            self.assertGreater(proxy.uplink.stats['lost'], 0)
+            self.assertGreaterEqual(retransmitted, proxy.uplink.stats['lost'])
+        finally:
+            proxy.close()
+            server_thread.join()
+            api.DEBUG = debug
+        # The server reassembled both files despite the loss
+        for stream_id, file in enumerate(files, 1):
+            with open(file, "rb") as sent, open(server.stream_path(output_dir.name, client.server_connection_id, stream_id), "rb") as received:
+                self.assertEqual(sent.read(), received.read())
+        output_dir.cleanup()
+
+
+class TestCongestion(unittest.TestCase):
+    def sent_packets(self, count, time_sent, size=1000):
+        return [reliability.SentPacket(i, None, time_sent, size, False) for i in range(count)]
+
+    def test_reno(self):
+        controller = congestion.NewReno(1000)
+        rtt = reliability.RttEstimator()
+        self.assertEqual(controller.congestion_window, 10000)
+        # Slow start doubles the window every window acknowledged
+        controller.on_packets_acked(self.sent_packets(10, 1.0), 1.1, rtt)
+        self.assertEqual(controller.congestion_window, 20000)
+        # A loss halves it, once per loss event
+        controller.on_packets_lost(self.sent_packets(2, 1.0), 1.2)
+        self.assertEqual(controller.congestion_window, 10000)
+        controller.on_packets_lost(self.sent_packets(1, 1.1), 1.3)
+        self.assertEqual(controller.congestion_window, 10000)
+        # Congestion avoidance - one datagram per window
+        controller.on_packets_acked(self.sent_packets(10, 1.5), 1.6, rtt)
+        self.assertEqual(controller.congestion_window, 11000)
+
+    def test_cubic(self):
+        controller = congestion.Cubic(1000)
+        rtt = reliability.RttEstimator()
+        rtt.update(0.1)
+        controller.congestion_window = 100000
+        controller.on_packets_lost(self.sent_packets(1, 0.0), 1.0)
+        self.assertAlmostEqual(controller.congestion_window, 70000)
+        # Grows back towards the old window (100 datagrams) and past it, K seconds after the loss
+        now = 1.0
+        while now < 1.0 + controller.k + 1:
+            now += 0.1
+            controller.on_packets_acked(self.sent_packets(int(controller.congestion_window // 1000), now - 0.1), now, rtt)
+        self.assertGreater(controller.congestion_window, 100000)
+
+    def test_cubic_minimum_window(self):
+        controller = congestion.Cubic(1200)
+        rtt = reliability.RttEstimator()
+        rtt.update(0.1)
+        # Losses until the window is held at the minimum, fast convergence puts w_max below it
+        for event in range(6):
+            controller.on_congestion_event(float(event))
+        self.assertEqual(controller.congestion_window, controller.minimum_window)
+        self.assertIsInstance(controller.k, float)
+        controller.on_packets_acked(self.sent_packets(2, 6.0), 6.1, rtt)
+        self.assertGreaterEqual(controller.congestion_window, controller.minimum_window)
+
+    def test_none(self):
+        controller = congestion.CongestionController()
+        self.assertTrue(controller.can_send(10 ** 12))
+
+    def test_pacer(self):
+        pacer = congestion.Pacer(burst=2000)
+        pacer.update_rate(100000, 0.1)          # 1,250,000 B/s with the pacing gain
+        self.assertEqual(pacer.time_until_send(1000, 0.0), 0)
+        pacer.on_packet_sent(1000)
+        pacer.on_packet_sent(1000)
+        # The burst is used up, 1000 more bytes take 0.8 ms - less than the pacing granularity
+        self.assertEqual(pacer.time_until_send(1000, 0.0), 0)
+        pacer.on_packet_sent(1000)
+        pacer.on_packet_sent(1000)
+        self.assertAlmostEqual(pacer.time_until_send(1000, 0.0), 3000 / 1250000)
+
+    def test_max_datagram_size_changed(self):
+        controller = congestion.Cubic(1200)
+        controller.on_max_datagram_size_changed(65507)
+        self.assertEqual(controller.congestion_window, congestion.initial_window(65507))
+        self.assertEqual(controller.minimum_window, 2 * 65507)
+
+
+class TestPathMtu(unittest.TestCase):
+    def test_probe_packet(self):
+        for size in (1200, 1472, 16400, 65507):
+            packet = pmtud.probe_packet(1, 2, size)
+            self.assertEqual(packet.size(), size)
+            self.assertEqual(len(packet.pack()), size)
+
+    def test_search(self):
+        # A 1500 byte path behind a 64 KiB interface - Ethernet's size, then the interface's and jumbo's, then a binary search
+        path_mtu = pmtud.PathMtuDiscovery(api.MAX_UDP_PAYLOAD)
+        now = 0.0
+        sizes = []
+        while path_mtu.state == pmtud.SEARCHING:
+            size = path_mtu.next_probe(now, 0.1)
+            if size is not None:
+                sizes.append(size)
+                if size + pmtud.UDP_IP_OVERHEAD <= 1500:
+                    path_mtu.on_probe_acked(size, now)
+            now += 0.1
+        self.assertEqual(sizes[:1 + 2 * pmtud.MAX_PROBES], [1472] + [api.MAX_UDP_PAYLOAD] * pmtud.MAX_PROBES + [8972] * pmtud.MAX_PROBES)
+        self.assertEqual(path_mtu.plpmtu, 1472)
+        self.assertIsNone(path_mtu.next_probe(now, 0.1))
+        # Bigger sizes are tried again once the raise timer fires
+        self.assertEqual(path_mtu.next_probe(now + pmtud.PMTU_RAISE_TIMER, 0.1), api.MAX_UDP_PAYLOAD)
+
+    def test_unknown_size_acked(self):
+        # Only the size of a probe that was sent raises the PLPMTU
+        path_mtu = pmtud.PathMtuDiscovery(api.MAX_UDP_PAYLOAD)
+        size = path_mtu.next_probe(0.0, 0.1)
+        self.assertFalse(path_mtu.on_probe_acked(size + 1, 0.0))
+        self.assertFalse(path_mtu.on_probe_acked(9000, 0.0))
+        self.assertEqual(path_mtu.plpmtu, pmtud.BASE_PLPMTU)
+        self.assertTrue(path_mtu.on_probe_acked(size, 0.0))
+        self.assertEqual(path_mtu.plpmtu, size)
+
+    def test_transfer(self):
+        # Through a 1500 byte path the datagrams grow to what it carries, only probes are too big
+        server_address = ("127.0.0.1", 9971)
+        server_thread = threading.Thread(target=Server, args=(server_address, api.DEFAULT_BATCH_SIZE, 1))
+        server_thread.start()
+        uplink, downlink = emulator.links(mtu=1500)
+        proxy = emulator.NetworkEmulator(("127.0.0.1", 0), server_address, uplink, downlink)
+        try:
+            client = Client(proxy.address)
+            files = data_generator.generate_num_of_files(1, 1000000)
+            client.send_files([(1, files[0])])
+            self.assertGreater(client.connection_stats['max_datagram_size'], pmtud.BASE_PLPMTU)
+            self.assertLessEqual(client.connection_stats['max_datagram_size'], 1500 - pmtud.UDP_IP_OVERHEAD)
+            self.assertGreater(uplink.stats['too_big'], 0)
+            self.assertLessEqual(uplink.stats['too_big'], client.connection_stats['pmtu_probes'])
+        finally:
+            proxy.close()
+            server_thread.join()
+
+
+class TestFrames(unittest.TestCase):
+    def test_codec(self):
+        sent = [frames.Frame(frames.STREAM, 1, 70000, b"data"), frames.Frame(frames.STREAM, 2, 300, b"", True),
+                frames.Frame(frames.ACK, 3, 99, api.pack_ack_ranges([(0, 100)])), frames.Frame(frames.MAX_DATA, 0, 1 << 20)]
+        [datagram] = frames.pack(sent, 1, 2, pmtud.BASE_PLPMTU)
+        packet = api.QuicPacket(0, 0, b"", 0, 0)
+        packet.unpack(datagram.pack())
+        self.assertEqual(packet.packet_type, api.FRAMES)
+        received = list(frames.iter_frames(packet))
+        self.assertEqual([(frame.frame_type, frame.stream_id, frame.offset, bytes(frame.data), frame.fin) for frame in received],
+                         [(frame.frame_type, frame.stream_id, frame.offset, bytes(frame.data), frame.fin) for frame in sent])
+        # A single frame packet reads as its frame, END_STREAM as an empty FIN
+        [frame] = frames.iter_frames(api.QuicPacket(0, 1, b"", 4, 500, api.END_STREAM))
+        self.assertEqual((frame.frame_type, frame.stream_id, frame.offset, frame.fin, frame.ack_space_length()), (frames.STREAM, 4, 500, True, 1))
+
+    def test_packer(self):
+        # Small frames of many streams share a datagram, the FIN goes on the waiting frame, a frame that doesn't fit seals it
+        packer = frames.FramePacker(1, 2, pmtud.BASE_PLPMTU)
+        for stream_id in range(1, 11):
+            self.assertIsNone(packer.add(frames.Frame(frames.STREAM, stream_id, 0, b"x" * 100)))
+            self.assertIsNone(packer.end_stream(stream_id, 100))
+        packet = packer.add(frames.Frame(frames.STREAM, 11, 0, b"x" * 1000))
+        self.assertEqual([(frame.stream_id, frame.fin) for frame in packet.frames], [(stream_id, True) for stream_id in range(1, 11)])
+        self.assertLessEqual(packet.size(), pmtud.BASE_PLPMTU)
+        # The end of a stream whose last frame already left is an empty FIN frame of its own
+        self.assertIsNone(packer.end_stream(1, 100))
+        packet = packer.seal()
+        self.assertEqual([(frame.stream_id, frame.offset, len(frame.data), frame.fin) for frame in packet.frames], [(11, 0, 1000, False), (1, 100, 0, True)])
+        self.assertIsNone(packer.seal())
+
+    def test_segments(self):
+        # The stream data stay the views they were given, on the wire the datagrams read the same with and without GSO
+        # A datagram with no room for another frame is padded to the full size, so the full ones are all the same size
+        data = memoryview(bytes(range(256)) * 20)
+        max_size = pmtud.BASE_PLPMTU
+        chunk = max_size - frames.MAX_PACKET_OVERHEAD - frames.MAX_FRAME_OVERHEAD
+        sent = [frames.Frame(frames.STREAM, 1, offset, data[offset:offset + chunk]) for offset in range(0, len(data), chunk)]
+        datagrams = frames.pack(sent, 1, 2, max_size)
+        for datagram, frame in zip(datagrams, sent):
+            self.assertIsNone(datagram.payload)
+            self.assertTrue(any(segment is frame.data for segment in datagram.segments))
+        self.assertEqual({datagram.payload_length for datagram in datagrams[:-1]}, {max_size - frames.MAX_PACKET_OVERHEAD})
+        self.assertLess(datagrams[-1].payload_length, max_size - frames.MAX_PACKET_OVERHEAD)
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server_socket.bind(("127.0.0.1", 0))
+        server_socket.settimeout(1)
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for use_gso in (True, False):
+                send_queue = api.SendQueue(client_socket, server_socket.getsockname(), 16, use_gso=use_gso)
+                for datagram in datagrams:
+                    send_queue.append(datagram)
+                send_queue.flush()
+                receiver = api.BatchReceiver(server_socket, 64)
+                received = []
+                while len(received) < len(sent):
+                    received += [(frame.offset, bytes(frame.data)) for packet, _ in receiver.recv_batch() for frame in frames.iter_frames(packet)]
+                self.assertEqual(received, [(frame.offset, bytes(frame.data)) for frame in sent])
+        finally:
+            server_socket.close()
+            client_socket.close()
+
+    def test_partial_ack(self):
+        # A datagram of two streams' frames arrived once either ACK comes (RTT sample), it is acknowledged once both did
+        loss_detector = reliability.LossDetector()
+        packet = frames.build_packet(0, 1, [frames.Frame(frames.STREAM, 1, 0, b"x" * 100), frames.Frame(frames.STREAM, 2, 0, b"y" * 100, True)])
+        loss_detector.on_packet_sent(packet, 0.0)
+        acked, lost = loss_detector.on_ack_received(1, [(0, 100)], 0.05)
+        self.assertEqual((acked, lost), ([], []))
+        self.assertAlmostEqual(loss_detector.rtt.smoothed_rtt, 0.05)
+        self.assertEqual(loss_detector.bytes_in_flight, packet.size())
+        acked, _ = loss_detector.on_ack_received(2, [(0, 101)], 0.06)
+        self.assertEqual([sent.packet for sent in acked], [packet])
+        self.assertEqual(loss_detector.bytes_in_flight, 0)
+
+    def test_small_files(self):
+        # Many small files take fewer datagrams than there are streams, and all of them arrive intact
+        debug, api.DEBUG = api.DEBUG, False
+        server_address = ("127.0.0.1", 9972)
+        output_dir = tempfile.TemporaryDirectory()
+        server_thread = threading.Thread(target=Server, args=(server_address, api.DEFAULT_BATCH_SIZE, 1, output_dir.name))
+        server_thread.start()
+        time.sleep(0.2)
+        try:
+            client = Client(server_address)
+            files = data_generator.generate_num_of_files(20, 300)
+            client.send_files(list(enumerate(files, 1)))
+            self.assertLess(client.connection_stats['datagrams_sent'], len(files))
+        finally:
+            server_thread.join()
+            api.DEBUG = debug
+        for stream_id, file in enumerate(files, 1):
+            with open(file, "rb") as sent, open(server.stream_path(output_dir.name, client.server_connection_id, stream_id), "rb") as received:
+                self.assertEqual(sent.read(), received.read())
+        output_dir.cleanup()
+
+
+class TestCompression(unittest.TestCase):
+    def test_negotiation(self):
+        self.assertIs(compression.choose(compression.encode_offer(["lzma", "zlib"])), compression.CODECS["lzma"])
+        self.assertIs(compression.choose(compression.encode_offer(["lzma", "zlib"]), ["zlib"]), compression.CODECS["zlib"])
+        self.assertIsNone(compression.choose(compression.encode_offer(["zlib"]), []))
+        self.assertIsNone(compression.choose(b"\xff"))            # A codec we don't know
+        self.assertIsNone(compression.choose(b""))
+
+    def test_stream(self):
+        # Blocks compressed in parallel, cut into chunks and decompressed back in pieces that don't line up with the members
+        data = b"".join(f"{i:08d}".encode() for i in range(20000))
+        for codec in compression.CODECS.values():
+            with concurrent.futures.ThreadPoolExecutor(2) as executor:
+                chunks = list(compression.compressed_chunks(codec, memoryview(data), 1000, executor, block_size=30000))
+            stream = b"".join(chunks)
+            self.assertLess(len(stream), len(data))
+            self.assertTrue(all(len(chunk) <= 1000 for chunk in chunks))
+            decompressor = compression.StreamDecompressor(codec)
+            self.assertEqual(b"".join(decompressor.decompress(stream[i:i + 777]) for i in range(0, len(stream), 777)), data)
+
+    def test_transfer(self):
+        # The server takes the offered codec, the files go compressed and are saved as they were
+        debug, api.DEBUG = api.DEBUG, False
+        server_address = ("127.0.0.1", 9973)
+        output_dir = tempfile.TemporaryDirectory()
+        server_thread = threading.Thread(target=Server, args=(server_address, api.DEFAULT_BATCH_SIZE, 1, output_dir.name))
+        server_thread.start()
+        time.sleep(0.2)
+        try:
+            client = Client(server_address, compression="zlib")
+            files = data_generator.generate_num_of_files(2, 600000)
+            client.send_files([(1, files[0]), (2, files[1])])
+            self.assertIs(client.codec, compression.CODECS["zlib"])
+            for stats in client.streams_stats.values():
+                self.assertEqual(stats['application_bytes'], 600000)
+                self.assertLess(stats['bytes_sent'], 0.8 * stats['application_bytes'])
+        finally:
+            server_thread.join()
+            api.DEBUG = debug
+        for stream_id, file in enumerate(files, 1):
+            with open(file, "rb") as sent, open(server.stream_path(output_dir.name, client.server_connection_id, stream_id), "rb") as received:
+                self.assertEqual(sent.read(), received.read())
+        output_dir.cleanup()
+
+
+class TestFec(unittest.TestCase):
+    def test_parity(self):
+        # Datagrams of different sizes, any single one lost from a group is rebuilt from the others and the parity
+        datagrams = [frames.build_packet(1, 2, [frames.Frame(frames.STREAM, 1, i * 1000, bytes([i + 1]) * (100 + 37 * i))]) for i in range(5)]
+        for lost in range(5):
+            encoder, decoder = fec.FecEncoder(5), fec.FecDecoder()
+            parities = [encoder.protect(datagram) for datagram in datagrams]
+            self.assertEqual(parities[:4], [None] * 4)
+            self.assertEqual((parities[4].packet_type, parities[4].stream_id, parities[4].pos_in_stream), (api.FEC_PARITY, 1, 5))
+            for i, datagram in enumerate(datagrams):
+                if i != lost:
+                    self.assertIsNone(decoder.on_data(datagram))
+            recovered = decoder.on_parity(parities[4])
+            self.assertEqual(recovered.pos_in_stream, lost)
+            [frame] = frames.iter_frames(recovered)     # The zeros it is padded with read as padding
+            self.assertEqual((frame.offset, bytes(frame.data)), (lost * 1000, bytes(datagrams[lost].joined_payload()[-(100 + 37 * lost):])))
+            self.assertIsNone(decoder.on_data(datagrams[lost]))        # Arrived late, the group is done
+        # Two lost from the same group - nothing to rebuild, the sender retransmits them
+        encoder, decoder = fec.FecEncoder(5), fec.FecDecoder()
+        parity = [encoder.protect(datagram) for datagram in datagrams][-1]
+        for datagram in datagrams[2:]:
+            decoder.on_data(datagram)
+        self.assertIsNone(decoder.on_parity(parity))
+        # A short group sealed before the sender goes quiet
+        self.assertEqual(encoder.seal(1, 2), None)
+        encoder.protect(datagrams[0])
+        self.assertEqual(encoder.seal(1, 2).pos_in_stream, 1)
+
+    def test_group_size(self):
+        self.assertEqual(fec.group_size_for(0), fec.MAX_GROUP_SIZE)
+        self.assertEqual(fec.group_size_for(0.05), 4)
+        self.assertEqual(fec.group_size_for(0.5), fec.MIN_GROUP_SIZE)
+        # The group size follows the smoothed loss, a fixed one doesn't
+        adaptive, fixed = fec.FecEncoder(), fec.FecEncoder(8)
+        for encoder in (adaptive, fixed):
+            encoder.on_loss_counts(10, 0)          # Too few datagrams for a sample
+            self.assertIsNone(encoder.loss_rate)
+            encoder.on_loss_counts(1000, 10)
+            self.assertAlmostEqual(encoder.loss_rate, 0.01)
+        self.assertEqual((adaptive.group_size, fixed.group_size), (24, 8))
+
+    def test_transfer_with_loss(self):
+        # Behind the emulator dropping 5% of the datagrams to the server, most losses are rebuilt instead of retransmitted
+        debug, api.DEBUG = api.DEBUG, False
+        server_address = ("127.0.0.1", 9974)
+        output_dir = tempfile.TemporaryDirectory()
+        stats_file = os.path.join(output_dir.name, "stats.json")
+        server_thread = threading.Thread(target=Server, args=(server_address, api.DEFAULT_BATCH_SIZE, 1, output_dir.name), kwargs={'stats_file': stats_file})
+        server_thread.start()
+        proxy = emulator.NetworkEmulator(("127.0.0.1", 0), server_address, emulator.Link(emulator.Bernoulli(0.05), seed=1))
+        try:
+            client = Client(proxy.address, window=32, cc="reno", packet_sizes=(1000, 2000), fec=0)
+            files = data_generator.generate_num_of_files(2, 200000)
+            client.send_files([(1, files[0]), (2, files[1])])
+            stats = client.connection_stats
+            self.assertGreater(stats['fec_parity_sent'], 0)
+            self.assertGreater(stats['fec_loss_rate'], 0)
+            self.assertLess(stats['fec_group_size'], fec.MAX_GROUP_SIZE)
+        finally:
+            proxy.close()
+            server_thread.join()
+            api.DEBUG = debug
+        with open(stats_file) as file:
+            self.assertGreater(json.load(file)['server']['fec_recovered'], 0)
+        for stream_id, file in enumerate(files, 1):
+            with open(file, "rb") as sent, open(server.stream_path(output_dir.name, client.server_connection_id, stream_id), "rb") as received:
+                self.assertEqual(sent.read(), received.read())
+        output_dir.cleanup()
+
+
+class TestProfiling(unittest.TestCase):
+    def test_phases(self):
+        # Nested phases - own times exclude the nested ones, every stack is a line of the collapsed stack file
+        class Work:
+            def outer(self):
+                time.sleep(0.01)
+                self.inner()
+
+            def inner(self):
+                time.sleep(0.02)
+
+        self.assertIsInstance(profiling.lock("off"), type(threading.Lock()))       # Nothing is timed when off
+        output_dir = tempfile.TemporaryDirectory()
+        output = os.path.join(output_dir.name, "test.folded")
+        profiling.configure([(Work, "outer", "outer"), (Work, "inner", "inner")], "test", output)
+        with profiling.lock("test lock"):
+            Work().outer()
+        Work().inner()
+        with contextlib.redirect_stdout(io.StringIO()) as report:
+            profiling.report()
+        self.assertFalse(profiling.ENABLED)
+        self.assertIn("Lock 'test lock': 1 acquisitions, 0 waited", report.getvalue())
+        with open(output) as file:
+            stacks = {path: int(us) for path, us in (line.rsplit(" ", 1) for line in file)}
+        self.assertEqual(set(stacks), {"test", "test;outer", "test;outer;inner", "test;inner"})
+        self.assertAlmostEqual(stacks["test;outer"], 10000, delta=5000)
+        self.assertAlmostEqual(stacks["test;outer;inner"], 20000, delta=5000)
+        Work().outer()          # Stopped, the wrappers just call through
+        output_dir.cleanup()
+
+
+class TestHandshake(unittest.TestCase):
+    def test_parameters(self):
+        parameters = handshake.decode_parameters(handshake.encode_parameters({handshake.INITIAL_MAX_DATA: 1 << 20, handshake.CODECS: b"\x01\x02", 0x7777: b""}))
+        self.assertEqual(parameters, {handshake.INITIAL_MAX_DATA: api.encode_varint(1 << 20), handshake.CODECS: b"\x01\x02", 0x7777: b""})
+        self.assertEqual(handshake.integer(parameters, handshake.INITIAL_MAX_DATA), 1 << 20)
+        self.assertEqual(handshake.integer(parameters, handshake.MAX_UDP_PAYLOAD_SIZE, 1200), 1200)
+        with self.assertRaises(ValueError):
+            handshake.decode_parameters(handshake.encode_parameters({handshake.CODECS: b"\x01\x02"})[:-1])
+
+    def test_ticket(self):
+        ticket = handshake.issue_ticket(1000, 500, 1, now=100.0)
+        self.assertEqual(handshake.open_ticket(ticket, now=200.0), (1000, 500, 1))
+        self.assertEqual(handshake.open_ticket(handshake.issue_ticket(1000, 500, None, now=100.0), now=200.0), (1000, 500, None))
+        self.assertIsNone(handshake.open_ticket(ticket, now=100.0 + handshake.TICKET_LIFETIME + 1))          # Expired
+        self.assertIsNone(handshake.open_ticket(ticket[:-1] + bytes([ticket[-1] ^ 1]), now=200.0))          # Tampered with
+        self.assertIsNone(handshake.open_ticket(ticket, now=200.0, key=b"another server"))
+        self.assertIsNone(handshake.open_ticket(b"short"))
+
+    def test_ticket_key_file(self):
+        # The key is created once, a server that loads it later (a restart, another worker) opens the tickets issued with it
+        folder = tempfile.TemporaryDirectory()
+        path = os.path.join(folder.name, "ticket.key")
+        key = handshake.load_ticket_key(path)
+        self.assertEqual(len(key), handshake.TICKET_KEY_SIZE)
+        ticket = handshake.issue_ticket(1000, 500, None, now=100.0, key=key)
+        self.assertEqual(handshake.open_ticket(ticket, now=200.0, key=handshake.load_ticket_key(path)), (1000, 500, None))
+        with open(path, "wb") as file:
+            file.write(b"short")
+        with self.assertRaises(ValueError):
+            handshake.load_ticket_key(path)
+        folder.cleanup()
+
+    def transfer(self, server_address, session_cache, output_dir, compression=None):
+        client = Client(server_address, session_cache=session_cache, compression=compression)
+        client.connect()
+        handshake_pending = client.handshake_pending
+        files = data_generator.generate_num_of_files(2, 100000)
+        client.send_files([(1, files[0]), (2, files[1])])
+        client.close()
+        for stream_id, file in enumerate(files, 1):
+            with open(file, "rb") as sent, open(server.stream_path(output_dir, client.server_connection_id, stream_id), "rb") as received:
+                self.assertEqual(sent.read(), received.read())
+        return client, handshake_pending
+
+    def test_resumption(self):
+        # The first connection gets a ticket, the next one sends its streams without waiting for the answer (0-RTT)
+        # A ticket the server can't open gets the early data rejected, and the client resends it
+        debug, api.DEBUG = api.DEBUG, False
+        server_address = ("127.0.0.1", 9975)
+        output_dir = tempfile.TemporaryDirectory()
+        stats_file = os.path.join(output_dir.name, "stats.json")
+        server_thread = threading.Thread(target=Server, args=(server_address, api.DEFAULT_BATCH_SIZE, 1, output_dir.name), kwargs={'stats_file': stats_file})
+        server_thread.start()
+        time.sleep(0.2)
+        try:
+            cache_path = os.path.join(output_dir.name, "sessions.json")
+            client, handshake_pending = self.transfer(server_address, handshake.SessionCache(cache_path), output_dir.name)
+            self.assertFalse(handshake_pending)
+            self.assertIsNone(client.connection_stats['early_data'])
+            # A new cache reads the ticket from the file, like the next run of the client would
+            client, handshake_pending = self.transfer(server_address, handshake.SessionCache(cache_path), output_dir.name)
+            self.assertTrue(handshake_pending)
+            self.assertIs(client.connection_stats['early_data'], True)
+            session_cache = handshake.SessionCache(cache_path)
+            session = session_cache.get(server_address)
+            session.ticket = session.ticket[:-1] + bytes([session.ticket[-1] ^ 1])
+            client, handshake_pending = self.transfer(server_address, session_cache, output_dir.name)
+            self.assertTrue(handshake_pending)
+            self.assertIs(client.connection_stats['early_data'], False)
+        finally:
+            server_thread.join()
+            api.DEBUG = debug
+        with open(stats_file) as file:
+            stats = json.load(file)['server']
+        self.assertEqual((stats['resumed'], stats['early_data_rejected'], stats['streams_completed']), (1, 1, 6))
+        output_dir.cleanup()
+
+    def test_rejected_codec(self):
+        # The ticket's codec isn't offered by the server anymore - the compressed early data is dropped and the client
+        # sends the streams again from their first byte, uncompressed
+        debug, api.DEBUG = api.DEBUG, False
+        server_address = ("127.0.0.1", 9976)
+        output_dir = tempfile.TemporaryDirectory()
+        session_cache = handshake.SessionCache()
+        for codecs, early_data in ((None, None), ([], False)):
+            server_thread = threading.Thread(target=Server, args=(server_address, api.DEFAULT_BATCH_SIZE, 1, output_dir.name), kwargs={'codecs': codecs})
+            server_thread.start()
+            time.sleep(0.2)
+            try:
+                client, _ = self.transfer(server_address, session_cache, output_dir.name, "zlib")
+            finally:
+                server_thread.join()
+            self.assertIs(client.connection_stats['early_data'], early_data)
+        self.assertIsNone(client.codec)
+        self.assertEqual(client.streams_stats[1]['bytes_sent'], 100000)
+        api.DEBUG = debug
+        output_dir.cleanup()
+
+class TestServerWorkers(unittest.TestCase):
+    def transfer(self, port, kernel_steering):
+        # Two clients, one per worker by connection ID, send a file each at the same time
+        debug, api.DEBUG = api.DEBUG, False
+        server_address = ("127.0.0.1", port)
+        stats = []
+        output_dir = tempfile.TemporaryDirectory()
+        stats_file = os.path.join(output_dir.name, "stats.json")
+        server_thread = threading.Thread(target=lambda: stats.extend(server.run_workers(server_address, 2, timeout=2, kernel_steering=kernel_steering, stats_file=stats_file)))
+        server_thread.start()
+        time.sleep(0.5)
+        try:
+            files = data_generator.generate_num_of_files(2, 100000)
+            clients = [Client(server_address, cc="reno") for _ in files]
+            for connection_id, client in enumerate(clients):
+                client.server_connection_id = connection_id
+            threads = [threading.Thread(target=client.send_file, args=(file, 1)) for client, file in zip(clients, files)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            server_thread.join()
+            api.DEBUG = debug
+        self.assertEqual(len(stats), 2)
+        self.assertEqual(sum(worker_stats['streams_completed'] for worker_stats in stats), 2)
+        # Each connection went to its own worker
+        self.assertEqual(sorted(worker_stats['bytes_received'] >= 100000 for worker_stats in stats), [True, True])
+        # One stats file for all the workers
+        with open(stats_file) as file:
+            data = json.load(file)
+        output_dir.cleanup()
+        self.assertEqual(data['server']['streams_completed'], 2)
+        self.assertEqual(len(data['workers']), 2)
+        self.assertEqual(data['totals']['delivered'], 200000)
+        self.assertGreater(data['totals']['inter_arrival']['count'], 0)
+
+    def test_kernel_steering(self):
+        self.transfer(9963, True)
+
+    def test_dispatcher(self):
+        self.transfer(9964, False)
+
+    def test_connection_id_of(self):
+        long_packet = api.QuicPacket(0, 77, b"", 1, 0, api.END_STREAM).pack()
+        short_packet = api.QuicPacket(0, 2 ** 63 + 78, b"data", 1, 0, api.DATA).pack()
+        self.assertEqual(api.connection_id_of(long_packet), 77)
+        self.assertEqual(api.connection_id_of(short_packet), 2 ** 63 + 78)
+
+    def test_new_connection_id(self):
+        for worker_index in range(3):
+            connection_id = api.new_connection_id(worker_index, 3)
+            self.assertLess(connection_id, 2 ** 64)
+            self.assertEqual(api.steering_index(connection_id, 3), worker_index)
+
+
+class TestConnections(unittest.TestCase):
+    def test_same_stream_id(self):
+        # Two clients from the same machine both send stream 1, the server keeps them apart by connection ID
+        debug, api.DEBUG = api.DEBUG, False
+        server_address = ("127.0.0.1", 9965)
+        output_dir = tempfile.TemporaryDirectory()
+        servers = []
+        server_thread = threading.Thread(target=lambda: servers.append(Server(server_address, api.DEFAULT_BATCH_SIZE, 1, output_dir.name, idle_timeout=0.5)))
+        server_thread.start()
+        time.sleep(0.2)
+        try:
+            files = data_generator.generate_num_of_files(2, 50000)
+            clients = [Client(server_address, cc="reno") for _ in files]
+            threads = [threading.Thread(target=client.send_file, args=(file, 1)) for client, file in zip(clients, files)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for client in clients:
+                client.close()
+            # Never closed, the connection is evicted once idle
+            idle_client = Client(server_address, cc="reno")
+            idle_client.connect()
+            time.sleep(0.7)
+        finally:
+            server_thread.join()
+            api.DEBUG = debug
+        stats = servers[0].stats
+        self.assertEqual(stats['connections'], 3)
+        self.assertEqual(stats['connections_evicted'], 1)
+        self.assertEqual(stats['streams_completed'], 2)
+        for client, file in zip(clients, files):
+            with open(file, "rb") as sent, open(server.stream_path(output_dir.name, client.server_connection_id, 1), "rb") as received:
+                self.assertEqual(sent.read(), received.read())
+        output_dir.cleanup()
+
+
+class TestReassembly(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.output_dir.name, "received.txt")
+
+    def tearDown(self):
+        self.output_dir.cleanup()
+
+    def test_out_of_order(self):
+        chunks = [bytes([65 + i]) * 10 for i in range(8)]
+        stream = reassembly.StreamReassembler(self.path)
+        for i in [0, 2, 5, 1, 1, 3, 7]:
+            self.assertTrue(stream.on_data(i * 10, memoryview(chunks[i])))
+        stream.flush()
+        self.assertEqual(stream.duplicates, 1)
+        self.assertEqual(stream.next_pos, 40)
+        stream.on_end(80)
+        self.assertEqual(stream.gaps(), [(40, 50), (60, 70)])
+        stream.on_data(40, chunks[4])
+        stream.on_data(60, chunks[6])
+        stream.flush()
+        self.assertTrue(stream.closed)
+        with open(self.path, "rb") as file:
+            self.assertEqual(file.read(), b"".join(chunks))
+
+    def test_bounded_gap_buffer(self):
+        stream = reassembly.StreamReassembler(self.path, max_buffered_bytes=25)
+        self.assertTrue(stream.on_data(10, b"x" * 10))
+        self.assertTrue(stream.on_data(20, b"x" * 10))
+        # Full - refused, not kept in memory
+        self.assertFalse(stream.on_data(30, b"x" * 10))
+        self.assertEqual(stream.buffered_bytes, 20)
+        # In order data is always accepted and drains the buffer
+        self.assertTrue(stream.on_data(0, b"x" * 10))
+        self.assertEqual(stream.buffered_bytes, 0)
+        self.assertTrue(stream.on_data(30, b"x" * 10))
+
+    def test_discard(self):
+        stream = reassembly.StreamReassembler()
+        stream.on_data(0, b"abc")
+        stream.on_end(3)
+        stream.flush()
+        self.assertTrue(stream.closed)
+        self.assertEqual(stream.file_offset, 3)
+
+
+class TestDataGenerator(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.folders = data_generator.FILES_FOLDER, data_generator.CACHE_FOLDER
+        data_generator.FILES_FOLDER = self.folder.name
+        data_generator.CACHE_FOLDER = os.path.join(self.folder.name, ".cache")
+
+    def tearDown(self):
+        data_generator.FILES_FOLDER, data_generator.CACHE_FOLDER = self.folders
+        self.folder.cleanup()
+
+    def test_random_data(self):
+        data = data_generator.generate_random_data(100000, seed=7)
+        self.assertEqual(len(data), 100000)
+        self.assertTrue(set(data) <= set(data_generator.ALPHABET))
+        self.assertEqual(data, data_generator.generate_random_data(100000, seed=7))
+        self.assertNotEqual(data, data_generator.generate_random_data(100000, seed=8))
+        self.assertNotEqual(data_generator.generate_random_data(1000), data_generator.generate_random_data(1000))
+
+    def test_cached_files(self):
+        files = data_generator.generate_num_of_files(2, 50000, seed=3)
+        with open(files[0], "rb") as first, open(files[1], "rb") as second:
+            contents = first.read(), second.read()
+        self.assertEqual([len(content) for content in contents], [50000, 50000])
+        self.assertNotEqual(contents[0], contents[1])
+        cached = data_generator.cached_file_path(50000, 3, 0)
+        mtime = os.stat(cached).st_mtime_ns
+        # The second run reuses the cache and gets the same data
+        data_generator.remove_files()
+        files = data_generator.generate_num_of_files(2, 50000, seed=3)
+        self.assertEqual(os.stat(cached).st_mtime_ns, mtime)
+        with open(files[0], "rb") as first:
+            self.assertEqual(first.read(), contents[0])
+        # The next seed's first file isn't this run's second one
+        files = data_generator.generate_num_of_files(1, 50000, seed=4)
+        with open(files[0], "rb") as first:
+            self.assertNotEqual(first.read(), contents[1])
+        data_generator.remove_files(clear_cache=True)
+        self.assertFalse(os.path.exists(data_generator.FILES_FOLDER))
+
+    def test_file_size_at_call_time(self):
+        # FILE_SIZE used to be bound when the function was defined, so changing it did nothing
+        file_size, data_generator.FILE_SIZE = data_generator.FILE_SIZE, 1234
+        try:
+            files = data_generator.generate_num_of_files(1, seed=None)
+        finally:
+            data_generator.FILE_SIZE = file_size
+        self.assertEqual(os.path.getsize(files[0]), 1234)
+
 
 class TestClient(unittest.TestCase):
     def test_send_file(self):
-        client = Client(("127.0.0.1", 9997))
+        client = Client(("127.0.0.1", 9997), reliable=False)      # the mocked socket can't send ACKs back
         # generate a file
         data_generator.generate_num_of_files(1)     # ALSO TESTS data_generator.py
         client.socket = MagicMock()
@@ -83,7 +1487,7 @@ class TestClient(unittest.TestCase):
         self.assertTrue(client.socket.sendto.called)
 
     def test_thread_safety(self):
-        client = Client(("127.0.0.1", 9997))
+        client = Client(("127.0.0.1", 9997), reliable=False)      # the mocked socket can't send ACKs back
         data_generator.generate_num_of_files(2)         # ALSO TESTS data_generator.py
         client.socket = MagicMock()
         files = ["data_files/file_1.txt", "data_files/file_2.txt"]
@@ -99,8 +1503,36 @@ class TestClient(unittest.TestCase):
         # make sure the number of threads is equal to the number of files
         self.assertEqual(len(threads), len(files))
 
+    def test_send_files_interleaved(self):
+        client = Client(("127.0.0.1", 9997), reliable=False)      # the mocked socket can't send ACKs back
+        files = data_generator.generate_num_of_files(2, 100000)
+        client.socket = MagicMock()
+        sent = []
+        # The send queue reuses its buffer, keep a copy of every datagram
+        client.socket.sendto.side_effect = lambda data, address: sent.append(bytes(data))
+        client.send_files([(1, files[0]), (2, files[1])])
+        # One sender, both streams complete
+        for stream_id in (1, 2):
+            self.assertEqual(client.streams_stats[stream_id]['bytes_sent'], 100000)
+            self.assertIsNotNone(client.streams_stats[stream_id]['end_time'])
+        packet = api.QuicPacket(0, 0, b"", 0, 0)
+        stream_ids = []
+        for datagram in sent:
+            packet.unpack(datagram)
+            stream_ids.extend(frame.stream_id for frame in frames.iter_frames(packet))
+        # Both streams were in flight at the same time
+        self.assertLess(stream_ids.index(2), len(stream_ids) - stream_ids[::-1].index(1) - 1)
+
+    def test_send_empty_file(self):
+        client = Client(("127.0.0.1", 9997), reliable=False)      # the mocked socket can't send ACKs back
+        files = data_generator.generate_num_of_files(1, 0)
+        client.socket = MagicMock()
+        client.send_file(files[0], 1)
+        self.assertEqual(client.streams_stats[1]['bytes_sent'], 0)
+        self.assertEqual(client.socket.sendto.call_count, 2)       # Only the handshake and the empty FIN frame
+
     def test_send_file_not_found(self):
-        client = Client(("127.0.0.1", 9997))
+        client = Client(("127.0.0.1", 9997), reliable=False)      # the mocked socket can't send ACKs back
         client.socket = MagicMock()
         with self.assertRaises(FileNotFoundError):
             client.send_file("non_existent_file.txt", 1)
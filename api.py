@@ -1,15 +1,26 @@
 import time     
 import socket       
+import select
 import threading    # For handling multiple streams
 import struct       # For packing and unpacking data
+import os
+import sys
+import errno
+import ctypes       # For recvmmsg / sendmmsg, which the socket module doesn't expose
+import ctypes.util
+import logging
 
 
-DEBUG = True
+DEBUG = False       # Packet events (every packet sent / received) are logged or traced, set by tracing.configure
 
 # Default values
 BUFFER_SIZE = 65536                     # The buffer size is the maximum amount of data that can be received at once
 DEFAULT_SERVER_HOST = "127.0.0.1"       # The default host for the server
 DEFAULT_SERVER_PORT = 9997              # The default port for the server
+DEFAULT_BATCH_SIZE = 32                 # The default number of datagrams moved per batched syscall
+SEND_BUFFER_SIZE = 256 * 1024           # The size of a send queue's buffer, packets wait there back to back until flushed
+MAX_UDP_PAYLOAD = 65507                 # The largest datagram UDP over IPv4 can carry
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024    # The kernel socket buffer size we ask for (the kernel may cap it)
 
 # Constants
 # Header types
@@ -23,6 +34,18 @@ END_STREAM = 3
 DATA = 4
 ACK = 5
 END_CONNECTION = 6
+# Flow control (flowcontrol.py) - the limit is carried in the offset field, there is no payload
+MAX_DATA = 7                # Receiver: the connection may send up to this many bytes over all streams
+MAX_STREAM_DATA = 8         # Receiver: the stream may send up to this offset
+DATA_BLOCKED = 9            # Sender: blocked by the connection limit, answered with the current MAX_DATA
+STREAM_DATA_BLOCKED = 10    # Sender: the stream is blocked by its limit, answered with the current MAX_STREAM_DATA
+# Path MTU discovery (pmtud.py) - the probe's size is carried in the offset field, its payload is padding
+PMTU_PROBE = 11             # Sender: a padded probe, answered with PMTU_PROBE_ACK if it got through
+PMTU_PROBE_ACK = 12         # Receiver: the probe of this size arrived
+# Frame layer (frames.py) - the payload is several frames (stream data, ACKs, credit...) coalesced into one datagram
+FRAMES = 13
+# Forward error correction (fec.py) - the group number in the stream ID field, its datagram count in the offset field
+FEC_PARITY = 14             # Sender: XOR of the payloads of the group's FRAMES datagrams
 
 
 
@@ -30,159 +53,794 @@ END_CONNECTION = 6
 # =============================== QUIC API ===============================
 # ========================================================================
 
+# region Logging
+
+'''
+Packet events go to the "quic.packets" logger at DEBUG level and, if a binary trace is on, to its ring buffer (tracing.py)
+The hot path only checks DEBUG, everything else happens in log_packet - a packet is formatted only if a handler emits the record
+(the logging module formats lazily), and with PACKET_LOG_SAMPLE = N only 1 of every N packet events is logged (all are traced)
+'''
+logger = logging.getLogger("quic")
+packet_logger = logging.getLogger("quic.packets")
+
+# Packet events
+PACKET_SENT = 1
+PACKET_RECEIVED = 2
+PACKET_LOST = 3
+PACKET_EVENT_NAMES = {PACKET_SENT: "Sent", PACKET_RECEIVED: "Received", PACKET_LOST: "Lost"}
+
+TRACE = None                # tracing.Trace the packet events are recorded to, None - not traced
+PACKET_LOG_SAMPLE = 1       # Log 1 of every N packet events
+_packet_events = 0
+
+
+def log_packet(event, packet, address):
+    # Only called when DEBUG is set
+    global _packet_events
+    if TRACE is not None:
+        TRACE.record(event, packet)
+    _packet_events += 1
+    if _packet_events % PACKET_LOG_SAMPLE == 0 and packet_logger.isEnabledFor(logging.DEBUG):
+        packet_logger.debug("%s %s:%s - %s", PACKET_EVENT_NAMES[event], address[0], address[1], packet)
+# endregion
+
 # region QUIC Packet
 
+'''
+Packing and unpacking:
+!: represents network byte order (big-endian)
+B: unsigned char (1 byte - 8 bits)
+H: unsigned short (usually 2 bytes - 16 bits)
+I: unsigned int (usually 4 bytes - 32 bits)
+Q: unsigned long long (8 bytes - 64 bits)
+
+We do this because that our way to control the sizing of the fields in the packet in python, to minimize overhead.
+The formats are compiled once (struct.Struct) so the hot path doesn't parse the format string for every packet.
+The Version-Specific Bits byte (RFC 8999 leaves it to the version) carries the packet type, so the receiver never has to look at the payload to classify a packet.
+The stream ID, the offset in the stream (in bytes) and the payload length follow the fixed part as variable-length integers (RFC 9000 Section 16),
+so small values take 1-2 bytes and a stream can be up to 2^62-1 bytes long.
+'''
+# header form, packet type, version, dest id length, dest id, source id length, source id - then stream id, offset, payload length (varints)
+LONG_HEADER_FORMAT = struct.Struct('!BBIBQBQ')
+# header form, packet type, dest id - then stream id, offset, payload length (varints)
+SHORT_HEADER_FORMAT = struct.Struct('!BBQ')
+LONG_HEADER_SIZE = LONG_HEADER_FORMAT.size      # 24 bytes, fixed part only
+SHORT_HEADER_SIZE = SHORT_HEADER_FORMAT.size    # 10 bytes, fixed part only
+CONNECTION_ID_LENGTH = 8                        # Connection IDs are random 64 bit numbers
+
+# Variable-length integers: the 2 high bits of the first byte give the length (1, 2, 4 or 8 bytes), the rest is the value
+VARINT_MAX = (1 << 62) - 1
+MAX_VARINT_SIZE = 8
+MAX_LONG_HEADER_SIZE = LONG_HEADER_SIZE + 3 * MAX_VARINT_SIZE      # Worst case header, for sizing buffers and windows
+MAX_SHORT_HEADER_SIZE = SHORT_HEADER_SIZE + 3 * MAX_VARINT_SIZE
+_VARINT_2 = struct.Struct('!H')
+_VARINT_4 = struct.Struct('!I')
+_VARINT_8 = struct.Struct('!Q')
+
+
+def varint_size(value):
+    if value < 0x40:
+        return 1
+    if value < 0x4000:
+        return 2
+    if value < 0x40000000:
+        return 4
+    if value <= VARINT_MAX:
+        return 8
+    raise ValueError(f"{value} is too big for a variable-length integer")
+
+
+def pack_varint_into(buffer, offset, value):
+    # Writes value at offset, returns the offset after it
+    if value < 0x40:
+        buffer[offset] = value
+        return offset + 1
+    if value < 0x4000:
+        _VARINT_2.pack_into(buffer, offset, value | 0x4000)
+        return offset + 2
+    if value < 0x40000000:
+        _VARINT_4.pack_into(buffer, offset, value | 0x80000000)
+        return offset + 4
+    if value <= VARINT_MAX:
+        _VARINT_8.pack_into(buffer, offset, value | 0xC000000000000000)
+        return offset + 8
+    raise ValueError(f"{value} is too big for a variable-length integer")
+
+
+def encode_varint(value):
+    buffer = bytearray(varint_size(value))
+    pack_varint_into(buffer, 0, value)
+    return bytes(buffer)
+
+
+def decode_varint(data, offset=0):
+    # Returns (value, offset after it), raises ValueError if data ends in the middle of it
+    try:
+        first = data[offset]
+    except IndexError:
+        raise ValueError("Truncated variable-length integer") from None
+    prefix = first >> 6
+    if prefix == 0:
+        return first, offset + 1
+    end = offset + (1 << prefix)
+    if end > len(data):
+        raise ValueError("Truncated variable-length integer")
+    if prefix == 1:
+        return _VARINT_2.unpack_from(data, offset)[0] & 0x3FFF, end
+    if prefix == 2:
+        return _VARINT_4.unpack_from(data, offset)[0] & 0x3FFFFFFF, end
+    return _VARINT_8.unpack_from(data, offset)[0] & VARINT_MAX, end
+
+
+# Control packets use the long header, data and acks use the short header
+HEADER_FORMS = {
+    HANDSHAKE: LONG_HEADER,
+    START_STREAM: LONG_HEADER,
+    END_STREAM: LONG_HEADER,
+    END_CONNECTION: LONG_HEADER,
+    ACK: SHORT_HEADER,
+    DATA: SHORT_HEADER,
+    MAX_DATA: SHORT_HEADER,
+    MAX_STREAM_DATA: SHORT_HEADER,
+    DATA_BLOCKED: SHORT_HEADER,
+    STREAM_DATA_BLOCKED: SHORT_HEADER,
+    PMTU_PROBE: SHORT_HEADER,
+    PMTU_PROBE_ACK: SHORT_HEADER,
+    FRAMES: SHORT_HEADER,
+    FEC_PARITY: SHORT_HEADER,
+}
+
+# Payloads the old text protocol used to mark control packets, only used when a packet is created from a str without an explicit type
+LEGACY_MARKERS = {
+    "handshake": HANDSHAKE,
+    "end": END_CONNECTION,
+    "end_stream": END_STREAM,
+}
+
+# ACK payload: ranges of received bytes in the stream, each as start offset and length (varints)
+# END_STREAM takes one unit right after the last byte, so the end of the stream is acknowledged like data (as FIN in TCP)
+MAX_ACK_RANGES = 64                     # Max number of ranges per ACK, the most recent ones are sent
+
+
+def pack_ack_ranges(ranges):
+    # ranges are half open (start, end) pairs
+    payload = bytearray(2 * MAX_VARINT_SIZE * len(ranges))
+    offset = 0
+    for start, end in ranges:
+        offset = pack_varint_into(payload, offset, start)
+        offset = pack_varint_into(payload, offset, end - start)
+    del payload[offset:]
+    return payload
+
+
+def unpack_ack_ranges(payload):
+    # Back to half open (start, end) pairs
+    ranges = []
+    offset = 0
+    while offset < len(payload):
+        start, offset = decode_varint(payload, offset)
+        length, offset = decode_varint(payload, offset)
+        ranges.append((start, start + length))
+    return ranges
+
+
+def ack_space_length(packet):
+    # How much of the stream's ACK space the packet covers - its payload, or one unit for END_STREAM
+    return 1 if packet.packet_type == END_STREAM else packet.payload_length
+
+
+def legacy_packet_type(text):
+    # Classify a text payload the way the old protocol did
+    if text in LEGACY_MARKERS:
+        return LEGACY_MARKERS[text]
+    if text[:3] == "ACK":
+        return ACK
+    return DATA
+
 
 class QuicPacket:
-    def __init__(self, source_id, destination_id, payload, stream_id, pos_in_stream):
-        # Long Header as suggested in RFC 8999 Section 5.1
-        self.version_specific_bits = 0           # not used - Version-Specific Bits (7 bits)
-        self.version = 0                         # not used - Version (32 bits)
-        self.destination_connection_id_length = 1  # not used - Destination Connection ID Length (8 bits)
-        self.destination_connection_id = destination_id      # Destination Connection ID (0..2040 bits, we set it to 1 bit to allow only 2 connection IDs)
-        self.source_connection_id_length = 1      # not used - Source Connection ID Length (8 bits)
-        self.source_connection_id = source_id           # Source Connection ID (0..2040 bits, we set it to 1 bit to allow only 2 connection IDs)
-        # self.version_specific_data = 0          # not used - Version-Specific Data (..)
-        self.stream_id = stream_id
-        self.pos_in_stream = pos_in_stream
-        self.payload_length = len(payload)       # used instead of above comment, Payload Length (0..2^16-1, 16 bits)
-        self.payload = payload                   # Payload (0..2^16-1)
-        if not isinstance(payload, bytes):
-            self.non_binary_payload = payload
-        else:
-            self.non_binary_payload = self.payload.decode("utf-8")
-        self.__set_packet_type()
-
-    # def __init__(self):
-    #     self.packet_type = 0
-    #     self.header_form = 0
-    #     self.version_specific_bits = 0
-    #     self.version = 0
-    #     self.destination_connection_id_length = 0
-    #     self.destination_connection_id = 0
-    #     self.source_connection_id_length = 0
-    #     self.source_connection_id = 0
-    #     self.version_specific_data = 0
-    #     self.stream_id = 0
-    #     self.pos_in_stream = 0
-    #     self.payload_length = 0
-    #     self.payload = ""
-
-    def __set_packet_type(self):
-        # Check if payload is a handshake, end connection or data packet
-        
-        if self.non_binary_payload == "handshake":
-            self.packet_type = HANDSHAKE
-            self.header_form = LONG_HEADER                     # Header Form, long for handshake
-        elif self.non_binary_payload == "end":
-            self.packet_type = END_CONNECTION
-            self.header_form = LONG_HEADER                     # Header Form, long for end connection
-        elif self.non_binary_payload == "end_stream":
-            self.packet_type = END_STREAM
-            self.header_form = LONG_HEADER                     # Header Form, long for end stream
-        elif self.non_binary_payload[:3] == "ACK":
-            self.packet_type = ACK
-            self.header_form = SHORT_HEADER                    # Header Form, short for ack packet
-        else:
-            self.packet_type = DATA
-            self.header_form = SHORT_HEADER                    # Header Form, short for data packet
-    
+    # Slots instead of a per-instance __dict__, the receive loop creates (or reuses) one of these for every datagram
+    __slots__ = ('packet_type', 'header_form', 'destination_connection_id', 'source_connection_id', 'stream_id', 'pos_in_stream', 'payload', 'payload_length', 'buffer', 'frames', 'segments')
+
+    # Long Header as suggested in RFC 8999 Section 5.1 - fields that never change are shared by all packets
+    version = 0                              # not used - Version (32 bits)
+    destination_connection_id_length = CONNECTION_ID_LENGTH     # not used - Destination Connection ID Length (8 bits)
+    source_connection_id_length = CONNECTION_ID_LENGTH          # not used - Source Connection ID Length (8 bits)
+    # version_specific_data = 0              # not used - Version-Specific Data (..)
+
+    def __init__(self, source_id, destination_id, payload, stream_id, pos_in_stream, packet_type=None):
+        self.destination_connection_id = destination_id      # Destination Connection ID (0..2040 bits, we use 64 bits)
+        self.source_connection_id = source_id           # Source Connection ID (0..2040 bits, we use 64 bits, only in the long header)
+        self.buffer = None                       # Receive buffer owned by the packet, only set for pooled packets (see PacketPool)
+        self.frames = None                       # Stream frames coalesced into a sent FRAMES packet, for the loss detector
+        self.segments = None                     # A sent FRAMES packet's payload as scatter-gather buffers, see set_segments
+        self.stream_id = stream_id                  # Stream ID (varint, 0..2^62-1)
+        self.pos_in_stream = pos_in_stream          # Offset of the payload in the stream in bytes (varint), for END_STREAM the stream's size
+        if isinstance(payload, str):
+            # Text is encoded once here, on the wire the payload is always binary
+            if packet_type is None:
+                packet_type = legacy_packet_type(payload)
+            payload = payload.encode("utf-8")
+        self.payload = payload                   # Payload, bytes / bytearray / memoryview - never decoded
+        self.payload_length = len(payload)       # Payload Length (varint)
+        self.set_packet_type(DATA if packet_type is None else packet_type)
+
+    def set_packet_type(self, packet_type):
+        # The packet type decides the header form (Version-Specific Bits carry the type itself)
+        self.packet_type = packet_type
+        self.header_form = HEADER_FORMS[packet_type]
+
+    def set_segments(self, segments, length):
+        # The payload as a list of buffers (frame headers, views of the stream data) that are never joined on the way out:
+        # with GSO they go to sendmsg as they are, otherwise they are copied once into the send buffer like any payload
+        # payload is None then, joined_payload() builds it for whatever needs it in one piece (FEC, traces, printing)
+        self.segments = segments
+        self.payload = None
+        self.payload_length = length
+
+    def joined_payload(self):
+        if self.segments is None:
+            return self.payload
+        return b"".join(self.segments)
+
+    @property
+    def non_binary_payload(self):
+        # Decoded copy of the payload, for printing and text payloads only - never used on the hot path
+        return bytes(self.joined_payload()).decode("utf-8", errors="replace")
+
     def __str__(self):
-        return f"Packet Type: {self.__packet_type_str()}, Header Form: {self.__header_form_str()}, Destination Connection ID: {self.destination_connection_id}, Source Connection ID: {self.source_connection_id}, Stream ID: {self.stream_id}, Position in Stream: {self.pos_in_stream}, Payload Length: {self.payload_length}, Payload: {self.payload[:5]} ... {self.payload[-5:]}"
-    
+        return f"Packet Type: {self.__packet_type_str()}, Header Form: {self.__header_form_str()}, Destination Connection ID: {self.destination_connection_id}, Source Connection ID: {self.source_connection_id}, Stream ID: {self.stream_id}, Offset in Stream: {self.pos_in_stream}, Payload Length: {self.payload_length}, Payload: {bytes(self.joined_payload()[:5])} ... {bytes(self.joined_payload()[-5:])}"
+
+    def size(self):
+        # Number of bytes the packet takes on the wire
+        size = varint_size(self.stream_id) + varint_size(self.pos_in_stream) + varint_size(self.payload_length) + self.payload_length
+        if self.header_form == LONG_HEADER:
+            return LONG_HEADER_SIZE + size
+        return SHORT_HEADER_SIZE + size
+
     def sendto(self, sock, address):
         # Pack the packet and send it to the address
         packed_packet = self.pack()
         sock.sendto(packed_packet, address)
         if DEBUG:
-            print(f"Stream {self.stream_id} - Packet #{self.pos_in_stream} sent to {address}: {self}")
+            log_packet(PACKET_SENT, self, address)
 
     def recvfrom(self, sock):
         # Receive the packet and unpack it
         data, address = sock.recvfrom(BUFFER_SIZE)
         self.unpack(data)
         if DEBUG:
-            print(f"Received {self.__packet_type_str()} packet from {address}: {self}")
+            log_packet(PACKET_RECEIVED, self, address)
         return address
-    
-    '''
-    Packing and unpacking:
-    !: represents network byte order (big-endian)
-    B: unsigned char (1 byte - 8 bits)
-    H: unsigned short (usually 2 bytes - 16 bits)
-    I: unsigned int (usually 4 bytes - 32 bits)
-
-    We do this because that our way to control the sizing of the fields in the packet in python, to minimize overhead
-    '''
+
     def pack(self):
-        # Checks header form to determine if it is a long header or a short header
+        # Pack into a fresh buffer, prefer pack_into with a reused buffer on the hot path
+        buffer = bytearray(self.size())
+        self.pack_into(buffer)
+        return buffer
+
+    def pack_into(self, buffer, offset=0):
+        # Write the packet into a caller supplied bytearray / writable memoryview, returns the number of bytes written
+        # The payload is copied exactly once, straight from its source into the buffer
+        start = offset + self.pack_header_into(buffer, offset)
+        if self.segments is None:
+            end = start + self.payload_length
+            buffer[start:end] = self.payload
+            return end - offset
+        for segment in self.segments:
+            end = start + len(segment)
+            buffer[start:end] = segment
+            start = end
+        return start - offset
+
+    def pack_header_into(self, buffer, offset=0):
+        # Write only the header, returns its size - for scatter-gather sends, where the payload goes out from its own buffer
         if self.header_form == LONG_HEADER:
-            return self.__pack_long()
+            LONG_HEADER_FORMAT.pack_into(buffer, offset, LONG_HEADER, self.packet_type, self.version, self.destination_connection_id_length, self.destination_connection_id, self.source_connection_id_length, self.source_connection_id)
+            start = offset + LONG_HEADER_SIZE
         else:
-            return self.__pack_short()
-    
+            SHORT_HEADER_FORMAT.pack_into(buffer, offset, SHORT_HEADER, self.packet_type, self.destination_connection_id)
+            start = offset + SHORT_HEADER_SIZE
+        start = pack_varint_into(buffer, start, self.stream_id)
+        start = pack_varint_into(buffer, start, self.pos_in_stream)
+        return pack_varint_into(buffer, start, self.payload_length) - offset
+
     def unpack(self, data):
-        # Checks header form to determine if it is a long header or a short header
-        if data[0] == LONG_HEADER:
-            self.__unpack_long(data)
+        # Parse a datagram, the payload becomes a memoryview into data (no copy, no decode)
+        # The view is only valid as long as data isn't reused, copy it (bytes(packet.payload)) to keep it
+        view = data if isinstance(data, memoryview) else memoryview(data)
+        if view[0] == LONG_HEADER:
+            # version and the id lengths are constants in our implementation, they are skipped
+            self.header_form, self.packet_type, _, _, self.destination_connection_id, _, self.source_connection_id = LONG_HEADER_FORMAT.unpack_from(view)
+            start = LONG_HEADER_SIZE
         else:
-            self.__unpack_short(data)
-        if not isinstance(self.payload, bytes):
-            self.non_binary_payload = self.payload
-        else:
-            self.non_binary_payload = self.payload.decode("utf-8")
-        self.__set_packet_type()
+            self.header_form, self.packet_type, self.destination_connection_id = SHORT_HEADER_FORMAT.unpack_from(view)
+            start = SHORT_HEADER_SIZE
+        self.stream_id, start = decode_varint(view, start)
+        self.pos_in_stream, start = decode_varint(view, start)
+        self.payload_length, start = decode_varint(view, start)
+        end = start + self.payload_length
+        if end > len(view):
+            raise ValueError(f"Truncated packet: header says {self.payload_length} payload bytes, got {len(view) - start}")
+        self.payload = view[start:end]
+        return self.payload
 
     ################################## Private helpers ##################################
     def __packet_type_str(self):
         if self.packet_type == HANDSHAKE:
             return "Handshake"
+        elif self.packet_type == START_STREAM:
+            return "Start Stream"
         elif self.packet_type == END_CONNECTION:
             return "End Connection"
         elif self.packet_type == END_STREAM:
             return "End Stream"
         elif self.packet_type == ACK:
             return "Ack"
+        elif self.packet_type == MAX_DATA:
+            return "Max Data"
+        elif self.packet_type == MAX_STREAM_DATA:
+            return "Max Stream Data"
+        elif self.packet_type == DATA_BLOCKED:
+            return "Data Blocked"
+        elif self.packet_type == STREAM_DATA_BLOCKED:
+            return "Stream Data Blocked"
+        elif self.packet_type == PMTU_PROBE:
+            return "PMTU Probe"
+        elif self.packet_type == PMTU_PROBE_ACK:
+            return "PMTU Probe Ack"
+        elif self.packet_type == FRAMES:
+            return "Frames"
+        elif self.packet_type == FEC_PARITY:
+            return "FEC Parity"
         else:
             return "Data"
-    
+
     def __header_form_str(self):
         if self.header_form == LONG_HEADER:
             return "Long Header"
         else:
             return "Short Header"
-        
-    def __pack_long(self):
-        self.header_form = LONG_HEADER      # make sure
-        # Packs all the data into a byte stream
-        return struct.pack('!BBIBBBBBHH', self.header_form, self.version_specific_bits, self.version, self.destination_connection_id_length, self.destination_connection_id, self.source_connection_id_length, self.source_connection_id, self.stream_id, self.pos_in_stream, self.payload_length) + self.non_binary_payload.encode("utf-8")
-    
-    def __unpack_long(self, data):
-        # Unpacks the byte stream into the object
-        self.header_form, self.version_specific_bits, self.version, self.destination_connection_id_length, self.destination_connection_id, self.source_connection_id_length, self.source_connection_id, self.stream_id, self.pos_in_stream, self.payload_length = struct.unpack('!BBIBBBBBHH', data[:15])
-
-        self.payload = data[15:]
-        self.head_form = LONG_HEADER
-        
-    def __pack_short(self):
-        self.header_form = SHORT_HEADER    # make sure
-        # Packs only header_form, version_specific_bits, destination_connection_id, version_specific_data and payload
-        return struct.pack('!BBBBHH', self.header_form, self.version_specific_bits, self.destination_connection_id, self.stream_id, self.pos_in_stream, self.payload_length) + self.non_binary_payload.encode("utf-8")
-    
-    def __unpack_short(self, data):
-        # Unpacks the byte stream into the object
-        self.header_form, self.version_specific_bits, self.destination_connection_id, self.stream_id, self.pos_in_stream, self.payload_length, = struct.unpack('!BBBBHH', data[:8])
-        self.payload = data[8:]
-        self.header_form = SHORT_HEADER
 # endregion
 
-def recv_packet(sock):
-    # Receive the packet
-    data, address = sock.recvfrom(BUFFER_SIZE)
+
+class PacketPool:
+    # Free list of packets, each with its own preallocated receive buffer
+    # Lets the receive loop reuse packet objects and buffers instead of allocating for every datagram
+    def __init__(self, max_size=64, buffer_size=BUFFER_SIZE):
+        self.max_size = max_size            # Max number of free packets kept around, extra released packets are dropped
+        self.buffer_size = buffer_size
+        self.free = []
+        self.allocated = 0                  # Number of packets the pool ever had to create
+
+    def acquire(self):
+        if self.free:
+            return self.free.pop()
+        packet = QuicPacket(0, 0, b"", 0, 0)
+        packet.buffer = memoryview(bytearray(self.buffer_size))
+        self.allocated += 1
+        return packet
+
+    def release(self, packet):
+        # The packet's payload view points into its buffer, drop it so nothing keeps using stale data
+        packet.payload = b""
+        if len(self.free) < self.max_size:
+            self.free.append(packet)
+
+
+def recv_packet(sock, pool=None):
+    if pool is None:
+        # Receive the packet
+        data, address = sock.recvfrom(BUFFER_SIZE)
+        packet = QuicPacket(0, 0, b"", 0, 0)
+    else:
+        # Receive straight into a pooled buffer, the caller gives the packet back with pool.release(packet)
+        packet = pool.acquire()
+        nbytes, address = sock.recvfrom_into(packet.buffer)
+        data = packet.buffer[:nbytes]
     # Unpack the packet
-    packet = QuicPacket(0, 0, "", 0, 0)
     packet.unpack(data)
     if DEBUG:
-        print(f"Received packet from {address}: {packet}")
+        log_packet(PACKET_RECEIVED, packet, address)
     return packet, address
-    
+
+
+# ========================================================================
+# ============================ Batched syscalls ==========================
+# ========================================================================
+
+# region Batched receive
+
+# C structures used by recvmmsg(2) / sendmmsg(2), ctypes takes care of the padding
+class _IoVec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(_IoVec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+SOCKADDR_SIZE = 128                     # sizeof(struct sockaddr_storage)
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+
+def _load_libc_function(name):
+    # Returns the libc function if this platform has it, None otherwise (the callers fall back to plain loops)
+    # The structures above use the Linux layout, so other platforms always take the fallback
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        return getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+
+
+_recvmmsg = _load_libc_function("recvmmsg")
+_sendmmsg = _load_libc_function("sendmmsg")
+
+
+def _parse_sockaddr(raw):
+    # sockaddr_in / sockaddr_in6 into the (host, port) tuple the socket module uses (Linux layout, family in host byte order)
+    family = int.from_bytes(raw[0:2], sys.byteorder)
+    port = int.from_bytes(raw[2:4], "big")
+    if family == socket.AF_INET6:
+        return socket.inet_ntop(socket.AF_INET6, bytes(raw[8:24])), port
+    return socket.inet_ntop(socket.AF_INET, bytes(raw[4:8])), port
+
+
+def _build_sockaddr(family, address):
+    # The (host, port) tuple as a raw sockaddr_in / sockaddr_in6, the opposite of _parse_sockaddr
+    host, port = socket.getaddrinfo(address[0], address[1], family, socket.SOCK_DGRAM)[0][4][:2]
+    if family == socket.AF_INET6:
+        return family.to_bytes(2, sys.byteorder) + port.to_bytes(2, "big") + bytes(4) + socket.inet_pton(family, host) + bytes(4)
+    return family.to_bytes(2, sys.byteorder) + port.to_bytes(2, "big") + socket.inet_pton(family, host) + bytes(8)
+
+
+class BatchReceiver:
+    # Receives up to batch_size datagrams per syscall into a ring of preallocated buffers
+    # Uses recvmmsg through ctypes where available, and a recvfrom_into loop otherwise
+    # The returned packets (and their payload views) are reused by the next recv_batch call
+    def __init__(self, sock, batch_size=DEFAULT_BATCH_SIZE, buffer_size=BUFFER_SIZE, use_recvmmsg=True):
+        self.sock = sock
+        self.batch_size = batch_size
+        self.dropped = 0                    # Malformed datagrams that were skipped
+        pool = PacketPool(batch_size, buffer_size)
+        self.packets = [pool.acquire() for _ in range(batch_size)]
+        self.use_recvmmsg = use_recvmmsg and _recvmmsg is not None and MSG_DONTWAIT != 0
+        if self.use_recvmmsg:
+            self.__init_mmsghdrs(buffer_size)
+
+    def recv_batch(self, timeout=None):
+        # Blocks until at least one datagram arrives, returns a list of (packet, address)
+        # Waits up to timeout seconds (0 - just poll), or the socket's own timeout if not given, then raises socket.timeout
+        if timeout is None:
+            timeout = self.sock.gettimeout()
+        if self.use_recvmmsg:
+            received = self.__recv_mmsg(timeout)
+        else:
+            received = self.__recv_loop(timeout)
+        batch = []
+        for packet, nbytes, address in received:
+            try:
+                packet.unpack(packet.buffer[:nbytes])
+            except (ValueError, IndexError, struct.error):
+                self.dropped += 1
+                continue
+            if DEBUG:
+                log_packet(PACKET_RECEIVED, packet, address)
+            batch.append((packet, address))
+        return batch
+
+    def __iter__(self):
+        # Yields (packet, address) forever, socket.timeout ends the iteration with an exception like recv_packet
+        while True:
+            yield from self.recv_batch()
+
+    ################################## Private helpers ##################################
+    def __init_mmsghdrs(self, buffer_size):
+        self.iovecs = (_IoVec * self.batch_size)()
+        self.names = (ctypes.c_char * (SOCKADDR_SIZE * self.batch_size))()
+        self.mmsghdrs = (_MMsgHdr * self.batch_size)()
+        self.c_buffers = []                 # Keeps the ctypes views of the buffers alive
+        for i, packet in enumerate(self.packets):
+            c_buffer = (ctypes.c_char * buffer_size).from_buffer(packet.buffer.obj)
+            self.c_buffers.append(c_buffer)
+            self.iovecs[i].iov_base = ctypes.addressof(c_buffer)
+            self.iovecs[i].iov_len = buffer_size
+            header = self.mmsghdrs[i].msg_hdr
+            header.msg_name = ctypes.addressof(self.names) + i * SOCKADDR_SIZE
+            header.msg_iov = ctypes.pointer(self.iovecs[i])
+            header.msg_iovlen = 1
+        self.names_view = memoryview(self.names).cast("B")
+
+    def __wait_readable(self, timeout):
+        # The sockets are read non-blocking, so the timeout is applied here
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        if not readable:
+            raise socket.timeout("timed out")
+
+    def __recv_mmsg(self, timeout):
+        while True:
+            self.__wait_readable(timeout)
+            for i in range(self.batch_size):
+                self.mmsghdrs[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+            count = _recvmmsg(self.sock.fileno(), self.mmsghdrs, self.batch_size, MSG_DONTWAIT, None)
+            if count >= 0:
+                break
+            err = ctypes.get_errno()
+            if err not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                raise OSError(err, os.strerror(err))
+        received = []
+        for i in range(count):
+            name = self.names_view[i * SOCKADDR_SIZE:i * SOCKADDR_SIZE + self.mmsghdrs[i].msg_hdr.msg_namelen]
+            received.append((self.packets[i], self.mmsghdrs[i].msg_len, _parse_sockaddr(name)))
+        return received
+
+    def __recv_loop(self, timeout):
+        # Waits for the first datagram, the rest are taken only if they are already waiting
+        self.__wait_readable(timeout)
+        received = []
+        socket_timeout = self.sock.gettimeout()
+        self.sock.setblocking(False)
+        try:
+            for packet in self.packets:
+                try:
+                    nbytes, address = self.sock.recvfrom_into(packet.buffer)
+                except (BlockingIOError, InterruptedError):
+                    break
+                received.append((packet, nbytes, address))
+        finally:
+            self.sock.settimeout(socket_timeout)
+        return received
+# endregion
+
+# region Batched send
+
+# UDP Generic Segmentation Offload (Linux >= 4.18): one sendmsg carries many equally sized datagrams, the kernel splits them
+SOL_UDP = getattr(socket, "SOL_UDP", 17)
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+GSO_MAX_SEGMENTS = 64                   # UDP_MAX_SEGMENTS in the kernel
+IOV_MAX = 1024                          # Buffers one sendmsg takes
+
+
+def gso_supported(sock):
+    # The kernel knows the option only if it can segment UDP
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        sock.getsockopt(SOL_UDP, UDP_SEGMENT)
+        return True
+    except OSError:
+        return False
+
+
+class SendQueue:
+    # Coalesces packets to one address into batched sends, flush() sends them with:
+    #   - sendmsg + UDP_SEGMENT (GSO), one syscall per run of equally sized packets, where the kernel supports it
+    #   - sendmmsg through ctypes, one syscall per batch, otherwise
+    #   - a plain sendto loop as the last fallback (non Linux, or anything that isn't a real socket)
+    # With GSO only the headers are packed into the preallocated buffer, the payloads are not copied at all:
+    # sendmsg gets a scatter-gather list of header and payload views (the payload may be a view of an mmapped file, or the
+    # segments of a FRAMES packet - its frame headers and the views of its stream data)
+    # Otherwise whole packets are packed back to back into the buffer
+    # Datagrams are sent atomically, so several queues (one per thread) can share a socket without a lock
+    def __init__(self, sock, address, batch_size=DEFAULT_BATCH_SIZE, buffer_size=SEND_BUFFER_SIZE, use_sendmmsg=True, use_gso=True):
+        self.sock = sock
+        self.address = address
+        self.batch_size = batch_size        # Max number of packets per flush
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.lengths = []                   # Sizes of the queued packets, in order
+        self.used = 0                       # Bytes of the buffer taken by queued packets (or headers)
+        self.packets_sent = 0
+        self.syscalls = 0                   # Number of send syscalls, packets_sent / syscalls is the coalescing factor
+        real_socket = isinstance(sock, socket.socket)
+        self.use_gso = use_gso and real_socket and gso_supported(sock)
+        self.use_sendmmsg = use_sendmmsg and real_socket and _sendmmsg is not None
+        if self.use_sendmmsg:
+            self.__init_mmsghdrs()
+        self.headers = []                   # (offset, size) of the queued headers in the buffer, GSO only
+        self.payloads = []                  # Payload buffers of every queued packet (a list each), GSO only
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def append(self, packet):
+        # Queue a packet, flushes first if the batch is full or the packet doesn't fit
+        size = packet.size()
+        if self.use_gso:
+            if len(self.lengths) == self.batch_size or self.used + MAX_LONG_HEADER_SIZE > len(self.buffer):
+                self.flush()
+            header_size = packet.pack_header_into(self.view, self.used)
+            self.headers.append((self.used, header_size))
+            self.payloads.append(packet.segments if packet.segments is not None else (packet.payload,))
+            self.used += header_size
+        else:
+            if len(self.lengths) == self.batch_size or self.used + size > len(self.buffer):
+                self.flush()
+            packet.pack_into(self.view, self.used)
+            self.used += size
+        self.lengths.append(size)
+        if DEBUG:
+            log_packet(PACKET_SENT, packet, self.address)
+        if len(self.lengths) == self.batch_size:
+            self.flush()
+
+    def flush(self):
+        # Send everything queued
+        if not self.lengths:
+            return
+        if self.use_gso:
+            self.__send_gso()
+        elif self.use_sendmmsg:
+            self.__send_mmsg(0, 0)
+        else:
+            self.__send_loop(0, 0)
+        self.packets_sent += len(self.lengths)
+        self.lengths.clear()
+        self.headers.clear()
+        self.payloads.clear()
+        self.used = 0
+
+    ################################## Private helpers ##################################
+    def __init_mmsghdrs(self):
+        self.sockaddr = ctypes.create_string_buffer(_build_sockaddr(self.sock.family, self.address))
+        self.c_buffer = (ctypes.c_char * len(self.buffer)).from_buffer(self.buffer)
+        self.iovecs = (_IoVec * self.batch_size)()
+        self.mmsghdrs = (_MMsgHdr * self.batch_size)()
+        for i in range(self.batch_size):
+            header = self.mmsghdrs[i].msg_hdr
+            header.msg_name = ctypes.addressof(self.sockaddr)
+            header.msg_namelen = len(self.sockaddr.raw) - 1     # create_string_buffer adds a NUL
+            header.msg_iov = ctypes.pointer(self.iovecs[i])
+            header.msg_iovlen = 1
+
+    def __wait_writable(self):
+        # sendmmsg on a socket with a timeout (non-blocking under the hood) can hit a full socket buffer
+        _, writable, _ = select.select([], [self.sock], [], self.sock.gettimeout())
+        if not writable:
+            raise socket.timeout("timed out")
+
+    def __iovecs(self, start, end):
+        # Scatter-gather list of the headers and payloads of packets start to end
+        iovecs = []
+        for (offset, size), payload in zip(self.headers[start:end], self.payloads[start:end]):
+            iovecs.append(self.view[offset:offset + size])
+            iovecs.extend(segment for segment in payload if segment)
+        return iovecs
+
+    def __send_gso(self):
+        lengths = self.lengths
+        count = len(lengths)
+        i = 0
+        while i < count:
+            # A run is a number of packets of the same size, only the last one may be shorter
+            segment_size = lengths[i]
+            total = segment_size
+            buffers = 1 + len(self.payloads[i])
+            j = i + 1
+            while (j < count and j - i < GSO_MAX_SEGMENTS and lengths[j] <= segment_size and total + lengths[j] <= MAX_UDP_PAYLOAD
+                   and buffers + 1 + len(self.payloads[j]) <= IOV_MAX):
+                total += lengths[j]
+                buffers += 1 + len(self.payloads[j])
+                j += 1
+                if lengths[j - 1] < segment_size:
+                    break
+            if j - i == 1:
+                self.sock.sendmsg(self.__iovecs(i, j), [], 0, self.address)
+            else:
+                try:
+                    self.sock.sendmsg(self.__iovecs(i, j), [(SOL_UDP, UDP_SEGMENT, struct.pack("=H", segment_size))], 0, self.address)
+                except OSError as e:
+                    if e.errno not in (errno.EIO, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOPROTOOPT):
+                        raise
+                    # The kernel or the device refused to segment, send the rest one by one and without GSO from now on
+                    self.use_gso = False
+                    for k in range(i, count):
+                        self.sock.sendmsg(self.__iovecs(k, k + 1), [], 0, self.address)
+                        self.syscalls += 1
+                    return
+            self.syscalls += 1
+            i = j
+
+    def __send_mmsg(self, start, offset):
+        count = len(self.lengths) - start
+        base = ctypes.addressof(self.c_buffer)
+        for k in range(count):
+            self.iovecs[k].iov_base = base + offset
+            self.iovecs[k].iov_len = self.lengths[start + k]
+            offset += self.lengths[start + k]
+        sent = 0
+        while sent < count:
+            result = _sendmmsg(self.sock.fileno(), ctypes.byref(self.mmsghdrs, sent * ctypes.sizeof(_MMsgHdr)), count - sent, 0)
+            if result < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.__wait_writable()
+                    continue
+                if err == errno.EINTR:
+                    continue
+                raise OSError(err, os.strerror(err))
+            sent += result
+            self.syscalls += 1
+
+    def __send_loop(self, start, offset):
+        for length in self.lengths[start:]:
+            self.sock.sendto(self.view[offset:offset + length], self.address)
+            offset += length
+            self.syscalls += 1
+# endregion
+
+
+# region Connection ID steering
+
+# Several sockets (one per worker process) bound to the same port with SO_REUSEPORT form a group, the kernel picks one per datagram
+# By default it hashes the addresses, a classic BPF program attached to the group picks by destination connection ID instead:
+# socket index = low 32 bits of the destination connection ID % number of sockets, so all of a connection's datagrams reach the same worker
+# The program sees the UDP payload - the destination connection ID starts at byte 7 of a long header and byte 2 of a short one
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+SO_ATTACH_REUSEPORT_CBPF = 51
+LONG_HEADER_DCID_OFFSET = 7
+SHORT_HEADER_DCID_OFFSET = 2
+_CONNECTION_ID_FORMAT = struct.Struct('!Q')
+
+
+class _SockFilter(ctypes.Structure):
+    _fields_ = [("code", ctypes.c_uint16), ("jt", ctypes.c_uint8), ("jf", ctypes.c_uint8), ("k", ctypes.c_uint32)]
+
+
+class _SockFprog(ctypes.Structure):
+    _fields_ = [("len", ctypes.c_uint16), ("filter", ctypes.POINTER(_SockFilter))]
+
+
+def new_connection_id(worker_index=0, workers=1):
+    # A random connection ID that steers to the given worker
+    connection_id = int.from_bytes(os.urandom(CONNECTION_ID_LENGTH), "big")
+    low = connection_id & 0xFFFFFFFF
+    low += worker_index - low % workers
+    if low > 0xFFFFFFFF:
+        low -= workers
+    return connection_id & ~0xFFFFFFFF | low
+
+
+def steering_index(connection_id, workers):
+    # The worker a connection ID steers to, what the BPF program computes
+    return (connection_id & 0xFFFFFFFF) % workers
+
+
+def connection_id_of(datagram):
+    # Destination connection ID of a raw datagram, for steering in user space
+    offset = LONG_HEADER_DCID_OFFSET if datagram[0] == LONG_HEADER else SHORT_HEADER_DCID_OFFSET
+    if len(datagram) < offset + CONNECTION_ID_LENGTH:
+        return 0
+    return _CONNECTION_ID_FORMAT.unpack_from(datagram, offset)[0]
+
+
+def steer_by_connection_id(sock, count):
+    # Attach the steering program to sock's reuseport group of count sockets, returns False if the kernel can't
+    if not sys.platform.startswith("linux"):
+        return False
+    program = (_SockFilter * 7)(
+        _SockFilter(0x30, 0, 0, 0),                             # ldb [0]          A = header form
+        _SockFilter(0x15, 0, 2, LONG_HEADER),                   # jeq #LONG, 2, 4
+        _SockFilter(0x20, 0, 0, LONG_HEADER_DCID_OFFSET + 4),   # ld [11]          A = low 32 bits of the connection ID
+        _SockFilter(0x05, 0, 0, 1),                             # ja 5
+        _SockFilter(0x20, 0, 0, SHORT_HEADER_DCID_OFFSET + 4),  # ld [6]
+        _SockFilter(0x94, 0, 0, count),                         # mod #count
+        _SockFilter(0x16, 0, 0, 0),                             # ret A            socket index
+    )
+    fprog = _SockFprog(len(program), program)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF, bytes(fprog))
+        return True
+    except OSError:
+        return False
+# endregion
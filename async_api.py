@@ -0,0 +1,310 @@
+import asyncio
+import collections
+import struct
+import api
+import flowcontrol
+
+# asyncio version of the QUIC client and server, built on loop.create_datagram_endpoint and the packet codec in api
+# One event loop serves any number of connections and streams, without a thread per stream,
+# and every connection has its own idle timeout instead of the process-wide socket timeout
+# A transport of its own, not compatible with client.py / server.py: no handshake, ACKs, flow control or coalesced frames,
+# just DATA and END_STREAM packets, any other packet is ignored - the server knows a connection by the destination
+# connection ID of its packets, picked by the client since there is no handshake to agree on one
+
+# Default values
+DEFAULT_IDLE_TIMEOUT = 15               # Seconds without a packet before a connection is dropped
+DEFAULT_PACKET_SIZE = 1400              # Payload bytes per packet, fits a 1500 byte MTU with the IP, UDP and QUIC headers
+
+
+# region Streams
+
+class ReceiveStream:
+    # The receiving side of a stream: async for chunk in stream, chunks are memoryviews of the datagrams (no copies)
+    # Chunks that arrive early are buffered only within the receive windows of flowcontrol.py, past the in order data for
+    # the stream and over all the connection's streams - there are no credit updates here, so the windows just slide
+    def __init__(self, connection, stream_id, window=flowcontrol.MAX_STREAM_WINDOW):
+        self.connection = connection
+        self.stream_id = stream_id
+        self.window = window                # Bytes past next_pos an early chunk may reach
+        self.chunks = collections.deque()   # In order chunks waiting for the reader
+        self.out_of_order = {}              # Chunks that arrived early, by offset in stream
+        self.buffered_bytes = 0             # Their size
+        self.dropped = 0                    # Early chunks refused, outside the windows
+        self.next_pos = 0                   # Offset of the next chunk the reader should get
+        self.end_pos = None                 # Size of the stream in bytes, known once END_STREAM arrived
+        self.error = None                   # Set if the connection went away before the stream finished
+        self.bytes_received = 0
+        self.packets_received = 0
+        self.waiter = None                  # Future the reader waits on for more data
+
+    @property
+    def finished(self):
+        return self.end_pos is not None and self.next_pos >= self.end_pos
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.chunks:
+            if self.finished:
+                raise StopAsyncIteration
+            if self.error is not None:
+                raise self.error
+            self.waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        return self.chunks.popleft()
+
+    async def read(self):
+        # Read the whole stream into bytes
+        return b"".join([chunk async for chunk in self])
+
+    ################################## Called by the protocol ##################################
+    def on_data(self, pos, chunk):
+        if pos < self.next_pos or pos in self.out_of_order:
+            return      # Duplicate
+        size = len(chunk)
+        early = pos != self.next_pos
+        if early and (pos + size > self.next_pos + self.window or self.connection.buffered_bytes + size > self.connection.window):
+            self.dropped += 1
+            return
+        self.bytes_received += size
+        self.packets_received += 1
+        if early:
+            self.out_of_order[pos] = chunk
+            self.buffered_bytes += size
+            self.connection.buffered_bytes += size
+            return
+        self.chunks.append(chunk)
+        self.next_pos += size
+        while self.next_pos in self.out_of_order:
+            chunk = self.out_of_order.pop(self.next_pos)
+            self.buffered_bytes -= len(chunk)
+            self.connection.buffered_bytes -= len(chunk)
+            self.chunks.append(chunk)
+            self.next_pos += len(chunk)
+        self.wake()
+
+    def on_end(self, pos):
+        self.end_pos = pos
+        self.wake()
+
+    def abort(self, error):
+        self.error = error
+        self.wake()
+
+    def wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+
+class SendStream:
+    # The sending side of a stream: await stream.write(data), then await stream.close()
+    def __init__(self, client, stream_id):
+        self.client = client
+        self.stream_id = stream_id
+        self.pos = 0                        # Offset of the next packet in the stream (bytes written so far)
+        self.bytes_sent = 0
+        self.closed = False
+
+    async def write(self, data):
+        view = memoryview(data)
+        packet_size = self.client.packet_size
+        for offset in range(0, len(view), packet_size):
+            chunk = view[offset:offset + packet_size]
+            await self.client.send(api.QuicPacket(self.client.connection_id, self.client.server_connection_id, chunk, self.stream_id, self.pos, api.DATA))
+            self.pos += len(chunk)
+            self.bytes_sent += len(chunk)
+
+    async def close(self):
+        # Send a final packet to signal the end of the stream
+        if not self.closed:
+            self.closed = True
+            await self.client.send(api.QuicPacket(self.client.connection_id, self.client.server_connection_id, b"", self.stream_id, self.pos, api.END_STREAM))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+# endregion
+
+
+# region Server
+
+class ServerConnection:
+    # A client as seen by the server, with its own streams and idle timer
+    def __init__(self, server, connection_id, address, window=flowcontrol.MAX_CONNECTION_WINDOW):
+        self.server = server
+        self.connection_id = connection_id  # The destination connection ID of the client's packets
+        self.address = address
+        self.streams = {}                   # ReceiveStream by stream ID
+        self.window = window                # Bytes of early chunks buffered over all the streams
+        self.buffered_bytes = 0
+        self.loop = asyncio.get_running_loop()
+        self.last_activity = self.loop.time()
+        self.timer = self.loop.call_later(server.idle_timeout, self.check_idle)
+
+    def on_packet(self, packet):
+        # The timer isn't rescheduled per packet, check_idle looks at last_activity when it fires
+        self.last_activity = self.loop.time()
+        if packet.packet_type == api.END_CONNECTION:
+            self.close(None)
+            return
+        if packet.packet_type != api.DATA and packet.packet_type != api.END_STREAM:
+            return      # Not of a stream
+        stream = self.streams.get(packet.stream_id)
+        if stream is None:
+            stream = self.streams[packet.stream_id] = ReceiveStream(self, packet.stream_id)
+            self.server.on_new_stream(stream)
+        if packet.packet_type == api.DATA:
+            stream.on_data(packet.pos_in_stream, packet.payload)
+        elif packet.packet_type == api.END_STREAM:
+            stream.on_end(packet.pos_in_stream)
+
+    def check_idle(self):
+        idle = self.loop.time() - self.last_activity
+        if idle >= self.server.idle_timeout:
+            print(f"Connection {self.connection_id:016x} from {self.address[0]}:{self.address[1]} idle for {idle:.1f}s, closing.")
+            self.close(ConnectionError("connection idle timeout"))
+        else:
+            self.timer = self.loop.call_later(self.server.idle_timeout - idle, self.check_idle)
+
+    def close(self, error):
+        self.timer.cancel()
+        for stream in self.streams.values():
+            if not stream.finished:
+                stream.abort(error or ConnectionError("connection closed"))
+        self.server.connections.pop(self.connection_id, None)
+
+
+class _ServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+
+    def datagram_received(self, data, address):
+        packet = api.QuicPacket(0, 0, b"", 0, 0)
+        try:
+            packet.unpack(data)
+        except (ValueError, IndexError, struct.error):
+            return      # Not one of ours, or cut short
+        if api.DEBUG:
+            api.log_packet(api.PACKET_RECEIVED, packet, address)
+        connection = self.server.connections.get(packet.destination_connection_id)
+        if connection is None:
+            if packet.packet_type != api.DATA and packet.packet_type != api.END_STREAM:
+                return      # Only a stream's packet opens a connection
+            connection = self.server.connections[packet.destination_connection_id] = ServerConnection(self.server, packet.destination_connection_id, address)
+        connection.on_packet(packet)
+
+
+class QuicServer:
+    # Either pass stream_handler (a coroutine function, started for every new stream) or call accept_stream()
+    def __init__(self, server_address=(api.DEFAULT_SERVER_HOST, api.DEFAULT_SERVER_PORT), stream_handler=None, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.server_address = server_address
+        self.stream_handler = stream_handler
+        self.idle_timeout = idle_timeout
+        self.connections = {}               # ServerConnection by the destination connection ID of its packets
+        self.new_streams = asyncio.Queue()
+        self.tasks = set()                  # Running stream handlers
+        self.transport = None
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: _ServerProtocol(self), local_addr=self.server_address)
+        # Port 0 means any free port, keep the real one
+        self.server_address = self.transport.get_extra_info("sockname")[:2]
+        print(f"Server running on {self.server_address[0]}:{self.server_address[1]}")
+        return self
+
+    async def accept_stream(self):
+        return await self.new_streams.get()
+
+    def on_new_stream(self, stream):
+        if self.stream_handler is None:
+            self.new_streams.put_nowait(stream)
+            return
+        task = asyncio.ensure_future(self.stream_handler(stream))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def close(self):
+        for connection in list(self.connections.values()):
+            connection.close(None)
+        if self.transport is not None:
+            self.transport.close()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+# endregion
+
+
+# region Client
+
+class _ClientProtocol(asyncio.DatagramProtocol):
+    def __init__(self, client):
+        self.client = client
+
+    def pause_writing(self):
+        # The transport's buffer is full (the socket would block), writers wait until it drains
+        self.client.can_write.clear()
+
+    def resume_writing(self):
+        self.client.can_write.set()
+
+    def datagram_received(self, data, address):
+        pass        # The server doesn't send anything yet
+
+    def error_received(self, exc):
+        api.logger.debug("Error received: %s", exc)
+
+
+class QuicClient:
+    def __init__(self, server_address=(api.DEFAULT_SERVER_HOST, api.DEFAULT_SERVER_PORT), packet_size=DEFAULT_PACKET_SIZE):
+        self.server_address = server_address
+        self.packet_size = packet_size
+        self.connection_id = api.new_connection_id()
+        self.server_connection_id = api.new_connection_id()     # The server knows the connection by it, no handshake - we pick it
+        self.next_stream_id = 1
+        self.packets_sent = 0
+        self.transport = None
+        self.can_write = asyncio.Event()
+
+    async def connect(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: _ClientProtocol(self), remote_addr=self.server_address)
+        self.can_write.set()
+        return self
+
+    def open_stream(self):
+        stream = SendStream(self, self.next_stream_id)
+        self.next_stream_id += 1
+        return stream
+
+    async def send(self, packet):
+        await self.can_write.wait()
+        self.transport.sendto(packet.pack())
+        self.packets_sent += 1
+        if api.DEBUG:
+            api.log_packet(api.PACKET_SENT, packet, self.server_address)
+        # UDP sends rarely block, yield every batch so the other streams (and the rest of the loop) get a turn
+        if self.packets_sent % api.DEFAULT_BATCH_SIZE == 0:
+            await asyncio.sleep(0)
+
+    async def close(self):
+        if self.transport is not None:
+            await self.send(api.QuicPacket(self.connection_id, self.server_connection_id, b"", 0, 0, api.END_CONNECTION))
+            self.transport.close()
+            self.transport = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+# endregion
@@ -1,11 +1,26 @@
 import random
-import threading
-import string
+import json
+import mmap
+import collections
+import concurrent.futures
 import time
+import os
+import struct
 import api
+import compression
 import socket
 import argparse
 import data_generator
+import scheduler
+import reliability
+import congestion
+import flowcontrol
+import fec
+import frames
+import handshake
+import pmtud
+import profiling
+import tracing
 
 # Used assignment 2 as a reference for the client code
 
@@ -15,124 +30,618 @@ PACKET_MAX_SIZE = 2000
 
 NUM_OF_FILES = 10
 
-def generate_payload_size():
-    return random.randint(PACKET_MIN_SIZE, PACKET_MAX_SIZE)
+DEFAULT_WINDOW = 128        # Packets in flight before the sender waits for ACKs
+DEFAULT_CC = "cubic"        # Congestion controller
+HANDSHAKE_TIMEOUT = 0.5     # Seconds before an unanswered handshake is resent, doubles with every attempt
+HANDSHAKE_ATTEMPTS = 5
+
+def generate_payload_size(min_size=PACKET_MIN_SIZE, max_size=PACKET_MAX_SIZE, rng=random):
+    return rng.randint(min_size, max_size)
+
+
+def file_chunks(view, chunk_size):
+    # The file's chunks as slices of its mapping - no reads, no copies, the pages are loaded by the kernel as they are sent
+    # chunk_size - the payload size, or a function returning the current one (it follows path MTU discovery)
+    size = chunk_size if callable(chunk_size) else lambda: chunk_size
+    offset = 0
+    while offset < len(view):
+        end = offset + size()
+        yield view[offset:end]
+        offset = end
+
+
+class StreamsRestarted(Exception):
+    # Raised out of the sender when the server rejected the 0-RTT data and picked another codec than the ticket's -
+    # send_files sends the streams again from their first byte
+    pass
+
+
+class Sender:
+    # Sending side of one send_files call, used only by the thread that runs it
+    # Keeps the window of in-flight packets full, processes ACK ranges and retransmits only the lost packets
+    # The congestion controller decides how many bytes may be in flight, the pacer spreads them over the RTT
+    # The scheduler gets the flow control credit (MAX_DATA / MAX_STREAM_DATA) the receiver sends along with the ACKs
+    # Path MTU probes go out between the packets, a bigger confirmed size grows the datagrams of the chunks produced from then on
+    # The streams' frames are coalesced by the packer - a datagram goes out once the next frame doesn't fit in it anymore,
+    # so small files, the last chunks of streams and the ends of streams share datagrams
+    # With FEC every group of datagrams is followed by its parity, and a lost datagram is declared lost only once the rest of
+    # its group had the time to arrive - the receiver rebuilds it from the parity without the retransmission round trip
+    def __init__(self, client, stream_scheduler):
+        self.client = client
+        self.stream_scheduler = stream_scheduler
+        self.send_queue = api.SendQueue(client.socket, client.server_address, client.batch_size)
+        self.packer = frames.FramePacker(client.connection_id, client.server_connection_id, client.max_datagram_size())
+        self.loss_detector = reliability.LossDetector()
+        if client.handshake_rtt is not None:
+            self.loss_detector.rtt.update(client.handshake_rtt)
+        self.congestion_controller = congestion.CONGESTION_CONTROLLERS[client.cc](client.max_datagram_size())
+        self.pacer = congestion.Pacer(client.batch_size * client.max_datagram_size())
+        self.retransmissions = collections.Counter()    # Retransmitted frames by stream ID
+        self.cc_samples = {}                            # stream_id -> [samples, sum of cwnd, sum of smoothed RTT], taken on every ACK
+        self.max_congestion_window = 0
+        self.unpolled = 0                               # Packets sent since ACKs were last read
+        self.blocked_limits = None                      # Limits the last DATA_BLOCKED / STREAM_DATA_BLOCKED were sent at
+        self.blocked_deadline = 0                       # When they are sent again if no credit came
+        self.blocked_probes = 0                         # Times they were sent again without getting credit
+        self.flow_control_wait = 0.0                    # Seconds spent blocked by flow control
+        self.fec_encoder = None if client.fec is None else fec.FecEncoder(client.fec or None)
+        self.fec_loss = (0, 0)                          # (FEC group datagrams, missing ones) the receiver last reported
+        if client.reliable:
+            self.ack_receiver = api.BatchReceiver(client.socket, client.batch_size)
+
+    def send_frame(self, frame):
+        packet = self.packer.add(frame)
+        if packet is not None:
+            self.send(packet)
+
+    def end_stream(self, stream_id, offset):
+        packet = self.packer.end_stream(stream_id, offset)
+        if packet is not None:
+            self.send(packet)
+
+    def flush_frames(self):
+        # Send the datagram being filled as it is
+        packet = self.packer.seal()
+        if packet is not None:
+            self.send(packet)
+
+    def flush_fec(self):
+        # Send the parity of the datagrams of the group so far, before the sender goes quiet
+        if self.fec_encoder is not None:
+            self.send_parity(self.fec_encoder.seal(self.client.connection_id, self.client.server_connection_id))
+
+    def protect(self, packet):
+        # Stamps a datagram with its FEC group, returns the group's parity if the datagram completed it
+        if self.fec_encoder is None or packet.packet_type != api.FRAMES:
+            return None
+        return self.fec_encoder.protect(packet)
+
+    def send_parity(self, parity):
+        # Outside the loss detector and the congestion window, like the path MTU probes - a parity is never resent
+        if parity is None:
+            return
+        if self.client.reliable:
+            self.pacer.on_packet_sent(parity.size())
+        self.send_queue.append(parity)
+
+    def send(self, packet):
+        if not self.client.reliable:
+            parity = self.protect(packet)
+            self.send_queue.append(packet)
+            self.send_parity(parity)
+            return
+        # Wait for room in the window, lost packets are resent before any new data
+        while len(self.loss_detector.in_flight) >= self.client.window or not self.congestion_controller.can_send(self.loss_detector.bytes_in_flight):
+            self.send_queue.flush()
+            self.poll_acks()
+        # Wait for the pacer, ACKs that arrive in the meantime are processed
+        parity = self.protect(packet)
+        size = packet.size()
+        while True:
+            delay = self.pacer.time_until_send(size, time.monotonic())
+            if delay == 0:
+                break
+            self.send_queue.flush()
+            self.poll_acks(delay)
+        self.loss_detector.on_packet_sent(packet, time.monotonic())
+        self.pacer.on_packet_sent(size)
+        self.send_queue.append(packet)
+        self.send_parity(parity)
+        # Read whatever ACKs arrived once per batch, without blocking
+        self.unpolled += 1
+        if self.unpolled >= self.client.batch_size:
+            self.poll_acks(0)
+
+    def poll_acks(self, max_wait=None):
+        # Process the waiting ACKs, waits up to max_wait seconds for one (0 - don't wait)
+        # or, if not given, until an ACK arrives or the loss / probe timer fires
+        self.unpolled = 0
+        timeout = max_wait
+        deadline = self.loss_detector.timeout_deadline()
+        if deadline is not None:
+            until_deadline = max(deadline - time.monotonic(), 0)
+            timeout = until_deadline if timeout is None else min(timeout, until_deadline)
+        if self.client.handshake_pending:
+            # Also wake up to resend an unanswered 0-RTT handshake
+            until_resend = max(self.client.handshake_deadline - time.monotonic(), 0)
+            timeout = until_resend if timeout is None else min(timeout, until_resend)
+        try:
+            batch = self.ack_receiver.recv_batch(timeout or 0)
+        except socket.timeout:
+            batch = []
+        now = time.monotonic()
+        lost = []
+        probes = []
+        rtt = self.loss_detector.rtt
+        for packet, _ in batch:
+            if packet.packet_type == api.HANDSHAKE:
+                self.on_handshake(packet, now)
+                continue
+            try:
+                for frame in frames.iter_frames(packet):
+                    self.on_frame(frame, now)
+            except ValueError:
+                continue            # A malformed frame, the frames after it are lost with it
+        if batch and self.fec_encoder is not None:
+            self.on_fec_feedback()
+        if batch:
+            lost = self.loss_detector.detect_lost(now)
+        elif deadline is not None and now >= deadline:
+            lost, probes = self.loss_detector.on_timeout(now)
+        if lost:
+            self.congestion_controller.on_packets_lost(lost, now)
+        self.max_congestion_window = max(self.max_congestion_window, self.congestion_controller.congestion_window)
+        self.pacer.update_rate(self.congestion_controller.congestion_window, rtt.smoothed_rtt)
+        self.retransmit(lost + probes)
+        if self.client.path_mtu is not None:
+            self.probe_path_mtu(now)
+        if self.client.handshake_pending:
+            self.client.resend_handshake(now)
+
+    def on_handshake(self, packet, now):
+        # The answer to a 0-RTT handshake, it arrives among the ACKs - from now on the server's connection ID is used
+        client = self.client
+        if not client.handshake_pending or packet.destination_connection_id != client.connection_id:
+            return                  # A repeated answer
+        codec = client.codec
+        accepted = client.on_handshake(packet, now)
+        self.packer.destination_id = client.server_connection_id
+        if not accepted:
+            # The server dropped the early data, all of it goes again to the new connection ID
+            discarded = self.loss_detector.discard_all()
+            if self.fec_encoder is not None:
+                self.fec_encoder.discard()
+            if client.codec is not codec:
+                # It was compressed with the ticket's codec - the streams start over with the server's pick instead
+                self.packer.discard()
+                raise StreamsRestarted()
+            self.retransmit(discarded)
+
+    def on_fec_feedback(self):
+        self.fec_encoder.on_loss_counts(*self.fec_loss)
+        # A lost datagram can be rebuilt only once the rest of its group and the parity arrived
+        self.loss_detector.packet_threshold = max(reliability.PACKET_THRESHOLD, self.fec_encoder.group_size + 1)
+
+    def on_frame(self, frame, now):
+        frame_type = frame.frame_type
+        if frame_type == frames.MAX_STREAM_DATA:
+            self.stream_scheduler.update_max_stream_data(frame.stream_id, frame.offset)
+        elif frame_type == frames.MAX_DATA:
+            self.stream_scheduler.update_max_data(frame.offset)
+        elif frame_type == frames.FEC_LOSS:
+            self.fec_loss = max(self.fec_loss, (frame.stream_id, frame.offset))
+        elif frame_type == frames.PMTU_PROBE_ACK:
+            if self.client.path_mtu is not None and self.client.path_mtu.on_probe_acked(frame.offset, now):
+                self.on_max_datagram_size_changed()
+        elif frame_type == frames.ACK:
+            rtt = self.loss_detector.rtt
+            cwnd_limited = 2 * self.loss_detector.bytes_in_flight >= self.congestion_controller.congestion_window
+            acked, _ = self.loss_detector.on_ack_received(frame.stream_id, api.unpack_ack_ranges(frame.data), now, False)
+            self.congestion_controller.on_packets_acked(acked, now, rtt, cwnd_limited)
+            samples = self.cc_samples.setdefault(frame.stream_id, [0, 0, 0])
+            samples[0] += 1
+            samples[1] += self.congestion_controller.congestion_window
+            samples[2] += rtt.smoothed_rtt
+
+    def probe_path_mtu(self, now):
+        # Send the next probe if one is due - outside the loss detector and the congestion window, a lost probe is no congestion signal
+        path_mtu = self.client.path_mtu
+        size = path_mtu.next_probe(now, self.loss_detector.rtt.pto())
+        if size is None:
+            return
+        try:
+            pmtud.probe_packet(self.client.connection_id, self.client.server_connection_id, size).sendto(self.client.socket, self.client.server_address)
+        except OSError:
+            path_mtu.on_probe_failed(size, now)     # Too big for the local interface (EMSGSIZE)
+
+    def on_max_datagram_size_changed(self):
+        max_datagram_size = self.client.max_datagram_size()
+        self.congestion_controller.on_max_datagram_size_changed(max_datagram_size)
+        self.pacer.burst = self.client.batch_size * max_datagram_size
+        self.packer.max_size = max_datagram_size
+
+    def retransmit(self, lost):
+        # A lost single frame packet is resent as it is, the frames of lost datagrams that weren't acknowledged yet are
+        # packed into new datagrams together
+        now = time.monotonic()
+        packets = []
+        lost_frames = []
+        for sent in lost:
+            if api.DEBUG:
+                api.log_packet(api.PACKET_LOST, sent.packet, self.client.server_address)
+            if sent.frames is None:
+                packets.append(sent.packet)
+                self.retransmissions[sent.packet.stream_id] += 1
+                continue
+            lost_frames.extend(sent.frames.values())
+            for stream_id, _ in sent.frames:
+                self.retransmissions[stream_id] += 1
+        if lost_frames:
+            packets.extend(frames.pack(lost_frames, self.client.connection_id, self.client.server_connection_id, self.client.max_datagram_size()))
+        for packet in packets:
+            parity = self.protect(packet)
+            self.loss_detector.on_packet_sent(packet, now, True)
+            self.pacer.on_packet_sent(packet.size())
+            self.send_queue.append(packet)
+            self.send_parity(parity)
+        self.send_queue.flush()
+
+    def wait_for_credit(self):
+        # Every stream left is blocked by flow control - tell the receiver at which limits (it answers with its current ones,
+        # in case an update was lost) and wait for credit, again every PTO for as long as it doesn't come
+        stream_scheduler = self.stream_scheduler
+        start = time.monotonic()
+        limits = (stream_scheduler.max_data, tuple(stream.max_data for stream in stream_scheduler.active))
+        if limits != self.blocked_limits or start >= self.blocked_deadline:
+            if limits == self.blocked_limits and not self.loss_detector.in_flight:
+                self.blocked_probes += 1
+                if self.blocked_probes > reliability.MAX_PTO_COUNT:
+                    raise ConnectionError(f"No flow control credit after {reliability.MAX_PTO_COUNT} probe timeouts, giving up")
+            elif limits != self.blocked_limits:
+                self.blocked_probes = 0
+            connection_id, server_connection_id = self.client.connection_id, self.client.server_connection_id
+            if stream_scheduler.blocked:
+                self.send_queue.append(api.QuicPacket(connection_id, server_connection_id, b"", 0, stream_scheduler.max_data, api.DATA_BLOCKED))
+            for stream in stream_scheduler.active:
+                if stream.blocked:
+                    self.send_queue.append(api.QuicPacket(connection_id, server_connection_id, b"", stream.stream_id, stream.max_data, api.STREAM_DATA_BLOCKED))
+            self.blocked_limits = limits
+            self.blocked_deadline = start + self.loss_detector.rtt.pto() * (2 ** self.blocked_probes)
+        self.flush_frames()
+        self.flush_fec()
+        self.send_queue.flush()
+        self.poll_acks(max(self.blocked_deadline - start, 0))
+        self.flow_control_wait += time.monotonic() - start
+
+    def finish(self):
+        # Flush and wait until nothing is in flight anymore
+        self.flush_frames()
+        self.flush_fec()
+        self.send_queue.flush()
+        if self.client.reliable:
+            while self.loss_detector.in_flight:
+                self.poll_acks()
+                self.flush_fec()        # Retransmissions are protected too
+                self.send_queue.flush()
+
+    def stream_stats(self, stream_id):
+        # Average congestion window (bytes) and smoothed RTT (seconds) seen while the stream's packets were acknowledged
+        samples, cwnd_sum, rtt_sum = self.cc_samples.get(stream_id, (0, 0, 0))
+        if not samples:
+            return {'avg_cwnd': 0, 'avg_rtt': 0}
+        return {'avg_cwnd': cwnd_sum / samples, 'avg_rtt': rtt_sum / samples}
+
+    def connection_stats(self):
+        rtt = self.loss_detector.rtt
+        return {
+            'cc': self.congestion_controller.name,
+            'cwnd': self.congestion_controller.congestion_window,
+            'max_cwnd': self.max_congestion_window,
+            'congestion_events': self.congestion_controller.congestion_events,
+            'smoothed_rtt': rtt.smoothed_rtt,
+            'min_rtt': rtt.min_rtt if rtt.has_sample else 0,
+            'packets_lost': self.loss_detector.packets_lost,
+            'datagrams_sent': self.send_queue.packets_sent,
+            'max_data': self.stream_scheduler.max_data,
+            'flow_control_blocked': self.stream_scheduler.blocked_count,
+            'flow_control_wait': self.flow_control_wait,
+            'compression': None if self.client.codec is None else self.client.codec.name,
+            'early_data': self.client.early_data,
+            'fec_group_size': 0 if self.fec_encoder is None else self.fec_encoder.group_size,
+            'fec_parity_sent': 0 if self.fec_encoder is None else self.fec_encoder.parity_sent,
+            'fec_loss_rate': None if self.fec_encoder is None else self.fec_encoder.loss_rate,
+            'max_datagram_size': self.client.max_datagram_size(),
+            'pmtu_probes': self.client.path_mtu.probes_sent if self.client.path_mtu else 0,
+            'pmtu_probes_lost': self.client.path_mtu.probes_lost if self.client.path_mtu else 0,
+        }
+
 
 class Client:
-    def __init__(self, server_address):
+    # packet_sizes - (min, max) payload size, every stream picks one in the range, seed - makes the picks reproducible
+    # None - the payloads fill the datagrams path MTU discovery found (reliable only, an unreliable client can't hear the probes' ACKs)
+    # compression - name of the codec (compression.CODECS) to offer in the handshake, used if the server takes it (reliable only,
+    # an unreliable client doesn't wait for the answer)
+    # session_cache - a handshake.SessionCache: the server's ticket is kept there, and a client with a ticket for the server
+    # sends its streams right behind the handshake (0-RTT, reliable only) - None: no resumption, every connection waits a round trip
+    # fec - None: no forward error correction, 0: a parity datagram per group of datagrams whose size adapts to the loss
+    # (fixed without reliability, nothing reports the loss), K: a parity per K datagrams
+    def __init__(self, server_address, batch_size=api.DEFAULT_BATCH_SIZE, reliable=True, window=DEFAULT_WINDOW, cc=DEFAULT_CC,
+                 packet_sizes=None, seed=None, compression=None, fec=None, session_cache=None):
         self.server_address = server_address
-        self.connection_id = 0      # Connection ID - using 1 bit in our implementation to allow only 2 connection IDs
+        self.batch_size = batch_size    # Max number of packets coalesced into one send
+        self.reliable = reliable        # Wait for ACKs and retransmit lost packets
+        self.window = window            # Max number of unacknowledged packets in flight
+        self.cc = cc                    # Congestion controller name, one of congestion.CONGESTION_CONTROLLERS
+        self.packet_sizes = packet_sizes
+        self.compression = compression
+        self.codec = None               # compression.Codec the server picked, None - the streams go uncompressed
+        self.fec = fec
+        self.session_cache = session_cache
+        # The server's transport parameters - defaults until the handshake (or the resumed session) tells
+        self.max_data = flowcontrol.INITIAL_MAX_DATA
+        self.max_stream_data = flowcontrol.INITIAL_MAX_STREAM_DATA
+        # 0-RTT - the handshake is answered while the streams are being sent, the sender resends it until it is
+        self.early_data = None          # None - 1-RTT, True - 0-RTT data sent (and accepted once answered), False - rejected and resent
+        self.handshake_pending = False
+        self.handshake_packet = None
+        self.handshake_sent = 0
+        self.handshake_timeout = HANDSHAKE_TIMEOUT
+        self.handshake_deadline = 0
+        self.handshake_attempts = 0
+        self.random = random.Random(seed)
+        self.connection_id = api.new_connection_id()            # Our connection ID, the server's packets carry it
+        self.server_connection_id = api.new_connection_id()     # The connection ID the server is addressed by - a random one until the handshake
+        self.connected = False
+        self.handshake_rtt = None       # The first RTT sample (RFC 9002 Section 5.1), None until the handshake was answered
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)      # UDP socket
-        # self.waiting_for_ack = {}   # Dict to store packets that are waiting for an ack
+        self.path_mtu = None
+        if packet_sizes is None and reliable:
+            self.path_mtu = pmtud.PathMtuDiscovery(pmtud.max_datagram_size(server_address))
+            pmtud.disable_fragmentation(self.socket)
 
-        self.streams_data = {}  # Dict to store file transfers by stream ID
         # store for each stream the number of packets and bytes received
         self.streams_stats = {}
+        self.connection_stats = {}
 
-        self.lock = threading.Lock()
+        self.lock = profiling.lock("Client.lock")
     
-    def send_file(self, file_path, stream_id):        
-        packet_size = generate_payload_size()
-        bytes_sent = 0
-        packets_sent = 0
-        with open(file_path, 'rb') as file:
-            while True:
-                data = file.read(packet_size)
-                if not data:
-                    break   # End of file
-                quic_packet = api.QuicPacket(0, 1, data, stream_id, packets_sent)
-                with self.lock:
-                    # time.sleep(0.0001)  # Wait for a second before sending the next packet
-                    quic_packet.sendto(self.socket, self.server_address)
-                    bytes_sent += len(data)
-                    packets_sent += 1
-                    self.streams_data[stream_id] = []
-                    self.streams_data[stream_id].append((quic_packet.pos_in_stream, quic_packet.non_binary_payload))
-
-                    if stream_id not in self.streams_stats:
-                        self.streams_stats[stream_id] = {
-                                'start_time': time.time(),      # Start time of the stream
-                                'end_time': None,               # End time of the stream
-                                'bytes_sent': bytes_sent,
-                                'packets_sent': packets_sent
-                            }
-                    else:       # add stats for the stream
-                        self.streams_stats[stream_id]['bytes_sent'] += len(quic_packet.payload)
-                        self.streams_stats[stream_id]['packets_sent'] += 1
-
-                    
-                ''' Wrote to handle acks, ditched for now because it ruins performance and tests
-                time.sleep(0.0001)  # Wait for a second before sending the next packet
-                self.waiting_for_ack[(stream_id, packets_sent)] = quic_packet
-                # wait for ack
-                while (stream_id, packets_sent) in self.waiting_for_ack:
-                    # Resend the packet if timeout occurs
-                    with self.lock:
-                        quic_packet.sendto(self.socket, self.server_address)
-                    # time.sleep(1)  # Wait for a second before resending
-                '''
-
-        # Send a final packet to signal the end of the stream
-        final_packet = api.QuicPacket(0, 1, "end_stream", stream_id, packets_sent)
+    def connect(self):
+        # Handshake - we send our connection ID and transport parameters to a random initial one, the server answers with
+        # the connection ID it wants (a multi-worker server picks one that steers to the worker that got the handshake),
+        # used from then on, its own parameters and a ticket for the next connection
+        # Without reliability nothing is waited for, the server also knows the connection by the initial ID
+        # With a ticket nothing is waited for either (0-RTT), the cached parameters hold until the answer arrives
         with self.lock:
-            final_packet.sendto(self.socket, self.server_address)
+            if self.connected:
+                return
+            parameters = {handshake.MAX_UDP_PAYLOAD_SIZE: handshake.RECEIVE_UDP_PAYLOAD_SIZE}
+            session = self.session_cache.get(self.server_address) if self.session_cache is not None and self.reliable else None
+            if session is not None and self.__codec_of(session.parameters) != (None if self.compression is None else compression.CODECS[self.compression]):
+                session = None          # The ticket is for another codec, the early data would be compressed with it
+            if self.compression and self.reliable:
+                parameters[handshake.CODECS] = compression.encode_offer([self.compression])
+            if session is not None:
+                parameters[handshake.RESUMPTION_TICKET] = session.ticket
+            self.handshake_packet = api.QuicPacket(self.connection_id, self.server_connection_id, handshake.encode_parameters(parameters), 0, 0, api.HANDSHAKE)
+            if not self.reliable:
+                self.handshake_packet.sendto(self.socket, self.server_address)
+                self.connected = True
+                return
+            if session is not None:
+                self.apply_parameters(session.parameters)
+                self.handshake_rtt = session.rtt
+                self.early_data = True
+                self.handshake_pending = True
+                self.handshake_attempts = 0
+                self.resend_handshake(time.monotonic())
+                self.connected = True
+                return
+            previous_timeout = self.socket.gettimeout()
+            timeout = HANDSHAKE_TIMEOUT
+            try:
+                for _ in range(HANDSHAKE_ATTEMPTS):
+                    self.handshake_packet.sendto(self.socket, self.server_address)
+                    sent = self.handshake_sent = time.monotonic()
+                    deadline = sent + timeout
+                    while True:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.socket.settimeout(remaining)
+                        try:
+                            packet, _ = api.recv_packet(self.socket)
+                        except socket.timeout:
+                            break
+                        except (ValueError, IndexError, struct.error):
+                            continue
+                        if packet.packet_type == api.HANDSHAKE and packet.destination_connection_id == self.connection_id:
+                            self.on_handshake(packet, time.monotonic())
+                            self.connected = True
+                            return
+                    timeout *= 2
+            finally:
+                self.socket.settimeout(previous_timeout)
+        raise ConnectionError(f"No answer to the handshake from {self.server_address[0]}:{self.server_address[1]}")
 
-        # Set end time for the stream
-        self.streams_stats[stream_id]['end_time'] = time.time()
-        
-        print(f"Stream {stream_id} completed: Sent {bytes_sent} bytes in {packets_sent} packets.")
-        
+    def resend_handshake(self, now):
+        # Sends the 0-RTT handshake again if it wasn't answered in time, the timeout doubles with every attempt
+        if now < self.handshake_deadline:
+            return
+        if self.handshake_attempts >= HANDSHAKE_ATTEMPTS:
+            raise ConnectionError(f"No answer to the handshake from {self.server_address[0]}:{self.server_address[1]}")
+        if self.handshake_attempts:
+            self.handshake_timeout *= 2
+        self.handshake_packet.sendto(self.socket, self.server_address)
+        self.handshake_attempts += 1
+        self.handshake_sent = now
+        self.handshake_deadline = now + self.handshake_timeout
 
-    ''' Wrote to handle acks, ditched for now because it ruins performance and tests
-    def receive_acks(self):
-        while True:
-            ack, _ = api.recv_packet(self.socket)
-            if ack.packet_type == api.ACK:
-                # remove from waiting for ack packets
-                if (ack.stream_id, ack.pos_in_stream) in self.waiting_for_ack:
-                    self.waiting_for_ack.pop((ack.stream_id, ack.pos_in_stream))
-                print(f"Received ACK for stream {ack.stream_id} packet {ack.pos_in_stream}")
-    '''
+    def on_handshake(self, packet, now):
+        # The server's answer - its connection ID, its transport parameters and a ticket for the next connection
+        # Returns False if it rejected our early data
+        try:
+            parameters = handshake.decode_parameters(packet.payload)
+        except ValueError:
+            parameters = {}
+        self.server_connection_id = packet.source_connection_id
+        self.handshake_rtt = now - self.handshake_sent
+        self.handshake_pending = False
+        accepted = self.early_data is None or handshake.integer(parameters, handshake.EARLY_DATA) == 1
+        self.apply_parameters(parameters)
+        if not accepted:
+            self.early_data = False
+        ticket = parameters.pop(handshake.RESUMPTION_TICKET, None)
+        parameters.pop(handshake.EARLY_DATA, None)
+        if ticket is not None and self.session_cache is not None:
+            self.session_cache.store(self.server_address, handshake.Session(ticket, parameters, self.handshake_rtt))
+        return accepted
+
+    def apply_parameters(self, parameters):
+        # The server's transport parameters, of its answer or of the resumed session
+        self.codec = self.__codec_of(parameters)
+        self.max_data = handshake.integer(parameters, handshake.INITIAL_MAX_DATA, flowcontrol.INITIAL_MAX_DATA)
+        self.max_stream_data = handshake.integer(parameters, handshake.INITIAL_MAX_STREAM_DATA, flowcontrol.INITIAL_MAX_STREAM_DATA)
+        max_udp_payload_size = handshake.integer(parameters, handshake.MAX_UDP_PAYLOAD_SIZE)
+        if max_udp_payload_size is not None and self.path_mtu is not None:
+            self.path_mtu.limit(max_udp_payload_size, time.monotonic())
+
+    def max_datagram_size(self):
+        if self.packet_sizes is not None:
+            return self.packet_sizes[1] + api.MAX_LONG_HEADER_SIZE
+        return pmtud.BASE_PLPMTU if self.path_mtu is None else self.path_mtu.plpmtu
+
+    def payload_size(self):
+        # Biggest chunk whose frame fills a datagram of the size path MTU discovery confirmed so far on its own
+        return self.max_datagram_size() - frames.MAX_PACKET_OVERHEAD - frames.MAX_FRAME_OVERHEAD
+
+    def close(self):
+        # Tell the server the connection is over, so it doesn't have to wait for the idle timeout
+        if self.connected:
+            api.QuicPacket(self.connection_id, self.server_connection_id, b"", 0, 0, api.END_CONNECTION).sendto(self.socket, self.server_address)
+            self.connected = False
+        self.socket.close()
+
+    def send_file(self, file_path, stream_id):
+        self.send_files([(stream_id, file_path)])
+
+    def send_files(self, streams):
+        # Sends all the files (list of (stream_id, file_path)) over the socket from this thread only
+        # The scheduler interleaves the streams' frames, each stream's file is read by its own reader into the stream's queue
+        # The files are mmapped, every frame's data is a memoryview of the mapping all the way to the socket - with GSO the
+        # datagrams go out as their headers and those views (frames.build_packet), otherwise they are copied once into the send buffer
+        # If compression was negotiated, a thread pool compresses the files' blocks ahead of the send loop instead
+        self.connect()
+        if self.reliable:
+            stream_scheduler = scheduler.StreamScheduler(max_data=self.max_data, max_stream_data=self.max_stream_data)
+        else:
+            # Without reliability nothing is read from the socket, credit would never arrive - the server writes in order data through anyway
+            stream_scheduler = scheduler.StreamScheduler()
+        sender = Sender(self, stream_scheduler)
+        if self.path_mtu is not None:
+            sender.probe_path_mtu(time.monotonic())     # The first probe goes out with the first packets
+        mappings = []
+        application_bytes = {}          # File size by stream ID
+        executor = None
+        try:
+            files = []                  # (stream ID, mapping, payload size)
+            for stream_id, file_path in streams:
+                with open(file_path, 'rb') as file:
+                    # mmap can't map an empty file
+                    mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(file.fileno()).st_size else b""
+                if mapping:
+                    if hasattr(mmap, "MADV_SEQUENTIAL"):
+                        mapping.madvise(mmap.MADV_SEQUENTIAL)      # Read ahead aggressively, drop pages behind
+                    mappings.append(mapping)
+                application_bytes[stream_id] = len(mapping)
+                files.append((stream_id, mapping, self.payload_size if self.packet_sizes is None else generate_payload_size(*self.packet_sizes, self.random)))
+
+            while True:
+                executor = None if self.codec is None else concurrent.futures.ThreadPoolExecutor(os.cpu_count() or 1, "compress")
+                for stream_id, mapping, packet_size in files:
+                    if executor is None:
+                        stream_scheduler.add_stream(stream_id, file_chunks(memoryview(mapping), packet_size))
+                    else:
+                        stream_scheduler.add_stream(stream_id, compression.compressed_chunks(self.codec, memoryview(mapping), packet_size, executor))
+                try:
+                    for stream, data in stream_scheduler:
+                        if stream is None:
+                            sender.wait_for_credit()
+                            continue
+                        if stream.start_time is None:
+                            stream.start_time = time.time()     # Start time of the stream
+                        if data is None:
+                            # The end of the stream - FIN on its last frame if that is still waiting for its datagram to fill up
+                            sender.end_stream(stream.stream_id, stream.bytes_sent)
+                            stream.end_time = time.time()       # End time of the stream
+                            print(f"Stream {stream.stream_id} completed: Sent {stream.bytes_sent} bytes in {stream.packets_sent} frames.")
+                            continue
+                        sender.send_frame(frames.Frame(frames.STREAM, stream.stream_id, stream.bytes_sent, data))
+                        stream.bytes_sent += len(data)
+                        stream.packets_sent += 1
+
+                    # Wait until everything (retransmissions included) is acknowledged
+                    sender.finish()
+                    break
+                except StreamsRestarted:
+                    # The rejected 0-RTT data was compressed with the ticket's codec, none of it counts - the streams start
+                    # over with the server's codec, under the limits of its answer
+                    print(f"0-RTT data rejected, resending the streams {'uncompressed' if self.codec is None else f'with {self.codec.name}'}.")
+                    if executor is not None:
+                        executor.shutdown(cancel_futures=True)
+                    stream_scheduler = sender.stream_scheduler = scheduler.StreamScheduler(max_data=self.max_data, max_stream_data=self.max_stream_data)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)      # Before the mappings go, the blocks being compressed are views of them
+            for mapping in mappings:
+                try:
+                    mapping.close()
+                except BufferError:
+                    pass        # Views of it are still alive (we got here with an exception), it is unmapped once they are gone
+
+        print(f"Sent {sender.send_queue.packets_sent} packets in {sender.send_queue.syscalls} send calls, {sender.loss_detector.packets_lost} lost and retransmitted.")
+        # Only the stats dict is shared with other threads calling send_files
+        with self.lock:
+            for stream_id, stream in stream_scheduler.streams.items():
+                self.streams_stats[stream_id] = {
+                    'start_time': stream.start_time,
+                    'end_time': stream.end_time,
+                    'bytes_sent': stream.bytes_sent,
+                    'application_bytes': application_bytes[stream_id],
+                    'packets_sent': stream.packets_sent,
+                    'packets_retransmitted': sender.retransmissions[stream_id],
+                    'flow_control_blocked': stream.blocked_count,
+                    'max_stream_data': stream.max_data,
+                    **sender.stream_stats(stream_id)
+                }
+            self.connection_stats = sender.connection_stats()
 
     def run(self, files):
         print(f"Client running on {self.server_address[0]}:{self.server_address[1]}")
-        threads = []
-        # Start a thread for each file and one for receiving acks
-        for stream_id, file in enumerate(files):
-            # Start a thread for each file to send it
-            thread = threading.Thread(target=self.send_file, args=(file, stream_id+1))
-            threads.append(thread)
-            thread.start()
-        
-        ''' Wrote to handle acks, ditched for now because it ruins performance and tests
-        # thread for receiving acks
-        ack_thread = threading.Thread(target=self.receive_acks, args=())
-        threads.append(ack_thread)    
-        ack_thread.start()          
-        '''                                            
-
-        for thread in threads:
-            thread.join()
+        # One thread owns the socket and interleaves all the streams (used to be a thread per file)
+        self.send_files([(stream_id+1, file) for stream_id, file in enumerate(files)])
 
         print("All files sent, printing stats...")
-
-        time.sleep(2)
         
         print("=========== Stats: ===========")
 
         # Sort streams by stream ID and print in order
         sorted_streams = sorted(self.streams_stats.items(), key=lambda x: x[0])
         total_bytes_sent = 0
+        total_application_bytes = sum(stats['application_bytes'] for _, stats in sorted_streams)
         total_packets_sent = 0
         avg_data_rate = 0
         avg_packet_rate = 0
         for stream_id, stats in sorted_streams:
             data_rate, packet_rate = calculate_stats(self.streams_stats[stream_id]['start_time'], self.streams_stats[stream_id]['end_time'], stats['bytes_sent'], stats['packets_sent'])
             print(f"Stream {stream_id}:")
-            print(f" - Bytes sent: {stats['bytes_sent']:,}")
+            print(f" - Bytes sent: {stats['bytes_sent']:,}" + (f" ({stats['application_bytes']:,} file bytes compressed)" if self.codec else ""))
             print(f" - Packets sent: {stats['packets_sent']:,}")
+            print(f" - Packets retransmitted: {stats['packets_retransmitted']:,}")
             print(f" - Data rate: {data_rate:,.2f} B/s")
             print(f" - Packet rate: {packet_rate:,.2f} packets/s")
+            print(f" - Avg congestion window: {stats['avg_cwnd']:,.0f} B")
+            print(f" - Avg RTT: {stats['avg_rtt'] * 1000:,.3f} ms")
+            print(f" - Flow control: blocked {stats['flow_control_blocked']:,} times, limit {stats['max_stream_data']:,} B at the end")
             print()
             total_bytes_sent += stats['bytes_sent']
             total_packets_sent += stats['packets_sent']
@@ -141,20 +650,54 @@ class Client:
 
         avg_data_rate /= len(sorted_streams)
         avg_packet_rate /= len(sorted_streams)
+        # The streams share the connection, so the aggregate rate is what the connection as a whole achieved
+        start_time = min(stats['start_time'] for _, stats in sorted_streams)
+        end_time = max(stats['end_time'] for _, stats in sorted_streams)
+        total_data_rate, total_packet_rate = calculate_stats(start_time, end_time, total_bytes_sent, total_packets_sent)
 
         # print stats of all stream together
         print("=========== Total: ===========")
         print(f" - Total bytes sent: {total_bytes_sent:,}")
         print(f" - Total packets sent: {total_packets_sent:,}")
+        if self.codec:
+            print(f" - Compression: {self.codec.name}, {total_application_bytes:,} file bytes sent as {total_bytes_sent:,} ({total_bytes_sent / max(total_application_bytes, 1):.1%})")
         print(f" - Average data rate: {avg_data_rate:,.2f} B/s")
         print(f" - Average packet rate: {avg_packet_rate:,.2f} packets/s")
+        print(f" - Aggregate data rate: {total_data_rate:,.2f} B/s")
+        print(f" - Aggregate packet rate: {total_packet_rate:,.2f} packets/s")
+        if self.connection_stats:
+            print(f" - Congestion control: {self.connection_stats['cc']}, {self.connection_stats['congestion_events']:,} congestion events, {self.connection_stats['packets_lost']:,} packets lost")
+            print(f" - Congestion window: {self.connection_stats['cwnd']:,.0f} B at the end, {self.connection_stats['max_cwnd']:,.0f} B max")
+            print(f" - RTT: {self.connection_stats['smoothed_rtt'] * 1000:,.3f} ms smoothed, {self.connection_stats['min_rtt'] * 1000:,.3f} ms min")
+            print(f" - Flow control: blocked {self.connection_stats['flow_control_blocked']:,} times by the connection limit ({self.connection_stats['max_data']:,} B at the end), {self.connection_stats['flow_control_wait']:,.3f} s waiting for credit")
+            print(f" - Max datagram size: {self.connection_stats['max_datagram_size']:,} B ({self.connection_stats['pmtu_probes']:,} path MTU probes, {self.connection_stats['pmtu_probes_lost']:,} lost)")
+            print(f" - Datagrams sent: {self.connection_stats['datagrams_sent']:,} for {total_packets_sent:,} stream frames")
+            if self.connection_stats['early_data'] is not None:
+                print(f" - Resumed: 0-RTT data {'accepted' if self.connection_stats['early_data'] else 'rejected and resent'}")
+            if self.fec is not None:
+                print(f" - FEC: {self.connection_stats['fec_parity_sent']:,} parity datagrams, groups of {self.connection_stats['fec_group_size']} at the end" + ("" if self.connection_stats['fec_loss_rate'] is None else f" for {self.connection_stats['fec_loss_rate']:.2%} loss"))
         print()
 
-        # Write average data rate and packet rate to a file, for graphing
-        with open("client_stats.txt", "a") as file:
-            file.write(f"{len(self.streams_stats)},{avg_data_rate},{avg_packet_rate}\n")
-        
-        self.socket.close()
+        self.close()
+        # For the benchmark (main.py)
+        return {
+            'streams': len(sorted_streams),
+            'bytes_sent': total_bytes_sent,
+            'application_bytes': total_application_bytes,
+            'packets_sent': total_packets_sent,
+            'packets_retransmitted': sum(stats['packets_retransmitted'] for _, stats in sorted_streams),
+            'avg_data_rate': avg_data_rate,
+            'avg_packet_rate': avg_packet_rate,
+            'data_rate': total_data_rate,
+            'packet_rate': total_packet_rate,
+        }
+
+    ################################## Private helpers ##################################
+    @staticmethod
+    def __codec_of(parameters):
+        # The codec of a CODECS transport parameter, its first one if several are offered
+        codec_ids = parameters.get(handshake.CODECS)
+        return compression.CODECS_BY_ID.get(codec_ids[0]) if codec_ids else None
 
 def calculate_stats(start_time, end_time, bytes_received, packets_received):
     time_elapsed = end_time - start_time
@@ -162,6 +705,23 @@ def calculate_stats(start_time, end_time, bytes_received, packets_received):
     packet_rate = packets_received / time_elapsed
     return data_rate, packet_rate
 
+# Phases timed by --profile (profiling.py) - the time of a phase excludes the phases it calls
+PROFILE_PHASES = [
+    (Client, "connect", "handshake"),
+    (scheduler.Stream, "refill", "read"),                   # The files' chunks - mmap slices, or waiting for compressed blocks
+    (frames.FramePacker, "add", "pack"),
+    (frames, "build_packet", "build_packet"),               # A sealed datagram's frames packed into its payload
+    (fec.FecEncoder, "protect", "fec"),
+    (api.SendQueue, "append", "serialize"),                 # Headers (struct.pack_into), and whole packets without GSO
+    (api.SendQueue, "flush", "send"),                       # The send syscalls
+    (Sender, "poll_acks", "poll_acks"),
+    (api.BatchReceiver, "recv_batch", "recv"),              # The receive syscall, waiting for ACKs included
+    (api.QuicPacket, "unpack", "parse"),
+    (Sender, "on_frame", "on_frame"),                       # ACKs and credit
+    (reliability.LossDetector, "detect_lost", "detect_lost"),
+    (Sender, "retransmit", "retransmit"),
+]
+
 if __name__ == "__main__":
     arg_parser = argparse.ArgumentParser(description="A QUIC Client.")
 
@@ -171,25 +731,58 @@ if __name__ == "__main__":
                             default=api.DEFAULT_SERVER_HOST, help="The host to connect to.")
     arg_parser.add_argument("-f", "--files", type=int,
                             default=NUM_OF_FILES, help="The number of files to generate and send, this is also the number of streams.")
-    arg_parser.add_argument("-s", "--size", type=int,
-                            default=data_generator.FILE_SIZE, help="The size of each file in MBs.")
+    arg_parser.add_argument("-s", "--size", type=float,
+                            default=data_generator.FILE_SIZE // (1024 * 1024), help="The size of each file in MBs.")
+    arg_parser.add_argument("--seed", type=int,
+                            default=data_generator.DEFAULT_SEED, help="Seed of the generated files, the same seed and size reuse the cached files.")
+    arg_parser.add_argument("--fresh-data", action="store_true",
+                            help="Generate new random files (not reproducible, not cached).")
+    arg_parser.add_argument("--clear-cache", action="store_true",
+                            help="Remove the cached files before and after the run.")
+    arg_parser.add_argument("-b", "--batch-size", type=int,
+                            default=api.DEFAULT_BATCH_SIZE, help="The max number of packets coalesced into one send syscall.")
+    arg_parser.add_argument("-w", "--window", type=int,
+                            default=DEFAULT_WINDOW, help="The max number of unacknowledged packets in flight.")
+    arg_parser.add_argument("--cc", type=str, choices=list(congestion.CONGESTION_CONTROLLERS),
+                            default=DEFAULT_CC, help="The congestion controller.")
+    arg_parser.add_argument("--unreliable", action="store_true",
+                            help="Don't wait for ACKs or retransmit, just send everything once.")
+    arg_parser.add_argument("--packet-size", type=int, nargs=2, metavar=("MIN", "MAX"),
+                            default=None, help="Range of the payload sizes, every stream picks one (reproducibly, by --seed). By default path MTU discovery sizes them.")
+    arg_parser.add_argument("--compress", type=str, choices=list(compression.CODECS),
+                            default=None, help="Compress the files with this codec, if the server accepts it.")
+    arg_parser.add_argument("--fec", type=int, nargs="?", const=0, metavar="K",
+                            default=None, help="Send a parity datagram per K datagrams, so the server can rebuild a lost one without a retransmission. Without K the group size adapts to the loss.")
+    arg_parser.add_argument("--session-cache", type=str, metavar="FILE",
+                            default=None, help="Keep the server's resumption ticket in this file, the next run sends its data in the first flight (0-RTT).")
+    arg_parser.add_argument("--json", type=str,
+                            default=None, help="Write the stats to this file as JSON.")
+    tracing.add_arguments(arg_parser)
+    profiling.add_arguments(arg_parser)
     
     args = arg_parser.parse_args()
+    tracing.configure_from_arguments(args, "client")
+    profiling.configure_from_arguments(args, "client", PROFILE_PHASES)
 
     host = args.host
     port = args.port
-    data_generator.FILE_SIZE = args.size * 1024 * 1024
 
-    # Remove all data_files to force generating new files
-    data_generator.remove_files()
+    # Remove the files of the last run, cached ones are reused unless the cache is cleared
+    data_generator.remove_files(args.clear_cache)
+
+    client = Client((host, port), args.batch_size, not args.unreliable, args.window, args.cc,
+                    None if args.packet_size is None else tuple(args.packet_size), None if args.fresh_data else args.seed, args.compress, args.fec,
+                    None if args.session_cache is None else handshake.SessionCache(args.session_cache))
 
-    client = Client((host, port))
+    totals = client.run(data_generator.generate_num_of_files(args.files, int(args.size * 1024 * 1024), None if args.fresh_data else args.seed))
 
-    client.run(data_generator.generate_num_of_files(args.files))
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({'totals': totals, 'connection': client.connection_stats, 'streams': client.streams_stats}, file)
 
 
     # Remove all data_files after sending
-    data_generator.remove_files()
+    data_generator.remove_files(args.clear_cache)
 
 
     
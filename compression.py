@@ -0,0 +1,92 @@
+import bz2
+import collections
+import itertools
+import lzma
+import zlib
+
+# Payload compression - negotiated per connection in the handshake, applied to every stream on its own
+# The sender cuts a stream's file into blocks and compresses each one as a complete member of the codec's format, in a
+# thread pool a few blocks ahead of the send loop (zlib, bz2 and lzma release the GIL), so the file is never in memory
+# and the streams' blocks are compressed in parallel. The stream is the members back to back, the receiver decompresses
+# the in order bytes as they are written out and starts a new member whenever one ends
+# Stream offsets, flow control and ACKs are all in compressed (wire) bytes, the file on the receiver is the original
+
+# Default values
+BLOCK_SIZE = 256 * 1024             # File bytes compressed as one member - big enough for the codecs, small enough to stream
+READ_AHEAD = 4                      # Blocks of a stream being compressed ahead of the send loop
+ZLIB_LEVEL = 1                      # The files are random text, higher levels gain ~3% for a 40% slower compression
+
+
+class Codec:
+    # codec_id - the byte that names it in the handshake, compress(block) - a complete member, decompressor() - a new
+    # decompression object with decompress(data), eof and unused_data (the stdlib's zlib / bz2 / lzma objects)
+    def __init__(self, name, codec_id, compress, decompressor):
+        self.name = name
+        self.codec_id = codec_id
+        self.compress = compress
+        self.decompressor = decompressor
+
+
+# Codecs by name, in order of preference - the client offers one, the server takes the first one it knows
+CODECS = {}
+CODECS_BY_ID = {}
+
+
+def register_codec(codec):
+    CODECS[codec.name] = codec
+    CODECS_BY_ID[codec.codec_id] = codec
+
+
+register_codec(Codec("zlib", 1, lambda block: zlib.compress(block, ZLIB_LEVEL), zlib.decompressobj))
+register_codec(Codec("bz2", 2, bz2.compress, bz2.BZ2Decompressor))
+register_codec(Codec("lzma", 3, lzma.compress, lzma.LZMADecompressor))
+
+
+def encode_offer(names):
+    # Handshake payload of the client - the codec IDs it can send, preferred first
+    return bytes(CODECS[name].codec_id for name in names)
+
+
+def choose(offer, supported=None):
+    # The server's pick from the client's offer, None if there is no codec both know
+    for codec_id in bytes(offer):
+        codec = CODECS_BY_ID.get(codec_id)
+        if codec is not None and (supported is None or codec.name in supported):
+            return codec
+    return None
+
+
+def compressed_chunks(codec, view, chunk_size, executor, block_size=BLOCK_SIZE, read_ahead=READ_AHEAD):
+    # The stream's chunks - the file's compressed blocks cut to chunk_size (an int, or a function returning the current
+    # payload size), read_ahead blocks are compressed by the executor ahead of the one being sent
+    size = chunk_size if callable(chunk_size) else lambda: chunk_size
+    blocks = (view[offset:offset + block_size] for offset in range(0, len(view), block_size))
+    pending = collections.deque(executor.submit(codec.compress, block) for block in itertools.islice(blocks, read_ahead))
+    while pending:
+        member = memoryview(pending.popleft().result())
+        block = next(blocks, None)
+        if block is not None:
+            pending.append(executor.submit(codec.compress, block))
+        offset = 0
+        while offset < len(member):
+            end = offset + size()
+            yield member[offset:end]
+            offset = end
+
+
+class StreamDecompressor:
+    # Decompresses a stream of members as it arrives in order, chunk by chunk
+    def __init__(self, codec):
+        self.codec = codec
+        self.decompressor = codec.decompressor()
+
+    def decompress(self, data):
+        output = []
+        while data:
+            output.append(self.decompressor.decompress(data))
+            if not self.decompressor.eof:
+                break
+            # The member ended, the rest of the data is the next one's
+            data = self.decompressor.unused_data
+            self.decompressor = self.codec.decompressor()
+        return b"".join(output)
@@ -0,0 +1,188 @@
+import math
+
+# Congestion control - drives the congestion window (bytes the sender may have in flight) from ACKs and losses
+# NewReno as in RFC 9002 Section 7 / Appendix B, CUBIC as in RFC 9438, and a token bucket pacer that spreads the window over the RTT
+
+# Constants
+DEFAULT_MAX_DATAGRAM_SIZE = 1200        # Smallest datagram every QUIC path must support
+LOSS_REDUCTION_FACTOR = 0.5             # kLossReductionFactor (NewReno)
+CUBIC_C = 0.4                           # C - scaling constant of the cubic function
+CUBIC_BETA = 0.7                        # beta_cubic - multiplicative decrease factor
+PACING_GAIN = 1.25                      # Pace a bit faster than cwnd / RTT so pacing alone never limits the window (RFC 9002 Section 7.7)
+PACING_GRANULARITY = 0.001              # Don't bother waiting less than this, seconds
+
+
+def initial_window(max_datagram_size):
+    # RFC 9002 Section 7.2
+    return min(10 * max_datagram_size, max(14720, 2 * max_datagram_size))
+
+
+class CongestionController:
+    # The interface the sender uses, this base class doesn't limit anything (--cc none)
+    name = "none"
+
+    def __init__(self, max_datagram_size=DEFAULT_MAX_DATAGRAM_SIZE):
+        self.max_datagram_size = max_datagram_size
+        self.congestion_window = math.inf
+        self.ssthresh = math.inf
+        self.congestion_events = 0
+
+    def can_send(self, bytes_in_flight):
+        return bytes_in_flight < self.congestion_window
+
+    def on_packets_acked(self, acked, now, rtt, cwnd_limited=True):
+        # cwnd_limited - the sender was using at least half the window, if not the window isn't what limits it and must not grow
+        pass
+
+    def on_packets_lost(self, lost, now):
+        pass
+
+    def on_max_datagram_size_changed(self, max_datagram_size):
+        # Path MTU discovery confirmed a bigger datagram
+        self.max_datagram_size = max_datagram_size
+
+
+class NewReno(CongestionController):
+    name = "reno"
+
+    def __init__(self, max_datagram_size=DEFAULT_MAX_DATAGRAM_SIZE):
+        super().__init__(max_datagram_size)
+        self.congestion_window = initial_window(max_datagram_size)
+        self.minimum_window = 2 * max_datagram_size
+        self.recovery_start_time = -math.inf   # Packets sent before this don't change the window (one reduction per loss event)
+        self.bytes_acked = 0                    # Acknowledged bytes counted towards the next increase in congestion avoidance
+
+    def on_packets_acked(self, acked, now, rtt, cwnd_limited=True):
+        if not cwnd_limited:
+            return
+        for sent in acked:
+            if sent.time_sent <= self.recovery_start_time:
+                continue
+            if self.congestion_window < self.ssthresh:
+                # Slow start - grows by what was acknowledged, doubles every RTT
+                self.congestion_window += sent.size
+            else:
+                # Congestion avoidance - one datagram per window acknowledged
+                self.bytes_acked += sent.size
+                if self.bytes_acked >= self.congestion_window:
+                    self.bytes_acked -= self.congestion_window
+                    self.congestion_window += self.max_datagram_size
+
+    def on_packets_lost(self, lost, now):
+        if max(sent.time_sent for sent in lost) > self.recovery_start_time:
+            self.on_congestion_event(now)
+
+    def on_max_datagram_size_changed(self, max_datagram_size):
+        # The initial window is recalculated with the new size (RFC 9002 Section 7.2), the window never shrinks because of it
+        super().on_max_datagram_size_changed(max_datagram_size)
+        self.minimum_window = 2 * max_datagram_size
+        self.congestion_window = max(self.congestion_window, initial_window(max_datagram_size))
+
+    def on_congestion_event(self, now):
+        self.recovery_start_time = now
+        self.congestion_events += 1
+        self.ssthresh = self.congestion_window * LOSS_REDUCTION_FACTOR
+        self.congestion_window = max(self.ssthresh, self.minimum_window)
+        self.bytes_acked = 0
+
+
+class Cubic(NewReno):
+    # Slow start and recovery are the same as NewReno, congestion avoidance follows the cubic function
+    # W_cubic(t) = C * (t - K)^3 + W_max, in datagrams, t is the time since the last congestion event
+    name = "cubic"
+
+    def __init__(self, max_datagram_size=DEFAULT_MAX_DATAGRAM_SIZE):
+        super().__init__(max_datagram_size)
+        self.w_max = 0.0                    # Window (datagrams) before the last reduction
+        self.k = 0.0                        # Time it takes the cubic function to get back to w_max
+        self.epoch_start = None             # Start of the current congestion avoidance epoch
+        self.w_est = 0.0                    # Window NewReno would have (datagrams), the cubic window never goes below it
+
+    def on_packets_acked(self, acked, now, rtt, cwnd_limited=True):
+        if not cwnd_limited:
+            return
+        for sent in acked:
+            if sent.time_sent <= self.recovery_start_time:
+                continue
+            if self.congestion_window < self.ssthresh:
+                self.congestion_window += sent.size
+                continue
+            if self.epoch_start is None:
+                # Left slow start without a loss, the current window is the plateau
+                self.epoch_start = now
+                self.w_max = self.congestion_window / self.max_datagram_size
+                self.k = 0.0
+                self.w_est = self.w_max
+            cwnd = self.congestion_window / self.max_datagram_size
+            t = now - self.epoch_start
+            # Where the window should be one RTT from now, growth limited to 1.5x per RTT
+            target = min(max(self.w_cubic(t + rtt.smoothed_rtt), cwnd), 1.5 * cwnd)
+            alpha = 3 * (1 - CUBIC_BETA) / (1 + CUBIC_BETA)
+            self.w_est += alpha * sent.size / self.congestion_window
+            if self.w_cubic(t) < self.w_est:
+                # Reno friendly region
+                cwnd = max(cwnd, self.w_est)
+            else:
+                cwnd += (target - cwnd) / cwnd * sent.size / self.max_datagram_size
+            self.congestion_window = cwnd * self.max_datagram_size
+
+    def on_max_datagram_size_changed(self, max_datagram_size):
+        # w_max and w_est count datagrams, of the old size
+        scale = self.max_datagram_size / max_datagram_size
+        self.w_max *= scale
+        self.w_est *= scale
+        super().on_max_datagram_size_changed(max_datagram_size)
+
+    def w_cubic(self, t):
+        return CUBIC_C * (t - self.k) ** 3 + self.w_max
+
+    def on_congestion_event(self, now):
+        cwnd = self.congestion_window / self.max_datagram_size
+        # Fast convergence - release bandwidth if the window didn't get back to the last plateau
+        if cwnd < self.w_max:
+            self.w_max = cwnd * (1 + CUBIC_BETA) / 2
+        else:
+            self.w_max = cwnd
+        self.recovery_start_time = now
+        self.congestion_events += 1
+        self.ssthresh = max(self.congestion_window * CUBIC_BETA, self.minimum_window)
+        self.congestion_window = self.ssthresh
+        self.epoch_start = now
+        # At the minimum window fast convergence can put w_max below the new window - K is 0 then, not complex
+        self.k = (max(self.w_max - self.congestion_window / self.max_datagram_size, 0) / CUBIC_C) ** (1 / 3)
+        self.w_est = self.congestion_window / self.max_datagram_size
+
+
+CONGESTION_CONTROLLERS = {
+    "reno": NewReno,
+    "cubic": Cubic,
+    "none": CongestionController,
+}
+
+
+class Pacer:
+    # Token bucket - tokens (bytes) refill at PACING_GAIN * cwnd / smoothed RTT, up to burst bytes
+    # The burst lets a whole batch go out together, so pacing doesn't undo the batched sends
+    def __init__(self, burst):
+        self.burst = burst
+        self.tokens = burst
+        self.rate = math.inf                # Bytes per second, unlimited until the first RTT sample
+        self.last_time = None
+
+    def update_rate(self, congestion_window, smoothed_rtt):
+        self.rate = PACING_GAIN * congestion_window / max(smoothed_rtt, PACING_GRANULARITY)
+
+    def time_until_send(self, size, now):
+        # Seconds to wait before size bytes may be sent, 0 if they may go now
+        if self.rate == math.inf:
+            self.tokens = self.burst
+        elif self.last_time is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+        if self.tokens >= size:
+            return 0
+        delay = (size - self.tokens) / self.rate
+        return delay if delay >= PACING_GRANULARITY else 0
+
+    def on_packet_sent(self, size):
+        self.tokens -= size
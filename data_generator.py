@@ -1,41 +1,116 @@
 import os
 import random
+import shutil
 import string
+import concurrent.futures
 
 FILES_FOLDER = "data_files"
+CACHE_FOLDER = os.path.join(FILES_FOLDER, ".cache")     # Generated files by (size, seed), kept by remove_files unless asked
 FILE_SIZE = 10 * 1024 * 1024        # 10 MB deault
+DEFAULT_SEED = 0                    # Files are reproducible by default, None for fresh random data (never cached)
+CHUNK_SIZE = 4 * 1024 * 1024        # Data is generated and written in chunks of this size
+
+# The data is made of random characters from the alphabet, generated as bytes in bulk:
+# random bytes are mapped onto the alphabet with bytes.translate, bytes the alphabet doesn't divide evenly are dropped (no bias)
+ALPHABET = (string.ascii_uppercase + string.digits).encode()
+_USABLE_BYTES = 256 // len(ALPHABET) * len(ALPHABET)
+_TRANSLATION_TABLE = bytes(ALPHABET[i % len(ALPHABET)] for i in range(_USABLE_BYTES)) + bytes(256 - _USABLE_BYTES)
+_DROPPED_BYTES = bytes(range(_USABLE_BYTES, 256))
+
+
+def _random_chunks(data_size, seed=None):
+    # Yields chunks of random alphabet bytes, data_size bytes in total
+    # With a seed the same data comes out every time (random.Random.randbytes), without one it comes from os.urandom
+    randbytes = os.urandom if seed is None else random.Random(seed).randbytes
+    while data_size > 0:
+        size = min(data_size, CHUNK_SIZE)
+        chunk = randbytes(size).translate(_TRANSLATION_TABLE, _DROPPED_BYTES)
+        while len(chunk) < size:
+            # ~1.6% of the bytes were dropped, top up
+            chunk += randbytes(size - len(chunk)).translate(_TRANSLATION_TABLE, _DROPPED_BYTES)
+        data_size -= size
+        yield chunk
 
 
 # Generate random data of a specific size, default size is 10 MB
-def generate_random_data(data_size: int = FILE_SIZE):
-    # Generate random characters to fill the data
-    data = ''.join(random.choices(string.ascii_uppercase + string.digits, k=data_size))
-    return data
+def generate_random_data(data_size: int = None, seed=None):
+    return b"".join(_random_chunks(FILE_SIZE if data_size is None else data_size, seed))
+
+
+def _generate_file(path, data_size, seed):
+    # Written to a temporary file first, so an interrupted run never leaves a partial file in the cache
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as file:
+        for chunk in _random_chunks(data_size, seed):
+            file.write(chunk)
+    os.replace(temp_path, path)
+    return path
+
+
+def file_seed(seed, index):
+    # Seed of file index (from 0) of a run - (seed, index) together, so the runs of neighbouring seeds share no files
+    return f"{seed}:{index}"
+
+
+def cached_file_path(data_size, seed, index=0):
+    return os.path.join(CACHE_FOLDER, f"{data_size}_{seed}_{index}.txt")
+
 
 # Generate a number of files with random data, default size is 10 MB per file
-def generate_num_of_files(num_of_files, size_for_each_file: int = FILE_SIZE):
-    print(f"Generating {num_of_files} files with {size_for_each_file} bytes each...")
+# File i (from 0) is generated from file_seed(seed, i) and cached, so the next run with the same size and seed reuses it
+def generate_num_of_files(num_of_files, size_for_each_file: int = None, seed=DEFAULT_SEED, processes=None):
+    if size_for_each_file is None:
+        size_for_each_file = FILE_SIZE
     # Make sure FILES_FOLDER exists
-    if not os.path.exists(FILES_FOLDER):
-        os.makedirs(FILES_FOLDER)
-    files = []
-    # Generate data and save it to files
-    for i in range(num_of_files):
-        data = generate_random_data(size_for_each_file)
-        with open(f"{FILES_FOLDER}/file_{i+1}.txt", "w") as file:
-            file.write(data)
-        # Add the file to the list of files
-        files.append(f"{FILES_FOLDER}/file_{i+1}.txt")
-    print("Files generated.")
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+    files = [f"{FILES_FOLDER}/file_{i+1}.txt" for i in range(num_of_files)]
+    if seed is None:
+        sources = [os.path.join(CACHE_FOLDER, f"random_{i+1}.txt") for i in range(num_of_files)]
+        missing = [(path, size_for_each_file, None) for path in sources]
+    else:
+        sources = [cached_file_path(size_for_each_file, seed, i) for i in range(num_of_files)]
+        missing = [(path, size_for_each_file, file_seed(seed, i)) for i, path in enumerate(sources) if not os.path.exists(path)]
+
+    if missing:
+        print(f"Generating {len(missing)} files with {size_for_each_file} bytes each ({num_of_files - len(missing)} cached)...")
+        processes = processes or min(len(missing), os.cpu_count() or 1)
+        if processes > 1:
+            # Each file is generated by its own process, generation is CPU bound
+            with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+                list(executor.map(_generate_file, *zip(*missing)))
+        else:
+            for args in missing:
+                _generate_file(*args)
+        print("Files generated.")
+    else:
+        print(f"Using {num_of_files} cached files with {size_for_each_file} bytes each.")
+
+    # The files are links to the cache (a copy where links aren't supported)
+    for source, file in zip(sources, files):
+        if os.path.exists(file):
+            os.remove(file)
+        if seed is None:
+            os.replace(source, file)
+            continue
+        try:
+            os.link(source, file)
+        except OSError:
+            shutil.copyfile(source, file)
     return files
 
-# Remove all files in the data_files folder
-def remove_files():
+# Remove all files in the data_files folder, the cache too if clear_cache
+def remove_files(clear_cache=False):
     if os.path.exists(FILES_FOLDER):
         print("Removing files...")
         for file in os.listdir(FILES_FOLDER):
-            os.remove(f"{FILES_FOLDER}/{file}")
-        os.rmdir(FILES_FOLDER)
+            path = f"{FILES_FOLDER}/{file}"
+            if os.path.isdir(path):
+                if clear_cache:
+                    shutil.rmtree(path)
+            else:
+                os.remove(path)
+        if not os.listdir(FILES_FOLDER):
+            os.rmdir(FILES_FOLDER)
         print("Files removed.")
     else:
-        print("No files to remove.")
\ No newline at end of file
+        print("No files to remove.")
@@ -0,0 +1,263 @@
+import argparse
+import heapq
+import random
+import selectors
+import socket
+import threading
+import time
+import api
+import pmtud
+
+# Network emulator - a userspace UDP proxy between the client and the server that makes loopback behave like a real path:
+# loss (independent or in bursts), delay and jitter, reordering and a bandwidth limit with a bounded queue, no root or tc/netem needed
+# Every direction is a Link, a datagram goes through: MTU -> loss -> bandwidth limit (token bucket, tail drop when the queue is full)
+# -> propagation delay + jitter -> (maybe) held back to be reordered. With a seed the same datagrams get the same fate
+#   python server.py
+#   python emulator.py --delay 0.02 --jitter 0.005 --loss 0.01 --rate 10
+#   python client.py -p 9998
+
+# Default values
+DEFAULT_PORT = api.DEFAULT_SERVER_PORT + 1     # Next to the server's
+DEFAULT_QUEUE_BYTES = 256 * 1024        # Bytes waiting for the bandwidth limit before the link drops (a router's buffer)
+DEFAULT_BUCKET_BYTES = 16 * 1024        # Burst the token bucket lets through at once
+DEFAULT_REORDER_DELAY = 0.005           # Seconds a reordered datagram is held back, the ones behind it overtake it
+POLL_INTERVAL = 0.1                     # Seconds between checks of whether the emulator was closed
+RECEIVE_BATCH = 64                      # Datagrams read from a socket at once, so a flood can't hold back the ones due to be sent
+
+
+class Bernoulli:
+    # Every datagram is lost with the same probability, independently of the others
+    def __init__(self, loss):
+        self.loss = loss
+
+    def lost(self, rng):
+        return self.loss > 0 and rng.random() < self.loss
+
+    def mean_loss(self):
+        return self.loss
+
+
+class GilbertElliott:
+    # Bursty loss - a good and a bad state, with their own loss probabilities (RFC 3611 / netem's "gemodel")
+    # p - probability to go from good to bad, r - from bad to good (the mean burst is 1 / r datagrams)
+    def __init__(self, p, r, bad_loss=1.0, good_loss=0.0):
+        self.p = p
+        self.r = r
+        self.bad_loss = bad_loss
+        self.good_loss = good_loss
+        self.bad = False
+
+    def lost(self, rng):
+        if self.bad:
+            if rng.random() < self.r:
+                self.bad = False
+        elif rng.random() < self.p:
+            self.bad = True
+        return rng.random() < (self.bad_loss if self.bad else self.good_loss)
+
+    def mean_loss(self):
+        if not self.p + self.r:
+            return self.good_loss
+        bad = self.p / (self.p + self.r)
+        return bad * self.bad_loss + (1 - bad) * self.good_loss
+
+
+class Link:
+    # One direction of the path
+    # rate - bytes per second (None - unlimited), queue - bytes that may wait for it, bucket - the burst it lets through at once
+    # delay - one way propagation delay, jitter - up to this much more or less (the order is kept), reorder - probability a
+    # datagram is held back reorder_delay seconds, mtu - IP packets bigger than this are dropped (None - no limit, as on loopback)
+    def __init__(self, loss_model=None, delay=0.0, jitter=0.0, reorder=0.0, reorder_delay=DEFAULT_REORDER_DELAY,
+                 rate=None, queue=DEFAULT_QUEUE_BYTES, bucket=DEFAULT_BUCKET_BYTES, seed=None, mtu=None):
+        self.mtu = mtu
+        self.loss_model = loss_model if loss_model is not None else Bernoulli(0.0)
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.rate = rate
+        self.queue = queue
+        self.bucket = bucket
+        self.random = random.Random(seed)
+        self.tokens = bucket
+        self.last_departure = 0.0           # When the last datagram left the bandwidth limit
+        self.last_delivery = 0.0            # Latest delivery time so far, the ones that aren't reordered never arrive before it
+        # Stats
+        self.stats = {'datagrams': 0, 'bytes': 0, 'too_big': 0, 'lost': 0, 'overflowed': 0, 'reordered': 0, 'delivered': 0}
+
+    def transmit(self, now, size):
+        # Returns when the datagram arrives at the other end, None if it is dropped
+        self.stats['datagrams'] += 1
+        self.stats['bytes'] += size
+        if self.mtu is not None and size + pmtud.UDP_IP_OVERHEAD > self.mtu:
+            self.stats['too_big'] += 1      # Don't Fragment is set, a router drops it
+            return None
+        if self.loss_model.lost(self.random):
+            self.stats['lost'] += 1
+            return None
+        departure = now
+        if self.rate is not None:
+            departure = max(now, self.last_departure)
+            tokens = min(self.bucket, self.tokens + (departure - self.last_departure) * self.rate)
+            if tokens < size:
+                departure += (size - tokens) / self.rate
+                tokens = size
+            if (departure - now) * self.rate > self.queue:
+                self.stats['overflowed'] += 1       # Tail drop, the queue is full
+                return None
+            self.tokens = tokens - size
+            self.last_departure = departure
+        arrival = departure + self.delay
+        if self.jitter:
+            arrival = max(departure, arrival + self.random.uniform(-self.jitter, self.jitter))
+        if self.reorder and self.random.random() < self.reorder:
+            self.stats['reordered'] += 1
+            arrival = max(arrival, self.last_delivery) + self.reorder_delay
+        else:
+            arrival = max(arrival, self.last_delivery)
+            self.last_delivery = arrival
+        self.stats['delivered'] += 1
+        return arrival
+
+
+class NetworkEmulator:
+    # Listens on listen_address, forwards what clients send to server_address over uplink and the server's replies over downlink
+    # Every client gets its own socket towards the server, so the server still sees one address per client
+    def __init__(self, listen_address, server_address, uplink=None, downlink=None):
+        self.server_address = server_address
+        self.uplink = uplink if uplink is not None else Link()
+        self.downlink = downlink if downlink is not None else Link()
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Bursts wait in the kernel until the emulator's thread gets to them, drops there would be loss nobody asked for
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, api.SOCKET_BUFFER_SIZE)
+        self.socket.bind(listen_address)
+        self.socket.setblocking(False)
+        self.address = self.socket.getsockname()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+        self.upstream = {}                  # Client address: its socket towards the server
+        self.in_flight = []                 # Heap of (arrival time, sequence, socket, datagram, destination)
+        self.sequence = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            now = time.monotonic()
+            while self.in_flight and self.in_flight[0][0] <= now:
+                _, _, sock, data, address = heapq.heappop(self.in_flight)
+                try:
+                    sock.sendto(data, address)
+                except OSError:
+                    pass                    # Nobody listening (yet), like a real network
+            timeout = min(self.in_flight[0][0] - now, POLL_INTERVAL) if self.in_flight else POLL_INTERVAL
+            for key, _ in self.selector.select(max(timeout, 0)):
+                self.receive(key.fileobj, key.data, time.monotonic())
+        for sock in self.upstream.values():
+            sock.close()
+        self.selector.close()
+        self.socket.close()
+
+    def receive(self, sock, client_address, now):
+        # What is waiting on the socket - client_address is None for the listening socket, else whose upstream socket it is
+        for _ in range(RECEIVE_BATCH):
+            try:
+                data, address = sock.recvfrom(api.BUFFER_SIZE)
+            except (BlockingIOError, ConnectionRefusedError):
+                return
+            if client_address is None:
+                link, out, destination = self.uplink, self.upstream_socket(address), self.server_address
+            else:
+                link, out, destination = self.downlink, self.socket, client_address
+            arrival = link.transmit(now, len(data))
+            if arrival is not None:
+                heapq.heappush(self.in_flight, (arrival, self.sequence, out, data, destination))
+                self.sequence += 1
+
+    def upstream_socket(self, client_address):
+        sock = self.upstream.get(client_address)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, api.SOCKET_BUFFER_SIZE)
+            sock.bind((self.address[0], 0))
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ, client_address)
+            self.upstream[client_address] = sock
+        return sock
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+
+
+def links(loss=0.0, burst=None, delay=0.0, jitter=0.0, reorder=0.0, reorder_delay=DEFAULT_REORDER_DELAY, rate=None,
+          queue=DEFAULT_QUEUE_BYTES, seed=None, direction="both", mtu=None):
+    # (uplink, downlink) with the same impairments in the given direction(s) - burst is Gilbert-Elliott's (p, r), loss then the
+    # good state's loss; rate is in bytes per second. The directions get different seeds so they don't drop in lockstep
+    # The MTU is a property of the path, it limits both directions
+    def link(impaired, link_seed):
+        if not impaired:
+            return Link(mtu=mtu)
+        loss_model = Bernoulli(loss) if burst is None else GilbertElliott(burst[0], burst[1], good_loss=loss)
+        return Link(loss_model, delay, jitter, reorder, reorder_delay, rate, queue, seed=link_seed, mtu=mtu)
+    return (link(direction in ("both", "up"), None if seed is None else 2 * seed),
+            link(direction in ("both", "down"), None if seed is None else 2 * seed + 1))
+
+
+def add_arguments(arg_parser):
+    # The impairment options emulator.py and the benchmark share
+    arg_parser.add_argument("--loss", type=float,
+                            default=0.0, help="Probability a datagram is lost (in the good state with --burst).")
+    arg_parser.add_argument("--burst", type=float, nargs=2, metavar=("P", "R"),
+                            default=None, help="Bursty loss (Gilbert-Elliott): P - good to bad, R - bad to good, every datagram is lost in the bad state.")
+    arg_parser.add_argument("--delay", type=float,
+                            default=0.0, help="One way delay in seconds.")
+    arg_parser.add_argument("--jitter", type=float,
+                            default=0.0, help="Up to this many seconds more or less delay.")
+    arg_parser.add_argument("--reorder", type=float,
+                            default=0.0, help="Probability a datagram is held back and overtaken by the next ones.")
+    arg_parser.add_argument("--reorder-delay", type=float,
+                            default=DEFAULT_REORDER_DELAY, help="Seconds a reordered datagram is held back.")
+    arg_parser.add_argument("--rate", type=float,
+                            default=None, help="Bandwidth limit in Mbit/s.")
+    arg_parser.add_argument("--queue", type=int,
+                            default=DEFAULT_QUEUE_BYTES, help="Bytes that may wait for the bandwidth limit, more are dropped.")
+    arg_parser.add_argument("--mtu", type=int,
+                            default=None, help="Drop IP packets bigger than this (e.g. 1500), there is no limit by default.")
+    arg_parser.add_argument("--direction", type=str, choices=["both", "up", "down"],
+                            default="both", help="Impair client to server (up), server to client (down) or both.")
+    arg_parser.add_argument("--emulator-seed", type=int,
+                            default=None, help="Seed of the loss, jitter and reordering, the same seed gives the same fate to the same datagrams.")
+
+
+def links_from_arguments(args):
+    return links(args.loss, args.burst, args.delay, args.jitter, args.reorder, args.reorder_delay,
+                 None if args.rate is None else args.rate * 1e6 / 8, args.queue, args.emulator_seed, args.direction, args.mtu)
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="A UDP proxy that emulates loss, delay, jitter, reordering and a bandwidth limit.")
+    arg_parser.add_argument("-p", "--port", type=int,
+                            default=DEFAULT_PORT, help="The port clients send to.")
+    arg_parser.add_argument("-H", "--host", type=str,
+                            default=api.DEFAULT_SERVER_HOST, help="The host to listen on.")
+    arg_parser.add_argument("-s", "--server", type=str,
+                            default=f"{api.DEFAULT_SERVER_HOST}:{api.DEFAULT_SERVER_PORT}", help="The server's HOST:PORT.")
+    add_arguments(arg_parser)
+
+    args = arg_parser.parse_args()
+
+    server_host, _, server_port = args.server.rpartition(":")
+    uplink, downlink = links_from_arguments(args)
+    emulator = NetworkEmulator((args.host, args.port), (server_host, int(server_port)), uplink, downlink)
+    print(f"Emulating on {emulator.address[0]}:{emulator.address[1]} -> {args.server}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.close()
+        for name, link in (("Uplink", uplink), ("Downlink", downlink)):
+            print(f"{name}: " + ", ".join(f"{key} {value:,}" for key, value in link.stats.items()))
@@ -0,0 +1,153 @@
+import api
+
+# Forward error correction - the sender follows every group of K datagrams with a parity datagram, the XOR of their payloads,
+# so the receiver can rebuild one lost datagram per group without waiting a round trip for the retransmission
+# Only datagrams of coalesced frames (api.FRAMES) are protected, their otherwise unused header fields carry the group:
+# stream ID - group number (from 1, 0 - not protected), offset - index in the group. The parity (api.FEC_PARITY) carries
+# the group number and how many datagrams the group has (the last one of a transfer may be short)
+# Payloads of different lengths are XORed as if padded with zeros at the end - a rebuilt payload comes out with the zeros,
+# which read as PADDING frames. The XOR is done on whole payloads at once as little endian ints (int.from_bytes), so the
+# padding is just the high order bytes and the work is a few C loops over the bytes, not a Python loop
+# K adapts to the loss the receiver sees - how many of the groups' datagrams were missing when their parity arrived (it
+# reports both counts in FEC_LOSS frames), so that a group loses about TARGET_LOSSES_PER_GROUP datagrams: few losses - big
+# groups and little parity overhead. The sender's own loss count can't be used, the rebuilt datagrams never look lost to it
+
+# Default values
+DEFAULT_GROUP_SIZE = 8                  # K until there is a loss estimate (and always, if not adaptive)
+MIN_GROUP_SIZE = 2
+MAX_GROUP_SIZE = 32
+TARGET_LOSSES_PER_GROUP = 0.25          # Expected lost datagrams per group (parity included) K is picked for
+LOSS_SAMPLE_DATAGRAMS = 64              # Datagrams sent between two loss samples
+MAX_GROUPS = 256                        # Groups the receiver keeps waiting for their missing datagrams or parity
+
+
+def group_size_for(loss_rate):
+    # K such that a group of K datagrams and the parity loses TARGET_LOSSES_PER_GROUP of them on average
+    if loss_rate <= 0:
+        return MAX_GROUP_SIZE
+    return max(MIN_GROUP_SIZE, min(MAX_GROUP_SIZE, int(TARGET_LOSSES_PER_GROUP / loss_rate) - 1))
+
+
+class FecEncoder:
+    # Sender side - protect() stamps every datagram with its group and returns the parity when the group is full
+    def __init__(self, group_size=None):
+        self.adaptive = group_size is None
+        self.group_size = DEFAULT_GROUP_SIZE if group_size is None else group_size
+        self.group = 1
+        self.count = 0                      # Datagrams in the current group so far
+        self.parity = 0                     # XOR of their payloads
+        self.parity_length = 0              # Longest payload
+        self.loss_rate = None               # Smoothed, None until the first sample
+        self.last_sample = (0, 0)           # (datagrams, missing datagrams) the receiver reported at the last sample
+        # Stats
+        self.parity_sent = 0
+
+    def protect(self, packet):
+        # Returns the group's parity packet if packet completed it
+        packet.stream_id = self.group
+        packet.pos_in_stream = self.count
+        self.parity ^= int.from_bytes(packet.joined_payload(), "little")
+        self.parity_length = max(self.parity_length, packet.payload_length)
+        self.count += 1
+        if self.count < self.group_size:
+            return None
+        return self.seal(packet.source_connection_id, packet.destination_connection_id)
+
+    def seal(self, source_id, destination_id):
+        # The parity of the datagrams of the group so far, None if there are none - the next datagram starts a new group
+        if not self.count:
+            return None
+        packet = api.QuicPacket(source_id, destination_id, self.parity.to_bytes(self.parity_length, "little"), self.group, self.count, api.FEC_PARITY)
+        self.group += 1
+        self.count = 0
+        self.parity = 0
+        self.parity_length = 0
+        self.parity_sent += 1
+        return packet
+
+    def discard(self):
+        # The datagrams of the group so far were dropped by the receiver (rejected 0-RTT data) - their parity would rebuild
+        # one of them, the next datagram starts a new group
+        if self.count:
+            self.group += 1
+            self.count = 0
+            self.parity = 0
+            self.parity_length = 0
+
+    def on_loss_counts(self, datagrams, missing):
+        # Cumulative counts of the receiver's FecDecoder, K follows the smoothed loss rate
+        datagrams_since, missing_since = datagrams - self.last_sample[0], missing - self.last_sample[1]
+        if datagrams_since < LOSS_SAMPLE_DATAGRAMS:
+            return
+        self.last_sample = (datagrams, missing)
+        sample = missing_since / datagrams_since
+        self.loss_rate = sample if self.loss_rate is None else 7 / 8 * self.loss_rate + 1 / 8 * sample
+        if self.adaptive:
+            self.group_size = group_size_for(self.loss_rate)
+
+
+class FecGroup:
+    __slots__ = ('received', 'parity', 'parity_length', 'count', 'done')
+
+    def __init__(self):
+        self.received = set()               # Indices of the datagrams that arrived
+        self.parity = 0                     # XOR of their payloads, and of the parity once it arrived
+        self.parity_length = 0
+        self.count = None                   # Datagrams in the group, known once the parity arrived
+        self.done = False                   # Nothing missing anymore (or rebuilt already)
+
+
+class FecDecoder:
+    # Receiver side, one per connection - feed it every FRAMES and FEC_PARITY packet, it returns the rebuilt datagram
+    # (a FRAMES packet) once a group is missing exactly one datagram and its parity arrived
+    def __init__(self, max_groups=MAX_GROUPS):
+        self.max_groups = max_groups
+        self.groups = {}                    # FecGroup by group number, oldest first
+        # Loss of the groups whose parity arrived, for the sender's group size
+        self.datagrams = 0
+        self.missing = 0
+        # Stats
+        self.recovered = 0
+        self.parity_received = 0
+
+    def on_data(self, packet):
+        if packet.stream_id == 0:
+            return None                     # Not protected
+        group = self.__group(packet.stream_id)
+        if group.done or packet.pos_in_stream in group.received:
+            return None
+        group.received.add(packet.pos_in_stream)
+        group.parity ^= int.from_bytes(packet.joined_payload(), "little")
+        return self.__recover(packet, group)
+
+    def on_parity(self, packet):
+        group = self.__group(packet.stream_id)
+        if group.done or group.count is not None:
+            return None
+        self.parity_received += 1
+        group.count = packet.pos_in_stream
+        group.parity ^= int.from_bytes(packet.payload, "little")
+        group.parity_length = packet.payload_length
+        self.datagrams += group.count
+        self.missing += group.count - len(group.received)
+        return self.__recover(packet, group)
+
+    ################################## Private helpers ##################################
+    def __group(self, number):
+        group = self.groups.get(number)
+        if group is None:
+            group = self.groups[number] = FecGroup()
+            if len(self.groups) > self.max_groups:
+                del self.groups[next(iter(self.groups))]
+        return group
+
+    def __recover(self, packet, group):
+        if group.count is None or len(group.received) < group.count - 1:
+            return None
+        group.done = True
+        if len(group.received) >= group.count:
+            return None                     # Nothing was lost
+        index = next(index for index in range(group.count) if index not in group.received)
+        self.recovered += 1
+        payload = group.parity.to_bytes(group.parity_length, "little")
+        return api.QuicPacket(packet.source_connection_id, packet.destination_connection_id, payload, packet.stream_id, index, api.FRAMES)
@@ -0,0 +1,59 @@
+import math
+
+# Flow control - the receiver gives the sender credit (RFC 9000 Section 4): MAX_STREAM_DATA is the offset a stream may send up to,
+# MAX_DATA the total bytes over all the streams of the connection. Credit is given back as data is written out, so the receiver's
+# memory (gap buffers, socket buffer) is bounded by the windows no matter how many streams there are
+# The windows start small and are auto-tuned: a window the sender used up within 2 RTTs is what limits it, so it is doubled
+
+# Initial limits - both sides start from these, the receiver raises them with MAX_DATA / MAX_STREAM_DATA
+INITIAL_MAX_STREAM_DATA = 512 * 1024            # initial_max_stream_data
+INITIAL_MAX_DATA = 1024 * 1024                  # initial_max_data
+# Auto-tuning stops here - a stream window never outgrows the reassembly gap buffer (reassembly.DEFAULT_MAX_BUFFERED_BYTES),
+# so data inside the window is never refused for lack of buffer space
+MAX_STREAM_WINDOW = 4 * 1024 * 1024
+MAX_CONNECTION_WINDOW = 16 * 1024 * 1024
+UPDATE_THRESHOLD = 0.5                          # Credit is given back once the sender used this fraction of the window
+AUTO_TUNE_RTTS = 2                              # A window used up within this many RTTs is doubled
+
+
+class ReceiveWindow:
+    # Receiver side credit of a stream or of a whole connection (for a connection the offsets are sums over its streams)
+    def __init__(self, window, max_window=math.inf):
+        self.window = window                # Credit given on every update
+        self.max_window = max_window        # Auto-tuning limit
+        self.max_data = window              # Limit advertised to the sender
+        self.received = 0                   # Highest offset received
+        self.consumed = 0                   # Bytes delivered in order (written out), credit is given back from here
+        self.epoch_start = None             # When the last update was sent, to measure how fast the window is used
+        # Stats
+        self.updates = 0
+        self.max_window_used = window
+
+    def allows(self, end):
+        return end <= self.max_data
+
+    def on_received(self, end):
+        # Returns how much the highest received offset grew
+        if end <= self.received:
+            return 0
+        increase = end - self.received
+        self.received = end
+        return increase
+
+    def on_consumed(self, consumed):
+        # Returns how much the consumed offset grew
+        increase = consumed - self.consumed
+        self.consumed = consumed
+        return increase
+
+    def update(self, now, rtt):
+        # The new limit to advertise, or None while the sender still has enough credit
+        if self.max_data - self.consumed > self.window * (1 - UPDATE_THRESHOLD):
+            return None
+        if self.epoch_start is not None and now - self.epoch_start < AUTO_TUNE_RTTS * rtt:
+            self.window = min(2 * self.window, self.max_window)
+            self.max_window_used = max(self.max_window_used, self.window)
+        self.epoch_start = now
+        self.max_data = self.consumed + self.window
+        self.updates += 1
+        return self.max_data
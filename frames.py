@@ -0,0 +1,198 @@
+import api
+
+# Frame layer - a FRAMES datagram carries several frames back to back (RFC 9000 Section 12.4): stream data of several
+# streams, ACKs, flow control credit and padding. The packer fills every datagram up to the target size, so small files,
+# the last chunks of streams and the ends of streams share datagrams instead of each taking one
+# Frame types are the packet types of the single frame packets, so a DATA, END_STREAM, ACK, MAX_DATA... packet reads as one frame
+# Every frame: type (1 byte), stream ID, offset, length (varints), data - what the single frame packets have in their header
+# The end of a stream is a FIN bit on its last STREAM frame (END_STREAM folded in), it takes one unit of ACK space after the data
+# A datagram's payload is never copied together: the frame headers (and data too short to be worth a buffer of its own) go
+# into one small buffer, the stream data stay views of the files, and the datagram is their list (QuicPacket.set_segments)
+# A datagram that has no room left for another frame is padded to the full size, so the full datagrams of a batch are all
+# the same size and GSO sends them in one run (a datagram of another size ends the run)
+
+# Frame types
+PADDING = 0                             # Zero bytes up to the end of the datagram
+STREAM = api.DATA
+ACK = api.ACK
+MAX_DATA = api.MAX_DATA
+MAX_STREAM_DATA = api.MAX_STREAM_DATA
+DATA_BLOCKED = api.DATA_BLOCKED
+STREAM_DATA_BLOCKED = api.STREAM_DATA_BLOCKED
+PMTU_PROBE_ACK = api.PMTU_PROBE_ACK
+FEC_LOSS = 15                           # Receiver: datagrams of the FEC groups so far (stream ID field), missing ones (offset)
+FIN_BIT = 0x80                          # On a STREAM frame - the stream ends after its data
+
+# The FRAMES packet's own header - short header and its varints (stream ID and offset: 0, or the FEC group and index)
+MAX_PACKET_OVERHEAD = api.MAX_SHORT_HEADER_SIZE
+MAX_FRAME_OVERHEAD = 1 + 3 * api.MAX_VARINT_SIZE     # A frame's type and varints, worst case
+INLINE_DATA = 64                        # Frame data shorter than this is copied next to its header instead of taking a buffer
+MAX_DATA_BUFFERS = 16                   # Frames of a datagram whose data is sent from its own buffer, the others' is copied
+PADDING_BYTES = memoryview(bytes(MAX_FRAME_OVERHEAD))      # Padding is a view of these zeros
+
+
+class Frame:
+    __slots__ = ('frame_type', 'stream_id', 'offset', 'data', 'fin')
+
+    def __init__(self, frame_type, stream_id=0, offset=0, data=b"", fin=False):
+        self.frame_type = frame_type
+        self.stream_id = stream_id
+        self.offset = offset                # STREAM: offset of the data in the stream, control frames: the value (a limit...)
+        self.data = data                    # STREAM: the data (a view, never copied until packed), ACK: the packed ranges
+        self.fin = fin
+
+    def __repr__(self):
+        return f"Frame({self.frame_type}, stream {self.stream_id}, offset {self.offset}, {len(self.data)} bytes{', FIN' if self.fin else ''})"
+
+    def size(self):
+        return 1 + api.varint_size(self.stream_id) + api.varint_size(self.offset) + api.varint_size(len(self.data)) + len(self.data)
+
+    def ack_space_length(self):
+        # The data, and one unit for the FIN (as END_STREAM)
+        return len(self.data) + self.fin
+
+    def pack_into(self, buffer, offset):
+        # Returns the offset after the frame
+        offset = self.pack_header_into(buffer, offset)
+        end = offset + len(self.data)
+        buffer[offset:end] = self.data
+        return end
+
+    def pack_header_into(self, buffer, offset):
+        # Everything but the data, returns the offset after it
+        buffer[offset] = self.frame_type | (FIN_BIT if self.fin else 0)
+        offset = api.pack_varint_into(buffer, offset + 1, self.stream_id)
+        offset = api.pack_varint_into(buffer, offset, self.offset)
+        return api.pack_varint_into(buffer, offset, len(self.data))
+
+
+def iter_frames(packet):
+    # The frames of a received packet - the data are views into the packet's buffer, valid as long as the packet is
+    if packet.packet_type != api.FRAMES:
+        if packet.packet_type == api.END_STREAM:
+            yield Frame(STREAM, packet.stream_id, packet.pos_in_stream, b"", True)
+        else:
+            yield Frame(packet.packet_type, packet.stream_id, packet.pos_in_stream, packet.payload)
+        return
+    payload = packet.joined_payload()
+    offset = 0
+    while offset < len(payload):
+        frame_type = payload[offset]
+        if frame_type == PADDING:
+            return
+        stream_id, offset = api.decode_varint(payload, offset + 1)
+        value, offset = api.decode_varint(payload, offset)
+        length, offset = api.decode_varint(payload, offset)
+        end = offset + length
+        if end > len(payload):
+            raise ValueError(f"Truncated frame: {length} bytes, {len(payload) - offset} left in the packet")
+        yield Frame(frame_type & ~FIN_BIT, stream_id, value, payload[offset:end], bool(frame_type & FIN_BIT))
+        offset = end
+
+
+def frame_headers(payload):
+    # (type byte with FIN_BIT, stream ID, offset or value, data length) of a FRAMES payload's frames, all of them or
+    # ValueError if one is malformed - no Frame objects and no data slices, for the trace
+    headers = []
+    offset = 0
+    while offset < len(payload) and payload[offset] != PADDING:
+        frame_type = payload[offset]
+        stream_id, offset = api.decode_varint(payload, offset + 1)
+        value, offset = api.decode_varint(payload, offset)
+        length, offset = api.decode_varint(payload, offset)
+        offset += length
+        if offset > len(payload):
+            raise ValueError(f"Truncated frame: {length} bytes, {len(payload) - offset + length} left in the packet")
+        headers.append((frame_type, stream_id, value, length))
+    return headers
+
+
+def build_packet(source_id, destination_id, frames, size=None, padding=0):
+    # A FRAMES packet of the frames and padding bytes of PADDING - the STREAM frames are kept on it (packet.frames) for the
+    # loss detector to track. The payload is segments: the headers in one buffer, cut where a frame's data is a buffer of its own
+    if size is None:
+        size = sum(frame.size() for frame in frames)
+    inline_size = size
+    own = 0
+    for frame in frames:
+        if len(frame.data) >= INLINE_DATA and own < MAX_DATA_BUFFERS:
+            own += 1
+            inline_size -= len(frame.data)
+    inline = bytearray(inline_size)
+    view = memoryview(inline)
+    segments = []
+    start = offset = own = 0
+    for frame in frames:
+        offset = frame.pack_header_into(inline, offset)
+        data = frame.data
+        if len(data) >= INLINE_DATA and own < MAX_DATA_BUFFERS:
+            own += 1
+            segments.append(view[start:offset])
+            segments.append(data)
+            start = offset
+        elif data:
+            inline[offset:offset + len(data)] = data
+            offset += len(data)
+    if offset > start:
+        segments.append(view[start:offset])
+    if padding:
+        segments.append(PADDING_BYTES[:padding])
+    packet = api.QuicPacket(source_id, destination_id, b"", 0, 0, api.FRAMES)
+    packet.set_segments(segments, size + padding)
+    packet.frames = [frame for frame in frames if frame.frame_type == STREAM]
+    return packet
+
+
+class FramePacker:
+    # Fills datagrams of up to max_size bytes with frames in the order they are added, a frame is never split
+    def __init__(self, source_id, destination_id, max_size):
+        self.source_id = source_id
+        self.destination_id = destination_id
+        self.max_size = max_size            # May change between frames (path MTU discovery)
+        self.frames = []                    # Frames waiting for the datagram to fill up
+        self.used = 0                       # Their size
+
+    def add(self, frame):
+        # Returns the datagram that was sealed to make room for the frame, None if it joined the waiting ones
+        size = frame.size()
+        packet = None
+        if self.frames and self.used + size > self.max_size - MAX_PACKET_OVERHEAD:
+            packet = self.seal()
+        self.frames.append(frame)
+        self.used += size
+        return packet
+
+    def end_stream(self, stream_id, offset):
+        # The stream has no data past offset - sets FIN on its last frame if that is still waiting, else adds an empty one
+        # Returns a sealed datagram like add
+        for frame in reversed(self.frames):
+            if frame.frame_type == STREAM and frame.stream_id == stream_id:
+                if frame.offset + len(frame.data) == offset:
+                    frame.fin = True
+                    return None
+                break
+        return self.add(Frame(STREAM, stream_id, offset, b"", True))
+
+    def discard(self):
+        # Drop the waiting frames without sending them
+        self.frames = []
+        self.used = 0
+
+    def seal(self):
+        # The datagram of the waiting frames, None if there are none
+        if not self.frames:
+            return None
+        room = self.max_size - MAX_PACKET_OVERHEAD - self.used
+        packet = build_packet(self.source_id, self.destination_id, self.frames, self.used, room if 0 < room < MAX_FRAME_OVERHEAD else 0)
+        self.discard()
+        return packet
+
+
+def pack(frames, source_id, destination_id, max_size):
+    # All the frames in as few datagrams as the packer makes of them
+    packer = FramePacker(source_id, destination_id, max_size)
+    packets = [packet for packet in map(packer.add, frames) if packet is not None]
+    packet = packer.seal()
+    if packet is not None:
+        packets.append(packet)
+    return packets
@@ -0,0 +1,140 @@
+import hashlib
+import hmac
+import json
+import os
+import struct
+import time
+import api
+
+# Handshake - the client's HANDSHAKE carries its transport parameters, the server's answer carries its own, each one as
+# (ID, length, value) varints like RFC 9000 Section 18.2: the biggest datagram the endpoint takes, the initial flow
+# control limits, the compression codecs. The answer also carries a resumption ticket for the next connection
+# A client that comes back with its ticket within TICKET_LIFETIME assumes the parameters it cached and sends stream
+# data right behind its handshake (0-RTT) instead of waiting a round trip for the answer. The ticket is the parameters
+# the early data is sent under, authenticated with the server's key - if it doesn't check out (expired, another server,
+# the server's limits went down, the codec isn't offered anymore) the server drops the early data and says so in its
+# answer, the client then resends it as 1-RTT data - from the streams' first byte if the server picked another codec
+
+# Transport parameter IDs
+MAX_UDP_PAYLOAD_SIZE = 0x03         # The biggest datagram the endpoint receives
+INITIAL_MAX_DATA = 0x04             # Server: flow control limit of the connection until the first MAX_DATA
+INITIAL_MAX_STREAM_DATA = 0x05      # Server: flow control limit of every stream until its first MAX_STREAM_DATA
+CODECS = 0x40                       # Client: the compression codecs it offers (IDs, preferred first), server: the one it picked (none - empty)
+RESUMPTION_TICKET = 0x41            # Server: a ticket for the next connection, client: the ticket its early data is sent under
+EARLY_DATA = 0x42                   # Server, if a ticket was presented: 1 - the early data was accepted, 0 - rejected, resend it
+
+# Default values
+MAX_UDP_PAYLOAD_SIZE_LIMIT = 65527  # The parameter's default and biggest valid value (RFC 9000 Section 18.2)
+RECEIVE_UDP_PAYLOAD_SIZE = min(api.BUFFER_SIZE, MAX_UDP_PAYLOAD_SIZE_LIMIT)     # What we advertise
+TICKET_LIFETIME = 24 * 3600         # Seconds a ticket is accepted for
+TICKET_KEY_SIZE = 32
+TICKET_KEY = os.urandom(TICKET_KEY_SIZE)    # Per server process unless a key file is given (load_ticket_key), forked workers share it
+TICKET_FORMAT = struct.Struct('!dQQB')      # Issued at (seconds since the epoch), initial max data, initial max stream data, codec ID (0 - none)
+TICKET_MAC_SIZE = 16                # Truncated HMAC-SHA256 of the fields
+
+
+def encode_parameters(parameters):
+    # parameters - {ID: int or bytes}, ints go as varints
+    payload = bytearray()
+    for parameter_id, value in parameters.items():
+        if isinstance(value, int):
+            value = api.encode_varint(value)
+        payload += api.encode_varint(parameter_id) + api.encode_varint(len(value)) + value
+    return bytes(payload)
+
+
+def decode_parameters(payload):
+    # {ID: bytes}, raises ValueError if the payload is cut short - unknown IDs are kept, the caller ignores them
+    parameters = {}
+    offset = 0
+    while offset < len(payload):
+        parameter_id, offset = api.decode_varint(payload, offset)
+        length, offset = api.decode_varint(payload, offset)
+        if offset + length > len(payload):
+            raise ValueError(f"Truncated transport parameter {parameter_id:#x}: {length} bytes, {len(payload) - offset} left")
+        parameters[parameter_id] = bytes(payload[offset:offset + length])
+        offset += length
+    return parameters
+
+
+def integer(parameters, parameter_id, default=None):
+    value = parameters.get(parameter_id)
+    return default if value is None else api.decode_varint(value)[0]
+
+
+def issue_ticket(max_data, max_stream_data, codec_id, now=None, key=TICKET_KEY):
+    fields = TICKET_FORMAT.pack(time.time() if now is None else now, max_data, max_stream_data, codec_id or 0)
+    return fields + hmac.new(key, fields, hashlib.sha256).digest()[:TICKET_MAC_SIZE]
+
+
+def load_ticket_key(path):
+    # The key in the file, a new random one is written there first if it doesn't exist - servers (and restarts of one)
+    # that share the file accept each other's tickets
+    try:
+        with open(path, "xb") as file:
+            os.chmod(path, 0o600)
+            file.write(os.urandom(TICKET_KEY_SIZE))
+    except FileExistsError:
+        pass
+    with open(path, "rb") as file:
+        key = file.read()
+    if len(key) < TICKET_KEY_SIZE:
+        raise ValueError(f"Ticket key file {path} holds {len(key)} bytes, at least {TICKET_KEY_SIZE} needed")
+    return key
+
+
+def open_ticket(ticket, now=None, key=TICKET_KEY):
+    # (max data, max stream data, codec ID or None) the ticket was issued with, None if it isn't ours or expired
+    if len(ticket) != TICKET_FORMAT.size + TICKET_MAC_SIZE:
+        return None
+    fields, mac = ticket[:TICKET_FORMAT.size], ticket[TICKET_FORMAT.size:]
+    if not hmac.compare_digest(mac, hmac.new(key, fields, hashlib.sha256).digest()[:TICKET_MAC_SIZE]):
+        return None
+    issued, max_data, max_stream_data, codec_id = TICKET_FORMAT.unpack(fields)
+    if not 0 <= (time.time() if now is None else now) - issued <= TICKET_LIFETIME:
+        return None
+    return max_data, max_stream_data, codec_id or None
+
+
+class Session:
+    # What a client remembers of a server - the last ticket, the parameters of its answer and the RTT
+    def __init__(self, ticket, parameters, rtt, received=None):
+        self.ticket = ticket
+        self.parameters = parameters        # {ID: bytes} of the server's answer
+        self.rtt = rtt
+        self.received = time.time() if received is None else received
+
+    def to_json(self):
+        return {'ticket': self.ticket.hex(), 'parameters': {str(parameter_id): value.hex() for parameter_id, value in self.parameters.items()},
+                'rtt': self.rtt, 'received': self.received}
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(bytes.fromhex(data['ticket']), {int(parameter_id): bytes.fromhex(value) for parameter_id, value in data['parameters'].items()},
+                   data['rtt'], data['received'])
+
+
+class SessionCache:
+    # Sessions by server address, kept in a JSON file if path is given so the next run of the client resumes too
+    def __init__(self, path=None):
+        self.path = path
+        self.sessions = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as file:
+                    self.sessions = {address: Session.from_json(session) for address, session in json.load(file).items()}
+            except (ValueError, KeyError):
+                self.sessions = {}          # Unreadable, start over
+
+    def get(self, address):
+        # The session to resume, None if there is none or its ticket expired
+        session = self.sessions.get(f"{address[0]}:{address[1]}")
+        if session is None or time.time() - session.received > TICKET_LIFETIME:
+            return None
+        return session
+
+    def store(self, address, session):
+        self.sessions[f"{address[0]}:{address[1]}"] = session
+        if self.path is not None:
+            with open(self.path, "w") as file:
+                json.dump({address: session.to_json() for address, session in self.sessions.items()}, file)
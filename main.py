@@ -1,78 +1,316 @@
-# This file is used to run everything and create graphs with the required data.
+# This file is used to benchmark everything and create graphs with the results.
+# Every configuration of the sweep (streams x file size x packet size x loss rate x delay) runs the server and the client as processes,
+# with the network emulator (emulator.py) between them when the sweep has any impairment,
+# warm-up runs first (not counted), then the measured repetitions. The results (with the run's metadata and 95% confidence
+# intervals) go to a JSON and a CSV file, and can be compared with a saved baseline - a regression fails the run.
+#   python main.py --streams 1 4 --sizes 1 10 --loss 0 0.01 --delay 0 0.02 --jitter 0.002 -o results.json
+#   python main.py -o results.json --baseline baseline.json --threshold 0.1
+import argparse
+import csv
+import itertools
+import json
+import math
+import os
+import platform
+import statistics
 import subprocess
+import sys
+import tempfile
+import threading
 import time
-import matplotlib.pyplot as plt
+import api
+import compression
+import data_generator
+import emulator
 
-MIN_NUM_OF_FILES = 1
-MAX_NUM_OF_FILES = 1
+# Default values
+DEFAULT_STREAMS = [1, 4]
+DEFAULT_SIZES = [1.0]                       # MB per file
+DEFAULT_PACKET_SIZES = ["auto"]             # Path MTU discovery, or MIN-MAX payload ranges
+DEFAULT_LOSS = [0.0]
+DEFAULT_DELAY = [0.0]                       # One way, seconds
+DEFAULT_REPETITIONS = 3
+DEFAULT_WARMUP = 1
+DEFAULT_THRESHOLD = 0.1                     # A metric more than 10% worse than the baseline is a regression
+DEFAULT_PORT = 9980
+READY_TIMEOUT = 10                          # Seconds the server has to start
+RUN_TIMEOUT = 300                           # Seconds a client has to send everything
 
-def start_server(port=9997):
-    # Start the server as a background process
-    server_process = subprocess.Popen(["python3", "server.py", "--port", str(port)])
+# Measured per run - name: (higher is better, description)
+METRICS = {
+    'goodput': (True, "Bytes per second delivered in order at the server"),
+    'send_rate': (True, "Bytes per second the client sent, retransmissions not included"),
+    'retransmitted': (False, "Packets the client retransmitted"),
+    'duplicates': (False, "Packets the server got more than once"),
+    'wall_time': (False, "Seconds from starting the client until it exited"),
+}
+
+# Two sided 95% quantiles of Student's t distribution by degrees of freedom, the normal one past the table
+T_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228, 2.201, 2.179, 2.160, 2.145, 2.131,
+        2.120, 2.110, 2.101, 2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045, 2.042]
+
+
+def confidence_interval(samples):
+    # (mean, half width of the 95% confidence interval) - the half width is 0 with fewer than 2 samples
+    mean = statistics.fmean(samples)
+    if len(samples) < 2:
+        return mean, 0.0
+    t = T_95[len(samples) - 2] if len(samples) - 2 < len(T_95) else 1.96
+    return mean, t * statistics.stdev(samples) / math.sqrt(len(samples))
+
+
+def parse_packet_sizes(text):
+    # "1000-2000", a single size "1200" or "auto" (None - sized by path MTU discovery)
+    if text == "auto":
+        return None
+    low, _, high = text.partition("-")
+    return int(low), int(high or low)
+
+
+def packet_sizes_str(packet_sizes):
+    return "auto" if packet_sizes is None else f"{packet_sizes[0]}-{packet_sizes[1]}"
+
+
+def config_key(config):
+    # Without compression the key stays what it was before the option existed, so older baselines still match
+    return (f"streams={config['streams']},size={config['size']},packet={packet_sizes_str(config['packet_sizes'])},"
+            f"loss={config['loss']},delay={config['delay']}" + (f",compress={config['compress']}" if config['compress'] else ""))
+
+
+def impaired(config, network):
+    return bool(config['loss'] or config['delay'] or any(network.values()))
+
+
+def start_server(port, stats_file):
+    # Starts the server and waits until it says it is running (no fixed sleep)
+    server_process = subprocess.Popen([sys.executable, "-u", "server.py", "--port", str(port), "--timeout", str(RUN_TIMEOUT),
+                                       "--stats-file", stats_file],
+                                      stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    deadline = time.monotonic() + READY_TIMEOUT
+    ready = threading.Event()
+
+    def read_output():
+        for line in server_process.stdout:
+            if line.startswith("Server running"):
+                ready.set()
+        # The rest is drained so the server never blocks on a full pipe
+
+    threading.Thread(target=read_output, daemon=True).start()
+    while not ready.wait(0.01):
+        if server_process.poll() is not None or time.monotonic() > deadline:
+            server_process.kill()
+            raise RuntimeError(f"The server didn't start (exit code {server_process.returncode})")
     return server_process
 
-def start_client(num_of_files=1, port=9997):
-    # Start the client as a background process
-    client_process = subprocess.Popen(["python3", "client.py", "--files", str(num_of_files), "--port", str(port)])
-    return client_process
 
-def main():
-    for i in range(1, MAX_NUM_OF_FILES+1):
-        # Start server
-        server = start_server(9980+i)
-
-        # wait for server to start
-        time.sleep(1)
-
-        print(f"Running test, with {i} files (streams)...")
-        # Start client
-        client = start_client(i, 9980+i)
-
-        # Wait client to finish
-        client.wait()
-
-        # Optionally, wait for the server to finish (if it has a termination condition)
-        server.terminate()
-        server.wait()
-
-        print(f"Test with {i} files completed...")
-    
-    # Generate graphs
-    print("Generating graphs...")
-    # client_stats.txt has all the stats in format: f"{NUM_OF_FILES},{avg_data_rate},{avg_packet_rate}\n"
- 
-    create_graphs_from_file("client_stats.txt")
-
-def create_graphs_from_file(file):
-    num_files_list = []
-    avg_data_rate_list = []
-    avg_packet_rate_list = []
-
-    # read all stats from the file that client.py produced
-    for line in open("client_stats.txt", "r"):
-        num_files, avg_data_rate, avg_packet_rate = line.split(",")
-        num_files_list.append(int(num_files))
-        avg_data_rate_list.append(float(avg_data_rate))
-        avg_packet_rate_list.append(float(avg_packet_rate))
-    # Create graphs
-    plt.figure()
-    plt.scatter(num_files_list, avg_packet_rate_list, marker='o')
-    plt.title("Average Packets per Second vs Number of Streams")
-    plt.xlabel("Number of Streams")
-    plt.ylabel("Average Packets per Second")
-    plt.grid(True)
-    plt.savefig(f"avg_packets_per_second.png")
-    plt.show()
+def run_once(config, port, seed, folder, network=None):
+    # network - the impairments besides the configuration's loss and delay (emulator.links' arguments), None to connect directly
+    server_stats_file = os.path.join(folder, "server.json")
+    client_stats_file = os.path.join(folder, "client.json")
+    server_process = start_server(port, server_stats_file)
+    proxy = None
+    client_port = port
+    try:
+        if network is not None:
+            uplink, downlink = emulator.links(config['loss'], delay=config['delay'], seed=seed, **network)
+            proxy = emulator.NetworkEmulator(("127.0.0.1", port + 1), ("127.0.0.1", port), uplink, downlink)
+            client_port = port + 1
+        start = time.monotonic()
+        packet_size = [] if config['packet_sizes'] is None else ["--packet-size", *map(str, config['packet_sizes'])]
+        compress = [] if config['compress'] is None else ["--compress", config['compress']]
+        subprocess.run([sys.executable, "client.py", "--port", str(client_port), "--files", str(config['streams']), "--size", str(config['size']),
+                        *packet_size, *compress, "--seed", str(seed), "--json", client_stats_file],
+                       stdout=subprocess.DEVNULL, check=True, timeout=RUN_TIMEOUT)
+        wall_time = time.monotonic() - start
+    finally:
+        if proxy is not None:
+            proxy.close()
+        server_process.terminate()
+        server_process.wait()
+    with open(server_stats_file) as file:
+        server_stats = json.load(file)
+    with open(client_stats_file) as file:
+        client_stats = json.load(file)
+    return {
+        'goodput': server_stats['totals']['goodput'],
+        'send_rate': client_stats['totals']['data_rate'],
+        'retransmitted': client_stats['totals']['packets_retransmitted'],
+        'duplicates': server_stats['totals']['duplicates'],
+        'wall_time': wall_time,
+    }
 
+
+def run_benchmark(configs, repetitions=DEFAULT_REPETITIONS, warmup=DEFAULT_WARMUP, port=DEFAULT_PORT, seed=data_generator.DEFAULT_SEED, network=None):
+    # Returns a result per configuration: the samples of every metric and their mean / confidence interval
+    # network - the impairments every configuration shares (emulator.links' arguments besides loss and delay). If any configuration
+    # is impaired all of them go through the emulator, so its own overhead is the same for all of them
+    network = network or {}
+    through_emulator = any(impaired(config, network) for config in configs)
+    results = []
+    with tempfile.TemporaryDirectory() as folder:
+        for config in configs:
+            key = config_key(config)
+            samples = {metric: [] for metric in METRICS}
+            for run in range(warmup + repetitions):
+                measured = run >= warmup
+                print(f"{key}: {'run ' + str(run - warmup + 1) + '/' + str(repetitions) if measured else 'warm-up'}...", flush=True)
+                # The same seed for every run of a configuration - same files, same packet sizes, same emulated loss
+                sample = run_once(config, port, seed, folder, network if through_emulator else None)
+                if measured:
+                    for metric, value in sample.items():
+                        samples[metric].append(value)
+            summary = {}
+            for metric, values in samples.items():
+                mean, half_width = confidence_interval(values)
+                summary[metric] = {'mean': mean, 'ci95': half_width, 'samples': values}
+            results.append({'key': key, 'config': config, 'metrics': summary})
+            print(f"{key}: goodput {summary['goodput']['mean'] / 1e6:,.2f} ± {summary['goodput']['ci95'] / 1e6:,.2f} MB/s", flush=True)
+    return results
+
+
+def metadata(args):
+    # What the results depend on, to tell whether two result files are comparable
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return {
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'commit': commit,
+        'dirty': dirty,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'batch_size': api.DEFAULT_BATCH_SIZE,
+        'repetitions': args.repetitions,
+        'warmup': args.warmup,
+        'seed': args.seed,
+        'network': network_arguments(args),
+    }
+
+
+def write_csv(path, results):
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["streams", "size_mb", "packet_sizes", "loss", "delay", "compress"] + [f"{metric}_{stat}" for metric in METRICS for stat in ("mean", "ci95")])
+        for result in results:
+            config = result['config']
+            writer.writerow([config['streams'], config['size'], packet_sizes_str(config['packet_sizes']), config['loss'], config['delay'], config['compress'] or "none"] +
+                            [result['metrics'][metric][stat] for metric in METRICS for stat in ("mean", "ci95")])
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    # Returns the regressions - (key, metric, baseline mean, mean, relative change) where a metric got worse by more than threshold
+    # Configurations or metrics missing on one side are skipped
+    baseline_results = {result['key']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        base = baseline_results.get(result['key'])
+        if base is None:
+            continue
+        for metric, (higher_is_better, _) in METRICS.items():
+            if metric not in base['metrics']:
+                continue
+            old, new = base['metrics'][metric]['mean'], result['metrics'][metric]['mean']
+            if old == 0:
+                continue
+            change = (new - old) / abs(old)
+            if (change < -threshold) if higher_is_better else (change > threshold):
+                regressions.append((result['key'], metric, old, new, change))
+    return regressions
+
+
+def create_graphs(results):
+    # Goodput by number of streams, one line per file size / packet size / loss rate
+    import matplotlib.pyplot as plt
     plt.figure()
-    plt.scatter(num_files_list, avg_data_rate_list, marker='o', color='r')
-    plt.title("Average Data Rate (Bits) vs Number of Streams")
+    lines = {}
+    for result in results:
+        config = result['config']
+        lines.setdefault((config['size'], packet_sizes_str(config['packet_sizes']), config['loss'], config['delay'], config['compress'] or "none"), []).append(result)
+    for (size, packet_sizes, loss, delay, compress), line in lines.items():
+        line.sort(key=lambda result: result['config']['streams'])
+        plt.errorbar([result['config']['streams'] for result in line], [result['metrics']['goodput']['mean'] / 1e6 for result in line],
+                     yerr=[result['metrics']['goodput']['ci95'] / 1e6 for result in line], marker='o', capsize=3,
+                     label=f"{size} MB, {packet_sizes} B packets, {loss:.1%} loss, {delay * 1000:g} ms delay" + ("" if compress == "none" else f", {compress}"))
+    plt.title("Goodput vs Number of Streams")
     plt.xlabel("Number of Streams")
-    plt.ylabel("Average Data Rate (Bits)")
+    plt.ylabel("Goodput (MB/s)")
     plt.grid(True)
-    plt.savefig(f"avg_data_rate.png")
-    plt.show()
+    plt.legend()
+    plt.savefig("goodput.png")
+
+
+def network_arguments(args):
+    return {'burst': args.burst, 'jitter': args.jitter, 'reorder': args.reorder, 'rate': None if args.rate is None else args.rate * 1e6 / 8,
+            'mtu': args.mtu}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark the server and the client over a sweep of configurations.")
+    arg_parser.add_argument("--streams", type=int, nargs="+",
+                            default=DEFAULT_STREAMS, help="Numbers of streams (files) to sweep.")
+    arg_parser.add_argument("--sizes", type=float, nargs="+",
+                            default=DEFAULT_SIZES, help="File sizes to sweep, in MBs.")
+    arg_parser.add_argument("--packet-sizes", type=str, nargs="+",
+                            default=DEFAULT_PACKET_SIZES, help="Payload size ranges (MIN-MAX) to sweep, auto - sized by path MTU discovery.")
+    arg_parser.add_argument("--loss", type=float, nargs="+",
+                            default=DEFAULT_LOSS, help="Loss rates to sweep (in the good state with --burst).")
+    arg_parser.add_argument("--delay", type=float, nargs="+",
+                            default=DEFAULT_DELAY, help="One way delays to sweep, in seconds.")
+    arg_parser.add_argument("--compress", type=str, nargs="+", choices=["none", *compression.CODECS],
+                            default=["none"], help="Compression codecs to sweep, none - uncompressed.")
+    arg_parser.add_argument("--burst", type=float, nargs=2, metavar=("P", "R"),
+                            default=None, help="Bursty loss (Gilbert-Elliott): P - good to bad, R - bad to good.")
+    arg_parser.add_argument("--jitter", type=float,
+                            default=0.0, help="Up to this many seconds more or less delay.")
+    arg_parser.add_argument("--reorder", type=float,
+                            default=0.0, help="Probability a datagram is reordered.")
+    arg_parser.add_argument("--rate", type=float,
+                            default=None, help="Bandwidth limit in Mbit/s.")
+    arg_parser.add_argument("--mtu", type=int,
+                            default=None, help="Path MTU (e.g. 1500), bigger datagrams are dropped.")
+    arg_parser.add_argument("-n", "--repetitions", type=int,
+                            default=DEFAULT_REPETITIONS, help="Measured runs per configuration.")
+    arg_parser.add_argument("--warmup", type=int,
+                            default=DEFAULT_WARMUP, help="Runs per configuration before the measured ones (not counted).")
+    arg_parser.add_argument("-p", "--port", type=int,
+                            default=DEFAULT_PORT, help="The port the server listens on (the emulator on the next one).")
+    arg_parser.add_argument("--seed", type=int,
+                            default=data_generator.DEFAULT_SEED, help="Seed of the files, the packet sizes and the emulator.")
+    arg_parser.add_argument("-o", "--output", type=str,
+                            default="benchmark.json", help="Where to write the results (JSON, and a CSV next to it).")
+    arg_parser.add_argument("--baseline", type=str,
+                            default=None, help="Results of an earlier run to compare with, exits with 1 on a regression.")
+    arg_parser.add_argument("--threshold", type=float,
+                            default=DEFAULT_THRESHOLD, help="Relative change of a metric's mean that counts as a regression.")
+    arg_parser.add_argument("--graphs", action="store_true",
+                            help="Plot goodput vs number of streams (needs matplotlib).")
+    args = arg_parser.parse_args()
+
+    configs = [{'streams': streams, 'size': size, 'packet_sizes': parse_packet_sizes(packet_sizes), 'loss': loss, 'delay': delay,
+                'compress': None if compress == "none" else compress}
+               for streams, size, packet_sizes, loss, delay, compress in itertools.product(args.streams, args.sizes, args.packet_sizes, args.loss, args.delay, args.compress)]
+    results = run_benchmark(configs, args.repetitions, args.warmup, args.port, args.seed, network_arguments(args))
+
+    with open(args.output, "w") as file:
+        json.dump({'metadata': metadata(args), 'metrics': {metric: description for metric, (_, description) in METRICS.items()}, 'results': results}, file, indent=2)
+    write_csv(os.path.splitext(args.output)[0] + ".csv", results)
+    print(f"Results written to {args.output}")
+    if args.graphs:
+        create_graphs(results)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.threshold)
+        for key, metric, old, new, change in regressions:
+            print(f"REGRESSION {key} {metric}: {old:,.2f} -> {new:,.2f} ({change:+.1%})")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline} (threshold {args.threshold:.0%})")
+
 
 if __name__ == "__main__":
     main()
-    # create_graphs_from_file("client_stats.txt")
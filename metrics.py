@@ -0,0 +1,239 @@
+import array
+import http.server
+import json
+import threading
+import time
+
+# Receive side statistics - what actually arrived (not what was sent), per stream and per connection, kept by the server's receive loop
+# Histograms are HDR style: log-linear buckets in fixed memory, a few % relative error, O(1) to record
+# The receive loop publishes an immutable snapshot every SNAPSHOT_INTERVAL (a reference swap), the endpoint's thread only reads
+# the latest one - a scrape never takes a lock the loop needs or makes it wait
+
+SUB_BUCKET_BITS = 5                     # 32 linear buckets per power of two (the lower half shared with the one below), ~3% error
+MAX_VALUE_BITS = 40                     # Values up to 2^40 (µs - 12 days, bytes - 1 TiB), bigger ones land in the last bucket
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+HALF_SUB_BUCKETS = SUB_BUCKETS // 2
+BUCKETS = SUB_BUCKETS + (MAX_VALUE_BITS - SUB_BUCKET_BITS) * HALF_SUB_BUCKETS
+QUANTILES = (0.5, 0.9, 0.99, 0.999)     # Reported for every histogram
+SNAPSHOT_INTERVAL = 1.0                 # Seconds between the snapshots the receive loop publishes
+
+
+def bucket_index(value):
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    if shift > MAX_VALUE_BITS - SUB_BUCKET_BITS:
+        return BUCKETS - 1
+    return SUB_BUCKETS + (shift - 1) * HALF_SUB_BUCKETS + (value >> shift) - HALF_SUB_BUCKETS
+
+
+def bucket_value(index):
+    # The middle of the values that fall into the bucket
+    if index < SUB_BUCKETS:
+        return index
+    shift = (index - SUB_BUCKETS) // HALF_SUB_BUCKETS + 1
+    top = (index - SUB_BUCKETS) % HALF_SUB_BUCKETS + HALF_SUB_BUCKETS
+    return (top << shift) + ((1 << shift) - 1) // 2
+
+
+class Histogram:
+    # Non negative integers (µs, bytes)
+    def __init__(self):
+        self.counts = array.array('Q', bytes(8 * BUCKETS))
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def record(self, value):
+        self.counts[bucket_index(value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, quantile):
+        if not self.count:
+            return 0
+        target = max(1, round(quantile * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(bucket_value(index), self.max)
+        return self.max
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0
+
+    def merge(self, other):
+        counts = self.counts
+        for index, count in enumerate(other.counts):
+            if count:
+                counts[index] += count
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def copy(self):
+        histogram = Histogram.__new__(Histogram)
+        histogram.counts = array.array('Q', self.counts)
+        histogram.count, histogram.sum, histogram.max = self.count, self.sum, self.max
+        return histogram
+
+
+class TransferMetrics:
+    # What arrived for a whole connection (or the server's, or several merged), arrival times are those of the receive batch -
+    # the packets of a batch share one, so the inter-arrival times are the gaps between the batches that brought packets (to
+    # the connection, or to the server for its totals), not within them
+    COUNTERS = ('packets', 'bytes', 'duplicates', 'gaps', 'reordered', 'delivered')
+
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0                      # Payload bytes, duplicates included
+        self.duplicates = 0                 # Packets that carried nothing new
+        self.gaps = 0                       # Packets that arrived past the highest offset so far - a hole opened before them
+        self.reordered = 0                  # Packets that arrived behind the highest offset - they filled a hole
+        self.delivered = 0                  # Bytes delivered in order (written out)
+        self.first_arrival = None
+        self.last_arrival = None
+        self.inter_arrival = Histogram()    # µs between consecutive receive batches
+        self.reorder_distance = Histogram()     # Bytes a reordered packet was behind the highest offset
+
+    def on_packet(self, now, length, duplicate=False, gap=False, reorder_distance=0):
+        if self.last_arrival is None:
+            self.first_arrival = now
+        elif now != self.last_arrival:
+            self.inter_arrival.record(int((now - self.last_arrival) * 1000000))
+        self.last_arrival = now
+        self.packets += 1
+        self.bytes += length
+        if duplicate:
+            self.duplicates += 1
+        elif gap:
+            self.gaps += 1
+        elif reorder_distance:
+            self.reordered += 1
+            self.reorder_distance.record(reorder_distance)
+
+    def merge(self, other):
+        for counter in self.COUNTERS:
+            setattr(self, counter, getattr(self, counter) + getattr(other, counter))
+        if other.first_arrival is not None:
+            self.first_arrival = other.first_arrival if self.first_arrival is None else min(self.first_arrival, other.first_arrival)
+            self.last_arrival = other.last_arrival if self.last_arrival is None else max(self.last_arrival, other.last_arrival)
+        self.inter_arrival.merge(other.inter_arrival)
+        self.reorder_distance.merge(other.reorder_distance)
+
+    def snapshot(self):
+        # Plain values and copies of the histograms, safe to hand to another thread
+        duration = self.last_arrival - self.first_arrival if self.first_arrival is not None else 0
+        snapshot = {counter: getattr(self, counter) for counter in self.COUNTERS}
+        snapshot['duration'] = duration
+        snapshot['goodput'] = self.delivered / duration if duration else 0
+        snapshot['inter_arrival'] = self.inter_arrival.copy()
+        snapshot['reorder_distance'] = self.reorder_distance.copy()
+        return snapshot
+
+
+class StreamMetrics(TransferMetrics):
+    # A stream's packets are classified by their offset against the highest one received
+    def __init__(self):
+        super().__init__()
+        self.highest_offset = 0             # End of the furthest data received
+
+    def on_data(self, now, pos, length, duplicate):
+        # Returns (gap, reorder distance) for the connection's metrics
+        end = pos + length
+        gap = not duplicate and pos > self.highest_offset
+        reorder_distance = self.highest_offset - pos if not duplicate and end <= self.highest_offset else 0
+        self.highest_offset = max(self.highest_offset, end)
+        self.on_packet(now, length, duplicate, gap, reorder_distance)
+        return gap, reorder_distance
+
+
+# region Endpoint
+def render_prometheus(snapshot):
+    # Prometheus text exposition format, the histograms as summaries (quantiles, sum, count)
+    lines = []
+    series = [({}, snapshot['totals'])]
+    for connection_id, connection in snapshot['connections'].items():
+        series.append(({'connection': connection_id}, connection))
+        for stream_id, stream in connection['streams'].items():
+            series.append(({'connection': connection_id, 'stream': str(stream_id)}, stream))
+    worker = {'worker': str(snapshot['worker'])}
+    for counter in TransferMetrics.COUNTERS:
+        name = f"quic_received_{counter}_total"
+        lines.append(f"# TYPE {name} counter")
+        lines.extend(f"{name}{_labels(worker, labels)} {values[counter]}" for labels, values in series)
+    lines.append("# TYPE quic_goodput_bytes_per_second gauge")
+    lines.extend(f"quic_goodput_bytes_per_second{_labels(worker, labels)} {values['goodput']:.1f}" for labels, values in series)
+    for key, name, scale in (('inter_arrival', 'quic_inter_arrival_seconds', 1e-6), ('reorder_distance', 'quic_reorder_distance_bytes', 1)):
+        lines.append(f"# TYPE {name} summary")
+        for labels, values in series:
+            histogram = values[key]
+            for quantile in QUANTILES:
+                lines.append(f"{name}{_labels(worker, labels, {'quantile': str(quantile)})} {histogram.percentile(quantile) * scale:g}")
+            lines.append(f"{name}_sum{_labels(worker, labels)} {histogram.sum * scale:g}")
+            lines.append(f"{name}_count{_labels(worker, labels)} {histogram.count}")
+    for key, value in snapshot['server'].items():
+        if key != 'pid':
+            lines.append(f"quic_server_{key}{_labels(worker)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def to_json(snapshot):
+    # The histograms as their percentiles
+    def convert(value):
+        if isinstance(value, Histogram):
+            return {'count': value.count, 'mean': value.mean(), 'max': value.max, **{f"p{quantile * 100:g}": value.percentile(quantile) for quantile in QUANTILES}}
+        if isinstance(value, dict):
+            return {str(key): convert(item) for key, item in value.items()}
+        return value
+    return json.dumps(convert(snapshot))
+
+
+def _labels(*label_sets):
+    labels = {}
+    for label_set in label_sets:
+        labels.update(label_set)
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}" if labels else ""
+
+
+class MetricsServer:
+    # Serves the latest published snapshot over HTTP from its own thread: /metrics (Prometheus), /metrics.json
+    def __init__(self, address, worker=0):
+        self.snapshot = {'time': time.time(), 'worker': worker, 'server': {}, 'totals': TransferMetrics().snapshot(), 'connections': {}}
+        metrics_server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                snapshot = metrics_server.snapshot      # One reference read, the snapshot is never modified after it was published
+                if self.path == "/metrics":
+                    body, content_type = render_prometheus(snapshot), "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body, content_type = to_json(snapshot), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass            # No line per scrape
+
+        self.http_server = http.server.ThreadingHTTPServer(address, Handler)
+        self.address = self.http_server.server_address
+        self.thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def publish(self, snapshot):
+        self.snapshot = snapshot
+
+    def close(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+# endregion
@@ -0,0 +1,149 @@
+import socket
+import api
+
+# Path MTU discovery - DPLPMTUD (RFC 8899): the sender finds the biggest datagram the path carries by sending padded probes,
+# the receiver acknowledges the ones that arrive. Data packets are sized by the largest acknowledged probe (the PLPMTU),
+# so they are never fragmented on a 1500 byte path, and on loopback they use the 64 KiB it can carry
+# The search tries the common sizes first (RFC 8899 Section 5.3.2) - Ethernet's, the local interface's (a loopback path takes it)
+# and jumbo frames', then narrows down with a binary search between the confirmed size and the smallest failed one
+# A probe isn't retransmitted or counted as a congestion signal (RFC 8899 Section 4.5), a size is given up on after
+# MAX_PROBES lost probes. Datagrams are sent with Don't Fragment, so a size that doesn't fit is lost instead of fragmented
+
+# Constants
+BASE_PLPMTU = 1200                  # BASE_PLPMTU - every path must carry this much (QUIC's minimum), the search starts here
+ETHERNET_PLPMTU = 1472              # 1500 byte MTU minus the IP and UDP headers
+JUMBO_PLPMTU = 8972                 # 9000 byte MTU (jumbo frames)
+DEFAULT_MAX_PLPMTU = ETHERNET_PLPMTU    # If the interface's MTU can't be read
+MAX_PROBES = 3                      # MAX_PROBES - lost probes of a size before it is given up on
+SEARCH_GRANULARITY = 32             # The search is complete once the confirmed size is this close to the smallest failed one
+PMTU_RAISE_TIMER = 600              # Seconds after a completed search before bigger sizes are tried again
+UDP_IP_OVERHEAD = 28                # IPv4 and UDP headers, the MTU is of the IP packet
+IP_MTU = getattr(socket, "IP_MTU", 14)
+IP_MTU_DISCOVER = getattr(socket, "IP_MTU_DISCOVER", 10)
+IP_PMTUDISC_PROBE = getattr(socket, "IP_PMTUDISC_PROBE", 3)     # Don't Fragment, and ignore the kernel's own path MTU
+
+# States (RFC 8899 Section 5.2)
+SEARCHING = "searching"
+SEARCH_COMPLETE = "search_complete"
+
+_PADDING = memoryview(bytes(api.MAX_UDP_PAYLOAD))
+
+
+def max_datagram_size(address):
+    # The biggest datagram the local interface towards address can send without fragmenting (Linux only, else an Ethernet guess)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        try:
+            sock.connect(address)
+            mtu = sock.getsockopt(socket.IPPROTO_IP, IP_MTU)
+        except OSError:
+            return DEFAULT_MAX_PLPMTU
+    return max(BASE_PLPMTU, min(api.MAX_UDP_PAYLOAD, mtu - UDP_IP_OVERHEAD))
+
+
+def disable_fragmentation(sock):
+    # Set Don't Fragment on everything the socket sends, a datagram too big for the path is dropped (or refused by the kernel)
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_PROBE)
+    except OSError:
+        pass                # Not Linux, the probes still find the size, fragments just aren't ruled out
+
+
+def probe_payload_length(size):
+    # Padding that makes a probe size bytes on the wire - the length's own varint is part of the size, so next to a varint
+    # boundary a few sizes can't be hit (None)
+    header_size = api.SHORT_HEADER_SIZE + api.varint_size(0) + api.varint_size(size)
+    for length_size in (1, 2, 4, 8):
+        payload_length = max(size - header_size - length_size, 0)
+        if api.varint_size(payload_length) == length_size:
+            return payload_length
+    return None
+
+
+def probe_packet(source_id, destination_id, size):
+    # A probe padded to size bytes on the wire
+    return api.QuicPacket(source_id, destination_id, _PADDING[:probe_payload_length(size)], 0, size, api.PMTU_PROBE)
+
+
+class PathMtuDiscovery:
+    # The search of one connection - the sender asks next_probe() for a probe to send, and reports the acknowledged and the
+    # refused ones. plpmtu is the biggest datagram known to get through
+    def __init__(self, max_plpmtu, base_plpmtu=BASE_PLPMTU):
+        self.max_plpmtu = max_plpmtu        # Biggest size worth probing (the local interface's limit)
+        self.plpmtu = base_plpmtu           # Confirmed size
+        self.high = max_plpmtu              # Smallest size not known to fail
+        self.state = SEARCH_COMPLETE
+        self.search_complete_time = None
+        self.candidates = []                # Common sizes to try before the binary search
+        self.probe_size = None              # Size of the probe in flight
+        self.probe_deadline = 0             # When it is lost
+        self.probe_count = 0                # Probes of that size lost so far
+        self.sizes_sent = set()             # Sizes probed, an acknowledgement of any other size is ignored
+        # Stats
+        self.probes_sent = 0
+        self.probes_lost = 0
+        if max_plpmtu > base_plpmtu:
+            self.start_search()
+
+    def start_search(self):
+        self.state = SEARCHING
+        self.high = self.max_plpmtu
+        self.candidates = [size for size in (ETHERNET_PLPMTU, self.max_plpmtu, JUMBO_PLPMTU) if size > self.plpmtu]
+
+    def next_probe(self, now, timeout):
+        # Size of the probe to send now, None if there is none to send - timeout is how long one may take (the PTO)
+        if self.state == SEARCH_COMPLETE:
+            if self.search_complete_time is None or now - self.search_complete_time < PMTU_RAISE_TIMER or self.plpmtu >= self.max_plpmtu:
+                return None
+            # Try bigger sizes again, the path may have changed
+            self.start_search()
+        if self.probe_size is not None:
+            if now < self.probe_deadline:
+                return None
+            self.probes_lost += 1
+            self.probe_count += 1
+            if self.probe_count >= MAX_PROBES:
+                self.on_probe_failed(self.probe_size, now)
+        if self.state == SEARCH_COMPLETE:
+            return None
+        if self.probe_size is None:
+            self.candidates = [size for size in self.candidates if self.plpmtu < size <= self.high]
+            size = self.candidates.pop(0) if self.candidates else (self.plpmtu + self.high + 1) // 2
+            while probe_payload_length(size) is None:
+                size -= 1
+            self.probe_size = size
+        self.probe_deadline = now + timeout
+        self.sizes_sent.add(self.probe_size)
+        self.probes_sent += 1
+        return self.probe_size
+
+    def limit(self, max_plpmtu, now):
+        # The peer takes no bigger datagrams (its max_udp_payload_size transport parameter)
+        if max_plpmtu < self.max_plpmtu:
+            self.max_plpmtu = max(max_plpmtu, self.plpmtu)
+            self.high = min(self.high, self.max_plpmtu)
+            self.check_complete(now)
+
+    def on_probe_acked(self, size, now):
+        # Returns True if the PLPMTU grew - an acknowledgement of a probe given up on as lost still counts
+        # size is what arrived, it must be the size of a probe that was sent (a corrupted or forged one doesn't count)
+        if size <= self.plpmtu or size not in self.sizes_sent:
+            return False
+        self.plpmtu = size
+        self.high = max(self.high, size)
+        if self.probe_size is not None and self.probe_size <= size:
+            self.probe_size = None
+            self.probe_count = 0
+        self.check_complete(now)
+        return True
+
+    def on_probe_failed(self, size, now):
+        # size doesn't get through - lost MAX_PROBES times, or too big for the local interface
+        self.high = min(self.high, size - 1)
+        self.probe_size = None
+        self.probe_count = 0
+        self.check_complete(now)
+
+    def check_complete(self, now):
+        if self.high - self.plpmtu < SEARCH_GRANULARITY:
+            self.state = SEARCH_COMPLETE
+            self.search_complete_time = now
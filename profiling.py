@@ -0,0 +1,220 @@
+import atexit
+import cProfile
+import collections
+import functools
+import io
+import pstats
+import threading
+import time
+import tracemalloc
+
+# Built-in profiling - where the time of a run goes, phase by phase: file reads, packing, the send and receive syscalls,
+# ACK processing, reassembly... (the phases are listed by client.py and server.py), plus the time spent waiting for locks
+# Off by default, and then free: the phases' functions are only replaced by timed wrappers (perf_counter_ns) when profiling
+# is configured, and profiling.lock() hands out plain locks. cProfile and tracemalloc can be added on top
+# Phases nest - a phase's own time excludes the phases it called, so the own times add up to the time profiled
+# Every stack of phases is also counted, written as a collapsed stack file for flame graph tools
+# (flamegraph.pl, speedscope, inferno) - one "client;send;sendmmsg <microseconds>" line per stack
+#   python client.py --profile client.folded && flamegraph.pl client.folded > client.svg
+
+# Default values
+TOP_FUNCTIONS = 15                      # Functions of the cProfile output printed in the report
+TOP_ALLOCATIONS = 10                    # Allocation sites of the tracemalloc output printed in the report
+
+ENABLED = False         # Set by configure, checked only where profiling.lock() creates a lock
+_state = None           # The run being profiled - _Profile, None if not profiling
+_originals = {}         # (owner, attribute) -> the function the timed wrapper replaced
+
+
+class _Profile:
+    def __init__(self, vantage_point, output, cprofile_path, memory):
+        self.vantage_point = vantage_point
+        self.output = output                # Collapsed stack file
+        self.cprofile_path = cprofile_path  # pstats dump of cProfile, None - cProfile is off
+        self.memory = memory                # tracemalloc on
+        self.start_ns = time.perf_counter_ns()
+        self.thread_timers = []             # Each thread's timers (_ThreadTimers), merged by the report
+        self.locks = []                     # TimedLocks handed out
+        self.local = threading.local()
+        self.profiler = None
+
+
+class _ThreadTimers:
+    # One thread's timers, only that thread updates them - no lock on the hot path
+    def __init__(self, root):
+        self.stack = []                             # [path, start ns, ns spent in nested phases] of the phases running
+        self.root = root                            # Path the thread's phases hang from
+        self.phases = collections.defaultdict(lambda: [0, 0, 0])    # phase -> [calls, total ns, own ns]
+        self.stacks = collections.Counter()         # Path of phases -> own ns
+
+
+def _timers():
+    timers = getattr(_state.local, "timers", None)
+    if timers is None:
+        thread = threading.current_thread()
+        root = (_state.vantage_point,) if thread is threading.main_thread() else (_state.vantage_point, thread.name)
+        timers = _state.local.timers = _ThreadTimers(root)
+        _state.thread_timers.append(timers)
+    return timers
+
+
+def timed(function, phase):
+    # The function, timed as phase
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _state is None:
+            return function(*args, **kwargs)        # Profiling stopped
+        timers = _timers()
+        stack = timers.stack
+        entry = [(stack[-1][0] if stack else timers.root) + (phase,), time.perf_counter_ns(), 0]
+        stack.append(entry)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter_ns() - entry[1]
+            stack.pop()
+            if stack:
+                stack[-1][2] += elapsed
+            own = elapsed - entry[2]
+            timer = timers.phases[phase]
+            timer[0] += 1
+            timer[1] += elapsed
+            timer[2] += own
+            timers.stacks[entry[0]] += own
+    return wrapper
+
+
+def instrument(phases):
+    # phases - (class or module, function name, phase) - each function is replaced by its timed wrapper, once
+    for owner, attribute, phase in phases:
+        if (owner, attribute) not in _originals:
+            _originals[(owner, attribute)] = getattr(owner, attribute)
+            setattr(owner, attribute, timed(_originals[(owner, attribute)], phase))
+
+
+class TimedLock:
+    # A lock that counts its acquisitions and how long they waited, a context manager like threading.Lock
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0                  # Acquisitions that had to wait
+        self.wait_ns = 0
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def acquire(self):
+        if not self.lock.acquire(False):
+            start = time.perf_counter_ns()
+            self.lock.acquire()
+            self.contended += 1
+            self.wait_ns += time.perf_counter_ns() - start
+        self.acquisitions += 1
+        return True
+
+    def release(self):
+        self.lock.release()
+
+
+def lock(name):
+    # A threading.Lock, a TimedLock if profiling
+    if not ENABLED:
+        return threading.Lock()
+    timed_lock = TimedLock(name)
+    _state.locks.append(timed_lock)
+    return timed_lock
+
+
+def configure(phases, vantage_point="unknown", output=None, cprofile_path=None, memory=False):
+    # Starts profiling the phases, the report is printed (and the files written) at exit or by report()
+    # Called again (in a forked worker) it starts over with new outputs
+    global ENABLED, _state
+    if _state is not None and _state.profiler is not None:
+        _state.profiler.disable()
+    ENABLED = True
+    _state = _Profile(vantage_point, output or f"{vantage_point}.folded", cprofile_path, memory)
+    instrument(phases)
+    if cprofile_path is not None:
+        _state.profiler = cProfile.Profile()
+        _state.profiler.enable()
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    atexit.register(report)
+
+
+def restart(suffix):
+    # In a forked worker process - starts over with its own outputs (FILE.suffix), the parent's timers aren't its time
+    configure([], _state.vantage_point, f"{_state.output}.{suffix}",
+              None if _state.cprofile_path is None else f"{_state.cprofile_path}.{suffix}", _state.memory)
+
+
+def report():
+    # Prints the breakdown, writes the collapsed stacks (and the cProfile dump) and stops profiling
+    global ENABLED, _state
+    state = _state
+    if state is None:
+        return
+    ENABLED = False
+    _state = None
+    wall_ns = time.perf_counter_ns() - state.start_ns
+    if state.profiler is not None:
+        state.profiler.disable()
+    phases = collections.defaultdict(lambda: [0, 0, 0])
+    stacks = collections.Counter()
+    for timers in list(state.thread_timers):
+        for phase, (calls, total, own) in timers.phases.items():
+            merged = phases[phase]
+            merged[0] += calls
+            merged[1] += total
+            merged[2] += own
+        stacks.update(timers.stacks)
+    # The main thread's time outside every phase is the root's own time, so the flame graph is as wide as the run
+    profiled = sum(sum(timers.stacks.values()) for timers in state.thread_timers if len(timers.root) == 1)
+    stacks[(state.vantage_point,)] += max(wall_ns - profiled, 0)
+
+    print(f"=========== Profile ({state.vantage_point}): ===========")
+    print(f" {'Phase':<20}{'Calls':>12}{'Total ms':>12}{'Own ms':>12}{'Own %':>8}{'Own us/call':>13}")
+    for phase, (calls, total, own) in sorted(phases.items(), key=lambda item: -item[1][2]):
+        print(f" {phase:<20}{calls:>12,}{total / 1e6:>12,.1f}{own / 1e6:>12,.1f}{own / max(wall_ns, 1):>8.1%}{own / max(calls, 1) / 1e3:>13,.2f}")
+    print(f" {'(outside phases)':<20}{'':>12}{'':>12}{stacks[(state.vantage_point,)] / 1e6:>12,.1f}{stacks[(state.vantage_point,)] / max(wall_ns, 1):>8.1%}")
+    print(f" Wall time: {wall_ns / 1e6:,.1f} ms (threads other than the main one can add up to more)")
+    for timed_lock in state.locks:
+        print(f" Lock '{timed_lock.name}': {timed_lock.acquisitions:,} acquisitions, {timed_lock.contended:,} waited, {timed_lock.wait_ns / 1e6:,.3f} ms waiting")
+    with open(state.output, "w") as file:
+        for path, own in sorted(stacks.items()):
+            if own >= 1000:
+                file.write(f"{';'.join(path)} {own // 1000}\n")
+    print(f" Collapsed stacks written to {state.output}")
+    if state.profiler is not None:
+        state.profiler.dump_stats(state.cprofile_path)
+        output = io.StringIO()
+        pstats.Stats(state.profiler, stream=output).sort_stats("cumulative").print_stats(TOP_FUNCTIONS)
+        print(output.getvalue())
+        print(f" cProfile stats written to {state.cprofile_path} (python -m pstats {state.cprofile_path})")
+    if state.memory and tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        print(f" Memory: {current / 1e6:,.1f} MB allocated at the end, {peak / 1e6:,.1f} MB peak")
+        for statistic in tracemalloc.take_snapshot().statistics("lineno")[:TOP_ALLOCATIONS]:
+            print(f"  {statistic}")
+        tracemalloc.stop()
+    print()
+
+
+def add_arguments(arg_parser):
+    # The profiling options client.py and server.py share
+    arg_parser.add_argument("--profile", type=str, nargs="?", const="", metavar="FILE",
+                            default=None, help="Time the phases of the run, print the breakdown at the end and write the collapsed stacks (for flame graphs) to FILE (by default client.folded / server.folded).")
+    arg_parser.add_argument("--profile-cprofile", type=str, metavar="FILE",
+                            default=None, help="With --profile, also run cProfile and dump its stats to FILE.")
+    arg_parser.add_argument("--profile-memory", action="store_true",
+                            help="With --profile, also trace memory allocations (tracemalloc), the top allocation sites are printed.")
+
+
+def configure_from_arguments(args, vantage_point, phases):
+    if args.profile is not None:
+        configure(phases, vantage_point, args.profile, args.profile_cprofile, args.profile_memory)
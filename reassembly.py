@@ -0,0 +1,148 @@
+import os
+
+# Server side stream reassembly - in order data goes straight to the file, out of order chunks wait in a bounded gap buffer
+# The file is never built in memory: memory per stream is the gap buffer (bounded) plus the chunks of the current batch
+
+# Default values
+DEFAULT_MAX_BUFFERED_BYTES = 4 * 1024 * 1024    # Max bytes of out of order chunks kept per stream
+PREALLOCATE_SIZE = 8 * 1024 * 1024              # The file is grown in steps of this size, then truncated to its real size
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024     # Max chunks per pwritev
+
+
+class StreamReassembler:
+    # Positions are byte offsets in the stream, chunks are written in offset order
+    # Retransmissions resend the same chunks, so an out of order chunk is a duplicate only if its offset is already buffered
+    # path None means the data is only reassembled (order, gaps, duplicates) and then discarded
+    # decompressor - a compression.StreamDecompressor the in order data goes through before it is written (None - not compressed),
+    # positions stay in stream (compressed) bytes, file_offset counts the bytes written to the file
+    def __init__(self, path=None, max_buffered_bytes=DEFAULT_MAX_BUFFERED_BYTES, decompressor=None):
+        self.path = path
+        self.max_buffered_bytes = max_buffered_bytes
+        self.decompressor = decompressor
+        self.fd = None
+        if path is not None:
+            self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.next_pos = 0                   # Offset of the next byte to be written to the file
+        self.file_offset = 0                # Bytes written so far, in order
+        self.allocated = 0                  # Bytes preallocated for the file
+        self.pending = []                   # In order chunks not written yet (views of the receive buffers, written by flush)
+        self.pending_bytes = 0
+        self.gap_buffer = {}                # Out of order chunks by offset (copies, the receive buffers are reused)
+        self.buffered_bytes = 0
+        self.end_pos = None                 # Size of the stream in bytes, known once END_STREAM arrived
+        self.closed = False
+        # Stats
+        self.duplicates = 0
+        self.dropped = 0                    # Out of order chunks refused because the gap buffer was full
+        self.max_buffered = 0               # Peak bytes in the gap buffer
+
+    @property
+    def complete(self):
+        return self.end_pos is not None and self.next_pos >= self.end_pos
+
+    def on_data(self, pos, data):
+        # Returns False if the chunk was refused (gap buffer full) - it must not be acknowledged, the sender will resend it
+        if pos + len(data) <= self.next_pos or pos in self.gap_buffer:
+            self.duplicates += 1
+            return True
+        if pos <= self.next_pos:
+            if pos < self.next_pos:
+                data = data[self.next_pos - pos:]      # Partly written already
+            self.pending.append(data)
+            self.pending_bytes += len(data)
+            self.next_pos += len(data)
+            # The chunk may have closed a gap
+            while self.next_pos in self.gap_buffer:
+                chunk = self.gap_buffer.pop(self.next_pos)
+                self.buffered_bytes -= len(chunk)
+                self.pending.append(chunk)
+                self.pending_bytes += len(chunk)
+                self.next_pos += len(chunk)
+            return True
+        if self.buffered_bytes + len(data) > self.max_buffered_bytes:
+            self.dropped += 1
+            return False
+        self.gap_buffer[pos] = bytes(data)
+        self.buffered_bytes += len(data)
+        self.max_buffered = max(self.max_buffered, self.buffered_bytes)
+        return True
+
+    def on_end(self, pos):
+        self.end_pos = pos
+
+    def gaps(self):
+        # Missing (start, end) byte ranges between what was written and the highest buffered chunk
+        gaps = []
+        expected = self.next_pos
+        for pos in sorted(self.gap_buffer):
+            if pos > expected:
+                gaps.append((expected, pos))
+            expected = max(expected, pos + len(self.gap_buffer[pos]))
+        if self.end_pos is not None and expected < self.end_pos:
+            gaps.append((expected, self.end_pos))
+        return gaps
+
+    def flush(self):
+        # Write the pending in order chunks, has to be called before the receive buffers are reused
+        if self.pending:
+            if self.decompressor is not None:
+                self.pending = [self.decompressor.decompress(chunk) for chunk in self.pending]
+                self.pending_bytes = sum(len(chunk) for chunk in self.pending)
+            if self.fd is not None:
+                self.__write(self.pending, self.pending_bytes)
+            self.file_offset += self.pending_bytes
+            self.pending = []
+            self.pending_bytes = 0
+        if self.complete and not self.closed:
+            self.close()
+
+    def close(self):
+        self.closed = True
+        self.gap_buffer.clear()
+        self.buffered_bytes = 0
+        if self.fd is not None:
+            # Drop what was preallocated but never written
+            os.ftruncate(self.fd, self.file_offset)
+            os.close(self.fd)
+            self.fd = None
+
+    ################################## Private helpers ##################################
+    def __write(self, chunks, size):
+        end = self.file_offset + size
+        if end > self.allocated and hasattr(os, "posix_fallocate"):
+            # Preallocate ahead, so the file system doesn't have to extend the file on every write
+            new_size = max(end, self.allocated + PREALLOCATE_SIZE)
+            try:
+                os.posix_fallocate(self.fd, self.allocated, new_size - self.allocated)
+                self.allocated = new_size
+            except OSError:
+                self.allocated = end      # Not supported by the file system, just write
+        offset = self.file_offset
+        for i in range(0, len(chunks), IOV_MAX):
+            group = chunks[i:i + IOV_MAX]
+            if hasattr(os, "pwritev"):
+                written = os.pwritev(self.fd, group, offset)
+                expected = sum(len(chunk) for chunk in group)
+                if written != expected:
+                    # Short write, finish it chunk by chunk
+                    self.__pwrite_all(group, offset, written)
+                offset += expected
+            else:
+                offset = self.__pwrite_all(group, offset, 0)
+
+    def __pwrite_all(self, chunks, offset, skip):
+        # Writes the chunks at offset, skipping the first skip bytes (already written), returns the offset after them
+        for chunk in chunks:
+            view = memoryview(chunk)
+            if skip >= len(view):
+                skip -= len(view)
+                offset += len(view)
+                continue
+            view = view[skip:]
+            offset += skip
+            skip = 0
+            while view:
+                written = os.pwrite(self.fd, view, offset)
+                view = view[written:]
+                offset += written
+        return offset
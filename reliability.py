@@ -0,0 +1,239 @@
+import bisect
+import collections
+import itertools
+import math
+
+# Reliable delivery - received ranges, RTT estimation and loss detection in the style of RFC 9002
+# Packets are identified on the wire by (stream_id, offset in stream), the sender also numbers them in send order
+# (retransmissions get a new number) so it can tell which packets were sent before the ones that were acknowledged
+# A datagram of coalesced frames (frames.py) is tracked by each of its stream frames' (stream_id, offset), it counts as
+# acknowledged once all of them are - the ACKs of the different streams come separately
+
+# Constants (RFC 9002 Section 6.1.1, 6.1.2, 6.2)
+PACKET_THRESHOLD = 3                    # kPacketThreshold - packets acknowledged after a packet before it is lost
+TIME_THRESHOLD = 9 / 8                  # kTimeThreshold - RTTs after which an unacknowledged packet is lost
+GRANULARITY = 0.001                     # kGranularity - timer granularity, seconds
+INITIAL_RTT = 0.333                     # kInitialRtt - RTT before the first sample, seconds
+MAX_ACK_DELAY = 0.025                   # max_ack_delay - the receiver acknowledges every received batch right away
+MAX_PTO_COUNT = 10                      # Consecutive probe timeouts before the sender gives up on the receiver
+
+
+class RangeSet:
+    # Sorted, non overlapping, half open [start, end) ranges of integers
+    # Adding the next integer of the last range (in order arrival) is O(1)
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def add(self, value):
+        # Returns False if the value was already in the set (a duplicate)
+        return self.add_range(value, value + 1)
+
+    def add_range(self, start, end):
+        # Returns False if nothing new was added - an empty range adds nothing (and would leave an empty range behind)
+        if start >= end:
+            return False
+        starts, ends = self.starts, self.ends
+        if starts and ends[-1] <= start:
+            if ends[-1] == start:
+                ends[-1] = end
+            else:
+                starts.append(start)
+                ends.append(end)
+            return True
+        i = bisect.bisect_left(ends, start)         # First range that ends at or after start
+        j = bisect.bisect_right(starts, end)        # Ranges from i to j touch [start, end)
+        if i < len(starts) and starts[i] <= start and end <= ends[i]:
+            return False
+        if i == j:
+            starts.insert(i, start)
+            ends.insert(i, end)
+        else:
+            starts[i:j] = [min(start, starts[i])]
+            ends[i:j] = [max(end, ends[j - 1])]
+        return True
+
+    def __contains__(self, value):
+        i = bisect.bisect_right(self.starts, value) - 1
+        return i >= 0 and value < self.ends[i]
+
+    def __iter__(self):
+        return zip(self.starts, self.ends)
+
+    def __len__(self):
+        # Number of ranges, not of integers
+        return len(self.starts)
+
+    def last(self, count):
+        # The count highest ranges, highest first
+        return list(zip(self.starts[:-count - 1:-1], self.ends[:-count - 1:-1]))
+
+
+class RttEstimator:
+    # RFC 9002 Section 5
+    def __init__(self):
+        self.latest_rtt = 0.0
+        self.min_rtt = math.inf
+        self.smoothed_rtt = INITIAL_RTT
+        self.rttvar = INITIAL_RTT / 2
+        self.has_sample = False
+
+    def update(self, sample, ack_delay=0.0):
+        self.latest_rtt = sample
+        self.min_rtt = min(self.min_rtt, sample)
+        if not self.has_sample:
+            self.has_sample = True
+            self.smoothed_rtt = sample
+            self.rttvar = sample / 2
+            return
+        # Don't subtract the ack delay below the minimum RTT
+        if sample - ack_delay >= self.min_rtt:
+            sample -= ack_delay
+        self.rttvar = 3 / 4 * self.rttvar + 1 / 4 * abs(self.smoothed_rtt - sample)
+        self.smoothed_rtt = 7 / 8 * self.smoothed_rtt + 1 / 8 * sample
+
+    def pto(self):
+        # Probe timeout (RFC 9002 Section 6.2.1)
+        return self.smoothed_rtt + max(4 * self.rttvar, GRANULARITY) + MAX_ACK_DELAY
+
+    def loss_delay(self):
+        # Time after which a packet sent before an acknowledged one is lost (RFC 9002 Section 6.1.2)
+        return max(TIME_THRESHOLD * max(self.smoothed_rtt, self.latest_rtt), GRANULARITY)
+
+
+class SentPacket:
+    __slots__ = ('number', 'packet', 'time_sent', 'size', 'retransmission', 'frames', 'arrived')
+
+    def __init__(self, number, packet, time_sent, size, retransmission):
+        self.number = number                # Send order number, local to the sender
+        self.packet = packet                # The QuicPacket, kept for retransmission
+        self.time_sent = time_sent
+        self.size = size                    # Bytes on the wire
+        self.retransmission = retransmission
+        self.frames = None                  # Coalesced datagrams - the stream frames not acknowledged yet by (stream_id, offset)
+        self.arrived = False                # One of its frames was acknowledged, it took an RTT sample already
+
+    def keys(self):
+        # The (stream_id, offset) pairs the packet is found by
+        if self.frames is None:
+            return [(self.packet.stream_id, self.packet.pos_in_stream)]
+        return list(self.frames)
+
+
+class LossDetector:
+    # Keeps the in-flight packets, processes ACK ranges and decides which packets are lost
+    def __init__(self):
+        self.rtt = RttEstimator()
+        self.in_flight = collections.OrderedDict()  # SentPacket by number, oldest first
+        self.by_stream = {}                 # stream_id -> {offset in stream: SentPacket}, to match ACK ranges
+        self.next_number = 0
+        self.largest_acked = -1             # Largest number acknowledged so far
+        self.bytes_in_flight = 0
+        self.time_of_last_sent = 0.0
+        self.pto_count = 0                  # Consecutive probe timeouts without an ACK
+        self.packet_threshold = PACKET_THRESHOLD    # Raised by FEC, so a lost packet gets the time to be rebuilt
+        # Stats
+        self.packets_acked = 0
+        self.packets_lost = 0
+
+    def on_packet_sent(self, packet, now, retransmission=False):
+        sent = SentPacket(self.next_number, packet, now, packet.size(), retransmission)
+        self.next_number += 1
+        self.in_flight[sent.number] = sent
+        if packet.frames is not None:
+            sent.frames = {(frame.stream_id, frame.offset): frame for frame in packet.frames}
+        for stream_id, offset in sent.keys():
+            self.by_stream.setdefault(stream_id, {})[offset] = sent
+        self.bytes_in_flight += sent.size
+        self.time_of_last_sent = now
+        return sent
+
+    def on_ack_received(self, stream_id, ranges, now, detect_loss=True):
+        # ranges - half open (start, end) byte ranges the receiver has, returns (acked, lost) SentPackets
+        # The receiver acknowledges a batch with one ACK per stream, when processing several ACKs pass detect_loss=False
+        # and call detect_lost once after the last one - otherwise the first ACK makes the other streams' packets look lost
+        # Frames are never split on retransmission, so a frame is acknowledged if a range holds its offset
+        stream_in_flight = self.by_stream.get(stream_id)
+        acked = []
+        arrived = []
+        if stream_in_flight and ranges:
+            ranges = sorted(ranges)
+            starts = [start for start, _ in ranges]
+            for offset in [offset for offset in stream_in_flight if offset < ranges[-1][1]]:
+                i = bisect.bisect_right(starts, offset) - 1
+                if i >= 0 and offset < ranges[i][1]:
+                    sent = stream_in_flight.pop(offset)
+                    if not sent.arrived:
+                        sent.arrived = True
+                        arrived.append(sent)
+                    if sent.frames is not None:
+                        del sent.frames[(stream_id, offset)]
+                        if sent.frames:
+                            continue        # Waiting for the other streams' ACKs
+                    self.__remove(sent)
+                    acked.append(sent)
+        self.packets_acked += len(acked)
+        if arrived:
+            self.pto_count = 0
+            newest = max(arrived, key=lambda sent: sent.number)
+            if newest.number > self.largest_acked:
+                self.largest_acked = newest.number
+                # The ACK can't tell which copy of a retransmitted packet arrived, so those give no RTT sample (Karn)
+                if not newest.retransmission:
+                    self.rtt.update(now - newest.time_sent)
+        return acked, self.detect_lost(now) if detect_loss else []
+
+    def detect_lost(self, now):
+        # Packets sent before the largest acknowledged one are lost if packet_threshold later ones were acknowledged,
+        # or if they are older than the loss delay (RFC 9002 Section 6.1)
+        lost = []
+        lost_send_time = now - self.rtt.loss_delay()
+        for number, sent in self.in_flight.items():
+            if number >= self.largest_acked:
+                break
+            if number <= self.largest_acked - self.packet_threshold or sent.time_sent <= lost_send_time:
+                lost.append(sent)
+        for sent in lost:
+            self.__forget(sent)
+        self.packets_lost += len(lost)
+        return lost
+
+    def discard_all(self):
+        # The receiver dropped everything sent so far (it rejected the 0-RTT data) - returns all of it, to be resent
+        # Not a loss, the congestion controller isn't told
+        discarded = list(self.in_flight.values())
+        for sent in discarded:
+            self.__forget(sent)
+        return discarded
+
+    def timeout_deadline(self):
+        # When on_timeout should be called if no ACK arrives, None if nothing is in flight
+        if not self.in_flight:
+            return None
+        return self.time_of_last_sent + self.rtt.pto() * (2 ** self.pto_count)
+
+    def on_timeout(self, now):
+        # Nothing was acknowledged for a whole probe timeout - returns (lost, probes): the packets lost by the thresholds,
+        # or else the oldest packets to resend as probes (we have no packet numbers on the wire, so a probe can only be a
+        # retransmission). A probe timeout is no congestion signal (RFC 9002 Section 6.2), the probes aren't counted as lost
+        lost = self.detect_lost(now)
+        if lost or not self.in_flight:
+            return lost, []
+        self.pto_count += 1
+        if self.pto_count > MAX_PTO_COUNT:
+            raise ConnectionError(f"No acknowledgement after {MAX_PTO_COUNT} probe timeouts, giving up")
+        probes = list(itertools.islice(self.in_flight.values(), 2))
+        for sent in probes:
+            self.__forget(sent)
+        return [], probes
+
+    ################################## Private helpers ##################################
+    def __forget(self, sent):
+        # Lost - its (remaining) frames are resent in new packets, which take over their offsets
+        for stream_id, offset in sent.keys():
+            self.by_stream[stream_id].pop(offset, None)
+        self.__remove(sent)
+
+    def __remove(self, sent):
+        del self.in_flight[sent.number]
+        self.bytes_in_flight -= sent.size
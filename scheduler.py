@@ -0,0 +1,123 @@
+import collections
+import itertools
+import math
+
+# Stream scheduler - one writer interleaves the frames of all open streams over a single socket
+# Used instead of a thread per stream contending on a lock for the socket
+# Flow control is respected here: a stream whose next frame would go past its limit (or the connection's) is skipped
+
+# Default values
+DEFAULT_QUANTUM = 16 * 1024             # Bytes a stream of weight 1 may send per round before the next stream gets a turn
+DEFAULT_READ_AHEAD = 16                 # Number of chunks a stream's reader produces into its queue at once
+
+
+class Stream:
+    def __init__(self, stream_id, chunks, weight=1):
+        self.stream_id = stream_id
+        self.chunks = chunks                # Iterator producing the stream's payload chunks (the reader)
+        self.weight = weight                # Share of the bandwidth relative to the other streams
+        self.queue = collections.deque()    # Frames produced by the reader, waiting for the writer
+        self.eof = False                    # The reader has nothing more to produce
+        self.deficit = 0                    # Bytes the stream may still send this round (deficit round robin)
+        self.offset = 0                     # Bytes handed to the writer so far
+        self.max_data = math.inf            # Flow control - offset the receiver lets the stream send up to (MAX_STREAM_DATA)
+        self.blocked = False                # The next frame would go past max_data
+        # Stats, filled in by the writer
+        self.bytes_sent = 0
+        self.packets_sent = 0
+        self.start_time = None
+        self.end_time = None
+        self.blocked_count = 0              # Times the stream got blocked by flow control
+
+    def refill(self, count):
+        # Let the reader produce up to count chunks into the queue
+        produced = len(self.queue)
+        self.queue.extend(itertools.islice(self.chunks, count))
+        if len(self.queue) - produced < count:
+            self.eof = True
+
+
+class StreamScheduler:
+    # Deficit round robin (weighted fair queueing in O(1) per frame):
+    # every round a stream earns quantum * weight bytes of credit and sends frames while it has credit for them
+    # With equal weights this is plain round robin by bytes, so streams with bigger packets don't get more bandwidth
+    # max_data / max_stream_data - the receiver's initial flow control limits, for the connection and for every new stream
+    def __init__(self, quantum=DEFAULT_QUANTUM, read_ahead=DEFAULT_READ_AHEAD, max_data=math.inf, max_stream_data=math.inf):
+        self.quantum = quantum
+        self.read_ahead = read_ahead
+        self.streams = {}                   # All streams by stream ID, finished ones included
+        self.active = collections.deque()   # Streams that still have frames to send, in round robin order
+        self.offset = 0                     # Bytes handed to the writer over all streams
+        self.max_data = max_data            # Flow control - bytes the receiver lets the connection send over all streams (MAX_DATA)
+        self.max_stream_data = max_stream_data
+        self.blocked = False                # The next frame would go past max_data
+        self.blocked_count = 0
+
+    def add_stream(self, stream_id, chunks, weight=1):
+        stream = Stream(stream_id, chunks, weight)
+        stream.max_data = self.max_stream_data
+        self.streams[stream_id] = stream
+        self.active.append(stream)
+        return stream
+
+    # Credit updates may arrive out of order, a limit never goes down
+    def update_max_data(self, max_data):
+        self.max_data = max(self.max_data, max_data)
+
+    def update_max_stream_data(self, stream_id, max_data):
+        stream = self.streams.get(stream_id)
+        if stream is not None:
+            stream.max_data = max(stream.max_data, max_data)
+
+    def __iter__(self):
+        # Yields (stream, chunk) in the order they should be sent, and (stream, None) once a stream has nothing left
+        # Yields (None, None) when every stream left is blocked by flow control - the caller waits for credit, then iterates on
+        active = self.active
+        blocked = 0                         # Streams in a row that were blocked
+        while active:
+            if blocked >= len(active):
+                yield None, None
+                blocked = 0
+            stream = active[0]
+            stream.deficit += self.quantum * stream.weight
+            while True:
+                if not stream.queue and not stream.eof:
+                    stream.refill(self.read_ahead)
+                if not stream.queue:
+                    # Drained - the stream leaves the rotation
+                    stream.deficit = 0
+                    active.popleft()
+                    yield stream, None
+                    break
+                size = len(stream.queue[0])
+                if self.__blocked(stream, size):
+                    # No flow control credit, the stream doesn't bank scheduling credit either
+                    stream.deficit = 0
+                    blocked += 1
+                    active.rotate(-1)
+                    break
+                blocked = 0
+                if size > stream.deficit:
+                    # Out of credit for this round, next stream
+                    active.rotate(-1)
+                    break
+                stream.deficit -= size
+                stream.offset += size
+                self.offset += size
+                yield stream, stream.queue.popleft()
+
+    ################################## Private helpers ##################################
+    def __blocked(self, stream, size):
+        if stream.offset + size > stream.max_data:
+            if not stream.blocked:
+                stream.blocked = True
+                stream.blocked_count += 1
+            return True
+        stream.blocked = False
+        if self.offset + size > self.max_data:
+            if not self.blocked:
+                self.blocked = True
+                self.blocked_count += 1
+            return True
+        self.blocked = False
+        return False
@@ -1,99 +1,578 @@
 import argparse
 import api
+import compression
+import fec
+import handshake
 import socket
+import os
+import struct
+import multiprocessing
+import reliability
+import reassembly
+import flowcontrol
+import frames
+import metrics
+import pmtud
+import profiling
+import tracing
 # import threading
 import time
+import heapq
+import signal
+import sys
 
 # Used assignment 2 as a reference for the server code
 
+DISPATCH_ADDRESS_FORMAT = struct.Struct('!4sH')     # Client address (IPv4, port) the dispatcher puts in front of every datagram it forwards
+DEFAULT_IDLE_TIMEOUT = 15                           # Seconds without a packet before a connection is dropped
+METRICS_HOST = "127.0.0.1"                          # The metrics endpoint is local only
+
+
+def stream_path(output_dir, connection_id, stream_id):
+    # A folder per connection, so different clients' streams with the same ID don't collide
+    return os.path.join(output_dir, f"{connection_id:016x}", f"received_file_{stream_id}.txt")
+
+
+class Connection:
+    # A client as seen by the server: its streams, where to send its ACKs and when it was last heard from
+    def __init__(self, server, connection_id, client_connection_id, initial_connection_id, address):
+        self.connection_id = connection_id                  # Chosen by the server, the client puts it in every packet after the handshake
+        self.client_connection_id = client_connection_id    # Chosen by the client, the server's packets carry it
+        self.initial_connection_id = initial_connection_id  # Random one the client used for its first packets, also looked up
+        self.address = address
+        self.codec = None                   # compression.Codec the streams are compressed with, picked in the handshake
+        self.handshake_answer = b""         # Our transport parameters, the same answer to a repeated handshake
+        self.early_data = None              # The client resumed with a ticket: True - its 0-RTT data is taken, False - dropped
+        self.streams = {}                   # StreamReassembler by stream ID
+        self.received = {}                  # RangeSet of received byte ranges by stream ID
+        self.ack_queue = api.SendQueue(server.socket, address, server.batch_size, 64 * 1024)
+        self.pending_frames = []            # ACK / credit frames of the batch, coalesced into datagrams when it is done
+        self.fec = fec.FecDecoder()         # Rebuilds lost datagrams from the client's parity, if it sends any
+        self.fec_reported = 0               # FEC group datagrams the client was told about
+        self.last_activity = time.monotonic()
+        # Flow control - the connection's window and one per stream (flowcontrol.ReceiveWindow by stream ID)
+        self.window = flowcontrol.ReceiveWindow(flowcontrol.INITIAL_MAX_DATA, server.max_connection_window)
+        self.stream_windows = {}
+        # RTT for auto-tuning the windows, measured from the handshake answer to the first packet sent to our connection ID
+        self.rtt = reliability.INITIAL_RTT
+        self.handshake_time = None
+        # What arrived - the connection's metrics and the streams' (metrics.StreamMetrics by stream ID)
+        self.metrics = metrics.TransferMetrics()
+        self.stream_metrics = {}
+
+    def set_address(self, address):
+        # The client's address changed (NAT rebinding), the connection ID still finds the connection
+        self.address = address
+        self.ack_queue = api.SendQueue(self.ack_queue.sock, address, self.ack_queue.batch_size, len(self.ack_queue.buffer))
+
+    def send_frames(self):
+        # The batch's frames in as few datagrams as they fit in - every path carries BASE_PLPMTU, our probes' answers included
+        if self.fec.datagrams != self.fec_reported:
+            # The client's FEC group size follows the loss we see
+            self.pending_frames.append(frames.Frame(frames.FEC_LOSS, self.fec.datagrams, self.fec.missing))
+            self.fec_reported = self.fec.datagrams
+        for packet in frames.pack(self.pending_frames, self.connection_id, self.client_connection_id, pmtud.BASE_PLPMTU):
+            self.ack_queue.append(packet)
+        self.pending_frames = []
+        self.ack_queue.flush()
+
+
 class Server:
-    def __init__(self, server_address):
+    # sock - an already bound socket to use (a worker's), receiver - what to receive the batches from (api.BatchReceiver by default)
+    # stats_queue - where a worker process puts its stats and receive metrics when it shuts down, worker_index / workers - which worker this is
+    # timeout - seconds without any packet before the server shuts down (None - never), idle_timeout - the same per connection
+    # metrics_address - where to serve the live receive metrics over HTTP (None - not served)
+    # stats_file - where to write the stats and the receive metrics as JSON when the server shuts down
+    # codecs - names of the compression codecs a client may pick (None - all of compression.CODECS, [] - no compression)
+    # ticket_key - key of the resumption tickets (None - handshake.TICKET_KEY, this process's own)
+    def __init__(self, server_address, batch_size=api.DEFAULT_BATCH_SIZE, timeout=15, output_dir=None, sock=None, receiver=None, stats_queue=None,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, worker_index=0, workers=1, metrics_address=None, stats_file=None, codecs=None,
+                 ticket_key=None):
         self.server_address = server_address
-        self.connection_id = 1  # Connection ID - using 1 bit in our implementation to allow only 2 connection IDs
-        # Create a QUIC socket
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)      # UDP socket
-        # allow the socket to be bound to an address that is already in use (if the server was restarted)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # Assign address and port to the server's socket
-        self.socket.bind(server_address)
+        self.batch_size = batch_size    # Max number of datagrams received per syscall
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.output_dir = output_dir    # Where received files are saved, None to only reassemble them
+        self.stats_queue = stats_queue
+        self.stats_file = stats_file
+        self.codecs = codecs
+        self.ticket_key = handshake.TICKET_KEY if ticket_key is None else ticket_key
+        self.worker_index = worker_index
+        self.workers = workers
+        self.stats = {'pid': os.getpid(), 'packets_received': 0, 'frames_received': 0, 'bytes_received': 0, 'bytes_delivered': 0, 'streams_completed': 0, 'duplicates': 0, 'refused': 0,
+                      'connections': 0, 'connections_evicted': 0, 'credit_updates': 0, 'flow_control_violations': 0,
+                      'fec_parity_received': 0, 'fec_recovered': 0, 'resumed': 0, 'early_data_rejected': 0}
+        # Connection table - Connection by connection ID (the server's and the client's initial one), one dict lookup per packet
+        self.connections = {}
+        # Idle eviction - heap of (deadline, connection ID), a connection that was active since is pushed back with a new deadline
+        # instead of rescheduling its timer on every packet
+        self.idle_timers = []
+        self.total_metrics = metrics.TransferMetrics()      # Every connection's packets, counted as they arrive - never merged
+        self.metrics_server = None if metrics_address is None else metrics.MetricsServer(metrics_address, worker_index)
+        self.next_snapshot = 0
+        if sock is None:
+            # Create a QUIC socket
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)      # UDP socket
+            # allow the socket to be bound to an address that is already in use (if the server was restarted)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # A bigger receive buffer absorbs bursts while the server is busy with the previous batch
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, api.SOCKET_BUFFER_SIZE)
+            # Assign address and port to the server's socket
+            self.socket.bind(server_address)
+        else:
+            self.socket = sock
+        # A connection window never grows past what the socket's receive buffer holds (the kernel reports twice the usable size),
+        # so a sender within its credit can't overrun the buffer
+        receive_buffer = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF) // 2
+        self.max_connection_window = max(flowcontrol.INITIAL_MAX_DATA, min(flowcontrol.MAX_CONNECTION_WINDOW, receive_buffer))
+        # Receives a batch of datagrams per syscall into preallocated buffers
+        self.receiver = receiver or api.BatchReceiver(self.socket, self.batch_size)
 
         # Used to make sure only one thread can modify a shared data at the same time (the thread that "holds the lock")
         # self.lock = threading.Lock()
 
         self.run()
 
-    ''' Moved printing stats to client.py, to calculate accurately even with packet loss
-    def handle_client(self, quic_packet, client_address, stream_id):
-        stream_id = quic_packet.stream_id
-        
-        if stream_id not in self.streams_data:
-            self.streams_data[stream_id] = []
-
-        self.streams_data[stream_id].append((quic_packet.pos_in_stream, quic_packet.non_binary_payload))
-
-        # If the packet signals the end of the stream, save the file (for testing purposes)
-        if quic_packet.packet_type == api.END_STREAM:
-            # Set end time for the stream
-            self.streams_stats[stream_id]['end_time'] = time.time()
-            # data_rate, packet_rate = calculate_stats(start_time, bytes_received, packets_received)
-            print(f"Stream {stream_id} completed:")
-            print(f" - Bytes received: {self.streams_stats[stream_id]['bytes_received']}")
-            print(f" - Packets received: {self.streams_stats[stream_id]['packets_received']}")
-            # print(f" - Data rate: {data_rate:.2f} B/s")
-            # print(f" - Packet rate: {packet_rate:.2f} packets/s")
-
-            # self.save_file(stream_id)           # Not required
-
-        else:   # add stats for the stream
-            if stream_id not in self.streams_stats:
-                self.streams_stats[stream_id] = {
-                    'start_time': time.time(),      # Start time of the stream
-                    'end_time': None,               # End time of the stream
-                    'bytes_received': bytes_received,
-                    'packets_received': packets_received
-                }
+    def run(self):
+        print(f"Server running on {self.server_address[0]}:{self.server_address[1]}" + (f" (pid {os.getpid()})" if self.stats_queue else ""))
+        last_packet = time.monotonic()
+        try:
+            while True:
+                now = time.monotonic()
+                self.evict_idle(now)
+                if self.metrics_server is not None and now >= self.next_snapshot:
+                    self.metrics_server.publish(self.metrics_snapshot())
+                    self.next_snapshot = now + metrics.SNAPSHOT_INTERVAL
+                # Wake up for the next eviction, snapshot or the shutdown, whichever comes first
+                wait = None if self.timeout is None else max(last_packet + self.timeout - now, 0)
+                timers = [timer for timer in (self.idle_timers[0][0] if self.idle_timers else None, self.next_snapshot if self.metrics_server else None) if timer is not None]
+                if timers:
+                    until_timer = max(min(timers) - now, 0)
+                    wait = until_timer if wait is None else min(wait, until_timer)
+                try:
+                    batch = self.receiver.recv_batch(wait)
+                except socket.timeout:
+                    if self.timeout is not None and time.monotonic() - last_packet >= self.timeout:
+                        print("Socket timed out. Closing socket.")
+                        break
+                    continue
+                except EOFError:
+                    break           # The dispatcher stopped
+                last_packet = time.monotonic()
+                self.handle_batch(batch, last_packet)
+        finally:
+            # Also on SIGTERM / Ctrl-C, so the stats are never lost
+            for connection in list(self.connections.values()):
+                self.close_connection(connection)
+            self.socket.close()
+            if self.metrics_server is not None:
+                self.metrics_server.close()
+            if self.stats_file is not None:
+                with open(self.stats_file, "w") as file:
+                    file.write(metrics.to_json(self.metrics_snapshot()))
+            if self.stats_queue is not None:
+                self.stats_queue.put((self.stats, self.total_metrics))
+
+    def handle_batch(self, batch, now):
+        # Reassemble the streams and acknowledge what was accepted
+        # The packets' payloads are views of the receive buffers, everything is written out before the next batch
+        # A datagram may carry the frames of several streams (frames.py), a single frame packet reads as one frame
+        # A datagram lost from a FEC group is rebuilt once the rest of the group and its parity arrived, and read like the others
+        to_ack = {}
+        touched = {}                # Connections that have something to send, by connection ID
+        closing = []
+        for packet, client_address in batch:
+            connection = self.connections.get(packet.destination_connection_id)
+            if packet.packet_type == api.HANDSHAKE:
+                if connection is None:
+                    connection = self.accept(packet, client_address)
+                # Also answers a repeated handshake (the answer was lost) with the same connection ID and parameters
+                connection.ack_queue.append(api.QuicPacket(connection.connection_id, connection.client_connection_id, connection.handshake_answer, 0, 0, api.HANDSHAKE))
+                if connection.handshake_time is None:
+                    connection.handshake_time = now
+                touched[connection.connection_id] = connection
+                continue
+            if connection is None:
+                continue            # Not a connection we know (evicted, or its handshake was lost)
+            connection.last_activity = now
+            if connection.handshake_time and packet.destination_connection_id == connection.connection_id:
+                connection.rtt = now - connection.handshake_time
+                connection.handshake_time = 0
+            if client_address != connection.address:
+                connection.set_address(client_address)
+            if connection.early_data is False and packet.destination_connection_id != connection.connection_id:
+                continue            # Rejected 0-RTT data, the client resends it to our connection ID
+            packet_type = packet.packet_type
+            if packet_type == api.END_CONNECTION:
+                closing.append(connection)
+                continue
+            if packet_type == api.PMTU_PROBE:
+                # It got through, the client may send datagrams of this size - the size that arrived, not the one the probe claims
+                connection.pending_frames.append(frames.Frame(frames.PMTU_PROBE_ACK, 0, packet.size()))
+                touched[connection.connection_id] = connection
+                continue
+            if packet_type == api.FEC_PARITY:
+                self.stats['fec_parity_received'] += 1
+                recovered = connection.fec.on_parity(packet)
             else:
-                self.streams_stats[stream_id]['bytes_received'] += len(quic_packet.payload)
-                self.streams_stats[stream_id]['packets_received'] += 1
-    '''
+                self.stats['packets_received'] += 1
+                self.handle_frames(connection, packet, now, to_ack, touched)
+                recovered = connection.fec.on_data(packet) if packet_type == api.FRAMES else None
+            if recovered is not None:
+                self.stats['fec_recovered'] += 1
+                self.handle_frames(connection, recovered, now, to_ack, touched)
+                touched[connection.connection_id] = connection
+        for connection, stream_id in to_ack:
+            stream = connection.streams[stream_id]
+            was_closed = stream.closed
+            stream.flush()
+            stream_metrics = connection.stream_metrics[stream_id]
+            connection.metrics.delivered += stream.file_offset - stream_metrics.delivered
+            self.total_metrics.delivered += stream.file_offset - stream_metrics.delivered
+            self.stats['bytes_delivered'] += stream.file_offset - stream_metrics.delivered
+            stream_metrics.delivered = stream.file_offset
+            if stream.closed and not was_closed:
+                self.stats['streams_completed'] += 1
+                self.stats['duplicates'] += stream.duplicates
+                self.stats['refused'] += stream.dropped
+                print(f"Stream {stream_id} of connection {connection.connection_id:016x} completed: {stream.file_offset:,} bytes{'' if stream.decompressor is None else f' ({stream.next_pos:,} compressed)'}, {stream.duplicates:,} duplicates, {stream.dropped:,} refused out of order, {stream.max_buffered:,} bytes max buffered, {connection.stream_windows[stream_id].max_window_used:,} bytes max window" + (f", saved to {stream.path}" if stream.path else ""))
+        self.ack(to_ack)
+        self.update_credit(to_ack, now)
+        for connection in touched.values():
+            connection.send_frames()
+        for connection in closing:
+            self.close_connection(connection)
 
-    def run(self):
-        print(f"Server running on {self.server_address[0]}:{self.server_address[1]}")
-        socket.setdefaulttimeout(15)
-        stream_id = 0
-        while True:
+    def handle_frames(self, connection, packet, now, to_ack, touched):
+        try:
+            for frame in frames.iter_frames(packet):
+                frame_type = frame.frame_type
+                if frame_type == frames.DATA_BLOCKED or frame_type == frames.STREAM_DATA_BLOCKED:
+                    self.answer_blocked(connection, frame)
+                    touched[connection.connection_id] = connection
+                elif frame_type == frames.STREAM and self.on_stream_frame(connection, frame, now):
+                    to_ack[(connection, frame.stream_id)] = connection.received[frame.stream_id]
+                    touched[connection.connection_id] = connection
+        except ValueError:
+            pass                    # A malformed frame, the frames after it are dropped (the ones before it are acknowledged)
+
+    def on_stream_frame(self, connection, frame, now):
+        # Returns False if the frame was refused, it isn't acknowledged then and the client resends it
+        self.stats['frames_received'] += 1
+        self.stats['bytes_received'] += len(frame.data)
+        stream_id = frame.stream_id
+        stream = connection.streams.get(stream_id)
+        if stream is None:
+            decompressor = None if connection.codec is None else compression.StreamDecompressor(connection.codec)
+            stream = connection.streams[stream_id] = reassembly.StreamReassembler(self.stream_path(connection, stream_id), decompressor=decompressor)
+            connection.received[stream_id] = reliability.RangeSet()
+            connection.stream_windows[stream_id] = flowcontrol.ReceiveWindow(flowcontrol.INITIAL_MAX_STREAM_DATA, flowcontrol.MAX_STREAM_WINDOW)
+            connection.stream_metrics[stream_id] = metrics.StreamMetrics()
+        length = len(frame.data)
+        end = frame.offset + length
+        if length:
+            window = connection.stream_windows[stream_id]
+            if not window.allows(end) or not connection.window.allows(connection.window.received + max(end - window.received, 0)):
+                # Past the credit we gave - in order data costs no memory and is written through, anything else is refused
+                self.stats['flow_control_violations'] += 1
+                if frame.offset > stream.next_pos:
+                    return False
+            if not stream.on_data(frame.offset, frame.data):
+                return False        # Gap buffer full
+            connection.window.on_received(connection.window.received + window.on_received(end))
+        if frame.fin:
+            stream.on_end(end)
+        duplicate = not connection.received[stream_id].add_range(frame.offset, end + frame.fin)
+        if length:
+            gap, reorder_distance = connection.stream_metrics[stream_id].on_data(now, frame.offset, length, duplicate)
+            connection.metrics.on_packet(now, length, duplicate, gap, reorder_distance)
+            self.total_metrics.on_packet(now, length, duplicate, gap, reorder_distance)
+        return True
+
+    def update_credit(self, to_ack, now):
+        # Give back the credit of what was written out, MAX_STREAM_DATA per stream and MAX_DATA per connection when due
+        connections = {}
+        for connection, stream_id in to_ack:
+            stream = connection.streams[stream_id]
+            window = connection.stream_windows[stream_id]
+            connection.window.on_consumed(connection.window.consumed + window.on_consumed(stream.next_pos))
+            connections[connection.connection_id] = connection
+            if stream.closed:
+                continue
+            max_data = window.update(now, connection.rtt)
+            if max_data is not None:
+                connection.pending_frames.append(frames.Frame(frames.MAX_STREAM_DATA, stream_id, max_data))
+                self.stats['credit_updates'] += 1
+        for connection in connections.values():
+            max_data = connection.window.update(now, connection.rtt)
+            if max_data is not None:
+                connection.pending_frames.append(frames.Frame(frames.MAX_DATA, 0, max_data))
+                self.stats['credit_updates'] += 1
+
+    def answer_blocked(self, connection, frame):
+        # The sender is blocked - the update that would unblock it may have been lost, repeat the current limit
+        if frame.frame_type == frames.DATA_BLOCKED:
+            connection.pending_frames.append(frames.Frame(frames.MAX_DATA, 0, connection.window.max_data))
+            return
+        window = connection.stream_windows.get(frame.stream_id)
+        max_data = flowcontrol.INITIAL_MAX_STREAM_DATA if window is None else window.max_data
+        connection.pending_frames.append(frames.Frame(frames.MAX_STREAM_DATA, frame.stream_id, max_data))
+
+    def accept(self, packet, client_address):
+        # A new connection - its ID steers to this worker, so the client's next packets come back here
+        connection_id = api.new_connection_id(self.worker_index, self.workers)
+        connection = Connection(self, connection_id, packet.source_connection_id, packet.destination_connection_id, client_address)
+        try:
+            parameters = handshake.decode_parameters(packet.payload)
+        except ValueError:
+            parameters = {}         # Malformed, taken as a client without parameters
+        connection.codec = compression.choose(parameters.get(handshake.CODECS, b""), self.codecs)
+        codec_id = None if connection.codec is None else connection.codec.codec_id
+        answer = {
+            handshake.MAX_UDP_PAYLOAD_SIZE: handshake.RECEIVE_UDP_PAYLOAD_SIZE,
+            handshake.INITIAL_MAX_DATA: flowcontrol.INITIAL_MAX_DATA,
+            handshake.INITIAL_MAX_STREAM_DATA: flowcontrol.INITIAL_MAX_STREAM_DATA,
+            handshake.CODECS: b"" if codec_id is None else bytes([codec_id]),
+        }
+        ticket = parameters.get(handshake.RESUMPTION_TICKET)
+        if ticket is not None:
+            # The early data was sent under the ticket's limits and codec, they have to hold still
+            resumed = handshake.open_ticket(ticket, key=self.ticket_key)
+            connection.early_data = (resumed is not None and resumed[0] <= flowcontrol.INITIAL_MAX_DATA
+                                     and resumed[1] <= flowcontrol.INITIAL_MAX_STREAM_DATA and resumed[2] == codec_id)
+            answer[handshake.EARLY_DATA] = int(connection.early_data)
+            self.stats['resumed' if connection.early_data else 'early_data_rejected'] += 1
+        answer[handshake.RESUMPTION_TICKET] = handshake.issue_ticket(flowcontrol.INITIAL_MAX_DATA, flowcontrol.INITIAL_MAX_STREAM_DATA, codec_id, key=self.ticket_key)
+        connection.handshake_answer = handshake.encode_parameters(answer)
+        self.connections[connection_id] = connection
+        self.connections[packet.destination_connection_id] = connection
+        heapq.heappush(self.idle_timers, (connection.last_activity + self.idle_timeout, connection_id))
+        self.stats['connections'] += 1
+        print(f"Connection {connection_id:016x} from {client_address[0]}:{client_address[1]}" + ("" if connection.codec is None else f", {connection.codec.name} compression")
+              + ("" if connection.early_data is None else f", resumed, 0-RTT data {'accepted' if connection.early_data else 'rejected'}"))
+        return connection
+
+    def evict_idle(self, now):
+        idle_timers = self.idle_timers
+        while idle_timers and idle_timers[0][0] <= now:
+            _, connection_id = heapq.heappop(idle_timers)
+            connection = self.connections.get(connection_id)
+            if connection is None or connection.connection_id != connection_id:
+                continue        # Closed already
+            deadline = connection.last_activity + self.idle_timeout
+            if deadline > now:
+                heapq.heappush(idle_timers, (deadline, connection_id))
+                continue
+            print(f"Connection {connection_id:016x} idle for {now - connection.last_activity:.1f}s, closing.")
+            self.stats['connections_evicted'] += 1
+            self.close_connection(connection)
+
+    def close_connection(self, connection):
+        if self.connections.get(connection.connection_id) is not connection:
+            return          # Closed already
+        for stream in connection.streams.values():
+            stream.close()
+        self.connections.pop(connection.connection_id, None)
+        self.connections.pop(connection.initial_connection_id, None)
+
+    def metrics_snapshot(self):
+        # Everything the metrics endpoint shows, copied - the endpoint's thread never sees the live objects
+        # Runs on the receive loop every SNAPSHOT_INTERVAL: the totals are kept up to date, so this only copies (the
+        # histograms' counts are arrays, copied whole), nothing is merged bucket by bucket
+        connections = {}
+        for connection_id, connection in self.connections.items():
+            if connection_id != connection.connection_id:
+                continue            # The initial connection ID, same connection
+            connections[f"{connection_id:016x}"] = {
+                'address': f"{connection.address[0]}:{connection.address[1]}",
+                **connection.metrics.snapshot(),
+                'streams': {stream_id: stream_metrics.snapshot() for stream_id, stream_metrics in connection.stream_metrics.items()},
+            }
+        return {'time': time.time(), 'worker': self.worker_index, 'server': dict(self.stats), 'totals': self.total_metrics.snapshot(), 'connections': connections}
+
+    def stream_path(self, connection, stream_id):
+        if self.output_dir is None:
+            return None
+        path = stream_path(self.output_dir, connection.connection_id, stream_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def ack(self, to_ack):
+        # One ACK frame per stream per batch (not per packet), carrying the ranges of bytes received so far
+        for (connection, stream_id), received in to_ack.items():
+            ranges = received.last(api.MAX_ACK_RANGES)
+            connection.pending_frames.append(frames.Frame(frames.ACK, stream_id, ranges[0][1] - 1, api.pack_ack_ranges(ranges)))
+
+
+# region Workers
+
+class DispatchedReceiver:
+    # Receives the datagrams the dispatcher forwards to a worker, same interface as api.BatchReceiver
+    def __init__(self, sock, batch_size=api.DEFAULT_BATCH_SIZE):
+        self.sock = sock
+        self.buffers = [bytearray(DISPATCH_ADDRESS_FORMAT.size + api.BUFFER_SIZE) for _ in range(batch_size)]
+        self.packets = [api.QuicPacket(0, 0, b"", 0, 0) for _ in range(batch_size)]
+        self.stopped = False
+        self.dropped = 0
+
+    def recv_batch(self, timeout=None):
+        # Waits up to timeout seconds (None - forever) for the first datagram, then takes whatever else is waiting
+        # The dispatcher sends an empty datagram when it stops, that ends the worker with EOFError
+        if self.stopped:
+            raise EOFError("the dispatcher stopped")
+        batch = []
+        received = 0
+        self.sock.settimeout(timeout)
+        for buffer, packet in zip(self.buffers, self.packets):
             try:
-                packet, client_address = api.recv_packet(self.socket)
-            except socket.timeout:
-                print("Socket timed out. Closing socket.")
-                self.socket.close()
+                length = self.sock.recv_into(buffer)
+            except BlockingIOError:
+                if not received:
+                    raise socket.timeout("timed out") from None
                 break
-            # ack = api.QuicPacket(0, 1, "ACK", packet.stream_id, packet.pos_in_stream)
-            # with self.lock:
-            #     ack.sendto(self.socket, client_address)
-            # stream_id += 1
-            # self.handle_client(packet, client_address, stream_id)
-            # threading.Thread(target=self.handle_client, args=(packet, client_address, stream_id)).start()
-
-
-    def save_file(self, stream_id):
-        print(f"Saving stream {stream_id} to file...")
-        # Sort packets by pos in stream (left value in dict)
-        sorted_packets = sorted(self.streams_data[stream_id], key=lambda x: x[0])
-        
-        # Combine all the packets to form the complete file
-        full_file_data = ""
-        for _, packet in sorted_packets:
-            full_file_data += packet
-
-        # Assuming the file is a text file for testing purposes
-        with open(f"received_file_{stream_id}.txt", "w") as f:
-            f.write(full_file_data)
-
-        print(f"Stream {stream_id} saved to file received_file_{stream_id}.txt")
-        
-        # # remove stream data from dict
-        # del self.streams_data[stream_id]
+            received += 1
+            if length == 0:
+                self.stopped = True
+                break
+            self.sock.setblocking(False)
+            ip, port = DISPATCH_ADDRESS_FORMAT.unpack_from(buffer)
+            try:
+                packet.unpack(memoryview(buffer)[DISPATCH_ADDRESS_FORMAT.size:length])
+            except (ValueError, IndexError, struct.error):
+                self.dropped += 1
+                continue
+            batch.append((packet, (socket.inet_ntoa(ip), port)))
+        return batch
+
+
+def reuseport_socket(server_address, timeout):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, api.SO_REUSEPORT, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, api.SOCKET_BUFFER_SIZE)
+    sock.settimeout(timeout)
+    sock.bind(server_address)
+    return sock
+
+
+def dispatch(sock, pipes):
+    # Connection ID steering in user space, when the kernel can't do it: every datagram goes to the worker of its
+    # destination connection ID with the client's address in front, the workers send their ACKs on the shared socket
+    size = DISPATCH_ADDRESS_FORMAT.size
+    buffer = bytearray(size + api.BUFFER_SIZE)
+    view = memoryview(buffer)
+    while True:
+        try:
+            length, address = sock.recvfrom_into(view[size:])
+        except socket.timeout:
+            break
+        if length == 0:
+            continue
+        DISPATCH_ADDRESS_FORMAT.pack_into(buffer, 0, socket.inet_aton(address[0]), address[1])
+        pipes[api.steering_index(api.connection_id_of(view[size:size + length]), len(pipes))].send(view[:size + length])
+    for pipe in pipes:
+        pipe.send(b"")
+
+
+def run_worker(*args, **kwargs):
+    # A worker process - if the server is traced, every worker gets its own trace file (the inherited mapping is shared)
+    # and if it is profiled its own profile, reported before the process exits (a worker doesn't run atexit)
+    if api.TRACE is not None:
+        tracing.configure(api.logger.level, api.PACKET_LOG_SAMPLE, f"{api.TRACE.path}.{kwargs['worker_index']}", api.TRACE.capacity, "server")
+    if profiling.ENABLED:
+        profiling.restart(kwargs['worker_index'])
+    try:
+        Server(*args, **kwargs)
+    finally:
+        profiling.report()
+
+
+def run_workers(server_address, workers, batch_size=api.DEFAULT_BATCH_SIZE, timeout=15, output_dir=None, kernel_steering=True, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                metrics_port=None, codecs=None, stats_file=None, ticket_key=None):
+    # Runs a Server in each of workers processes on the same port, a connection's datagrams always reach the same worker:
+    # the sockets form a SO_REUSEPORT group steered by connection ID with BPF, or, if the kernel can't, one socket is read
+    # by a dispatcher (this process) that hashes the connection IDs. Returns the workers' stats
+    # Worker i serves its metrics on metrics_port + i, stats_file gets the stats and the receive metrics of all of them merged
+    context = multiprocessing.get_context("fork")
+    stats_queue = context.Queue()
+    # All the sockets are bound here, before forking, so their order in the group (the BPF program's index) is known
+    # This process keeps them open until every worker is done, so the group never shrinks and the indices never move
+    sockets = [reuseport_socket(server_address, timeout) for _ in range(workers if kernel_steering else 1)]
+    worker_kwargs = [{'idle_timeout': idle_timeout, 'worker_index': i, 'workers': workers, 'codecs': codecs, 'ticket_key': ticket_key,
+                      'metrics_address': None if metrics_port is None else (METRICS_HOST, metrics_port + i)} for i in range(workers)]
+    if kernel_steering and api.steer_by_connection_id(sockets[0], workers):
+        print(f"Starting {workers} workers, steered by connection ID in the kernel")
+        processes = [context.Process(target=run_worker, args=(server_address, batch_size, timeout, output_dir, sock, None, stats_queue),
+                                     kwargs=worker_kwargs[i]) for i, sock in enumerate(sockets)]
+        pipes = []
+    else:
+        print(f"Starting {workers} workers, steered by connection ID by a dispatcher")
+        for sock in sockets[1:]:
+            sock.close()
+        sockets = sockets[:1]
+        pipes = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(workers)]
+        # The workers run until the dispatcher stops them (no timeout of their own), it stops after timeout without packets
+        processes = [context.Process(target=run_worker, args=(server_address, batch_size, None, output_dir, sockets[0], DispatchedReceiver(worker_end, batch_size), stats_queue),
+                                     kwargs=worker_kwargs[i]) for i, (_, worker_end) in enumerate(pipes)]
+    for process in processes:
+        process.start()
+    if pipes:
+        dispatch(sockets[0], [dispatcher_end for dispatcher_end, _ in pipes])
+    results = [stats_queue.get() for _ in processes]      # (stats, metrics.TransferMetrics) of every worker
+    stats = [worker_stats for worker_stats, _ in results]
+    for process in processes:
+        process.join()
+    for sock in sockets:
+        sock.close()
+    for pipe in pipes:
+        for end in pipe:
+            end.close()
+    print_worker_stats(stats)
+    if stats_file is not None:
+        write_worker_stats(stats_file, results)
+    return stats
+
+
+def write_worker_stats(stats_file, results):
+    # The same JSON a single server writes - the workers' stats summed and their metrics merged, each worker's stats too
+    totals = metrics.TransferMetrics()
+    for _, worker_metrics in results:
+        totals.merge(worker_metrics)
+    server_stats = {key: sum(worker_stats[key] for worker_stats, _ in results) for key in results[0][0] if key != 'pid'}
+    snapshot = {'time': time.time(), 'server': {'pid': os.getpid(), **server_stats}, 'totals': totals.snapshot(), 'connections': {},
+                'workers': [worker_stats for worker_stats, _ in results]}
+    with open(stats_file, "w") as file:
+        file.write(metrics.to_json(snapshot))
+
+
+def print_worker_stats(stats):
+    print("=========== Workers: ===========")
+    for i, worker_stats in enumerate(sorted(stats, key=lambda worker_stats: worker_stats['pid'])):
+        print(f"Worker {i} (pid {worker_stats['pid']}): {worker_stats['connections']:,} connections, {worker_stats['packets_received']:,} packets, {worker_stats['bytes_received']:,} bytes, {worker_stats['streams_completed']:,} streams completed, {worker_stats['duplicates']:,} duplicates, {worker_stats['refused']:,} refused")
+    print("=========== Total: ===========")
+    for key in ('connections', 'connections_evicted', 'packets_received', 'frames_received', 'bytes_received', 'bytes_delivered', 'streams_completed', 'duplicates', 'refused', 'credit_updates', 'flow_control_violations', 'fec_parity_received', 'fec_recovered', 'resumed', 'early_data_rejected'):
+        print(f" - {key.replace('_', ' ').capitalize()}: {sum(worker_stats[key] for worker_stats in stats):,}")
+# endregion
+
+
+# Phases timed by --profile (profiling.py) - the time of a phase excludes the phases it calls
+PROFILE_PHASES = [
+    (api.BatchReceiver, "recv_batch", "recv"),              # The receive syscall, waiting for datagrams included
+    (DispatchedReceiver, "recv_batch", "recv"),
+    (api.QuicPacket, "unpack", "parse"),
+    (Server, "handle_batch", "handle_batch"),
+    (Server, "handle_frames", "handle_frames"),
+    (Server, "on_stream_frame", "on_stream_frame"),         # Reassembly and flow control of a stream's frame
+    (fec.FecDecoder, "on_data", "fec"),
+    (fec.FecDecoder, "on_parity", "fec"),
+    (reassembly.StreamReassembler, "flush", "write"),       # pwritev of the in order data
+    (compression.StreamDecompressor, "decompress", "decompress"),
+    (Server, "ack", "ack"),
+    (Server, "update_credit", "update_credit"),
+    (frames, "build_packet", "build_packet"),
+    (api.SendQueue, "append", "serialize"),
+    (api.SendQueue, "flush", "send"),                       # The send syscalls
+]
+
 
 if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser(
@@ -103,10 +582,41 @@ if __name__ == '__main__':
                             default=api.DEFAULT_SERVER_PORT, help='The port to listen on.')
     arg_parser.add_argument('-H', '--host', type=str,
                             default=api.DEFAULT_SERVER_HOST, help='The host to listen on.')
+    arg_parser.add_argument('-b', '--batch-size', type=int,
+                            default=api.DEFAULT_BATCH_SIZE, help='The max number of datagrams to receive per syscall.')
+    arg_parser.add_argument('-o', '--output-dir', type=str,
+                            default=None, help='Save the received files to this folder (by default they are only reassembled).')
+    arg_parser.add_argument('-t', '--timeout', type=float,
+                            default=15, help='Seconds without packets before the server shuts down.')
+    arg_parser.add_argument('-i', '--idle-timeout', type=float,
+                            default=DEFAULT_IDLE_TIMEOUT, help='Seconds without packets before a connection is dropped.')
+    arg_parser.add_argument('-W', '--workers', type=int,
+                            default=1, help='Number of worker processes sharing the port (SO_REUSEPORT), a connection always goes to the same one.')
+    arg_parser.add_argument('-m', '--metrics-port', type=int,
+                            default=None, help='Serve live receive metrics on this local port (/metrics in Prometheus text format, /metrics.json), workers use consecutive ports.')
+    arg_parser.add_argument('--stats-file', type=str,
+                            default=None, help='Write the stats and the receive metrics to this file as JSON when the server shuts down (merged over the workers).')
+    arg_parser.add_argument('--codecs', type=str, nargs='*', choices=list(compression.CODECS),
+                            default=list(compression.CODECS), help='Compression codecs a client may pick (none given - no compression).')
+    arg_parser.add_argument('--ticket-key-file', type=str,
+                            default=None, help='Key of the resumption tickets, created if missing - tickets outlive the process and are shared by the servers using the file.')
+    tracing.add_arguments(arg_parser)
+    profiling.add_arguments(arg_parser)
 
     args = arg_parser.parse_args()
+    tracing.configure_from_arguments(args, "server")
+    profiling.configure_from_arguments(args, "server", PROFILE_PHASES)
+    # SIGTERM shuts the server down like a timeout does
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
     host = args.host
     port = args.port
+    ticket_key = None if args.ticket_key_file is None else handshake.load_ticket_key(args.ticket_key_file)
 
-    Server((host, port))
\ No newline at end of file
+    if args.workers > 1:
+        run_workers((host, port), args.workers, args.batch_size, args.timeout, args.output_dir, idle_timeout=args.idle_timeout, metrics_port=args.metrics_port,
+                    codecs=args.codecs, stats_file=args.stats_file, ticket_key=ticket_key)
+    else:
+        Server((host, port), args.batch_size, args.timeout, args.output_dir, idle_timeout=args.idle_timeout,
+               metrics_address=None if args.metrics_port is None else (METRICS_HOST, args.metrics_port),
+               stats_file=args.stats_file, codecs=args.codecs, ticket_key=ticket_key)
\ No newline at end of file
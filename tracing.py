@@ -0,0 +1,203 @@
+import argparse
+import atexit
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+import api
+import frames
+
+# Binary packet trace - a fixed size record per packet event in a ring buffer in an mmapped file, cheap enough to leave on
+# at full speed (no formatting, no syscalls - the kernel writes the pages back), the newest records overwrite the oldest
+# The trace is decoded offline, to text or to qlog JSON (draft-ietf-quic-qlog-main-schema) for qvis and friends:
+#   python tracing.py server.trace -o server.qlog
+
+# Default values
+DEFAULT_TRACE_RECORDS = 1 << 20         # Records in the ring buffer (40 MB)
+LOG_FORMAT = "%(asctime)s %(name)s %(levelname)s: %(message)s"
+
+MAGIC = b"QTRC"
+VERSION = 2
+VANTAGE_POINTS = ("unknown", "client", "server")
+# magic, version, vantage point, record size, capacity (records), records written so far, start time (seconds since the epoch)
+HEADER_FORMAT = struct.Struct('<4sBBHQQd')
+# ns since the start, event, packet type, payload length, stream ID, offset in stream, destination connection ID
+RECORD_FORMAT = struct.Struct('<QBBxxIQQQ')
+_WRITTEN_FORMAT = struct.Struct('<Q')
+_WRITTEN_OFFSET = 16                    # Of the records written counter in the header
+# A datagram of coalesced frames (frames.py) takes a record, followed by one per frame with this bit set on the event
+# (the frame type in place of the packet type, with frames.FIN_BIT on a stream's last frame) - the decoder puts them back together
+FRAME_RECORD = 0x80
+
+
+class Trace:
+    def __init__(self, path, capacity=DEFAULT_TRACE_RECORDS, vantage_point="unknown"):
+        self.path = path
+        self.capacity = capacity
+        self.written = 0
+        self.start_ns = time.monotonic_ns()
+        size = HEADER_FORMAT.size + capacity * RECORD_FORMAT.size
+        with open(path, "wb+") as file:
+            file.truncate(size)
+            self.map = mmap.mmap(file.fileno(), size)
+        HEADER_FORMAT.pack_into(self.map, 0, MAGIC, VERSION, VANTAGE_POINTS.index(vantage_point), RECORD_FORMAT.size, capacity, 0, time.time())
+
+    def record(self, event, packet):
+        time_ns = time.monotonic_ns() - self.start_ns
+        self.__write(time_ns, event, packet.packet_type, packet.payload_length, packet.stream_id, packet.pos_in_stream, packet.destination_connection_id)
+        if packet.packet_type == api.FRAMES:
+            try:
+                headers = frames.frame_headers(packet.joined_payload())
+            except ValueError:
+                headers = ()                # Malformed, the receiver drops it - the datagram's own record is all there is
+            for frame_type, stream_id, offset, length in headers:
+                self.__write(time_ns, event | FRAME_RECORD, frame_type, length, stream_id, offset, packet.destination_connection_id)
+        _WRITTEN_FORMAT.pack_into(self.map, _WRITTEN_OFFSET, self.written)
+
+    def __write(self, *fields):
+        RECORD_FORMAT.pack_into(self.map, HEADER_FORMAT.size + (self.written % self.capacity) * RECORD_FORMAT.size, *fields)
+        self.written += 1
+
+    def close(self):
+        if not self.map.closed:
+            self.map.flush()
+            self.map.close()
+
+
+def configure(level=logging.INFO, sample=1, trace_path=None, trace_records=DEFAULT_TRACE_RECORDS, vantage_point="unknown"):
+    # Sets up logging - packet events are logged at DEBUG level, 1 of every sample of them, and traced to trace_path if given
+    # Returns the trace (None if not tracing)
+    logging.basicConfig(format=LOG_FORMAT)
+    api.logger.setLevel(level)
+    api.PACKET_LOG_SAMPLE = max(1, sample)
+    if api.TRACE is not None:
+        api.TRACE.close()
+    api.TRACE = None if trace_path is None else Trace(trace_path, trace_records, vantage_point)
+    if api.TRACE is not None:
+        atexit.register(api.TRACE.close)
+    api.DEBUG = api.TRACE is not None or api.packet_logger.isEnabledFor(logging.DEBUG)
+    return api.TRACE
+
+
+def add_arguments(arg_parser):
+    # The logging options client.py and server.py share
+    arg_parser.add_argument("--log-level", type=str.upper, choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                            default="INFO", help="DEBUG logs every packet sent and received.")
+    arg_parser.add_argument("--log-sample", type=int,
+                            default=1, help="Log only 1 of every N packets.")
+    arg_parser.add_argument("--trace", type=str,
+                            default=None, help="Record every packet to this binary trace file (decode it with tracing.py).")
+    arg_parser.add_argument("--trace-records", type=int,
+                            default=DEFAULT_TRACE_RECORDS, help="Size of the trace's ring buffer, the newest records are kept.")
+
+
+def configure_from_arguments(args, vantage_point):
+    return configure(args.log_level, args.log_sample, args.trace, args.trace_records, vantage_point)
+
+
+# region Decoder
+def read_trace(path):
+    # Returns (header dict, records oldest first) - each record is a dict
+    with open(path, "rb") as file:
+        data = file.read()
+    magic, version, vantage_point, record_size, capacity, written, start_time = HEADER_FORMAT.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a trace (version {VERSION})")
+    header = {'vantage_point': VANTAGE_POINTS[vantage_point], 'capacity': capacity, 'written': written, 'start_time': start_time,
+              'dropped': max(written - capacity, 0)}
+    first = max(written - capacity, 0)
+    records = []
+    for i in range(first, written):
+        time_ns, event, packet_type, length, stream_id, offset, connection_id = RECORD_FORMAT.unpack_from(data, HEADER_FORMAT.size + (i % capacity) * record_size)
+        records.append({'time_ns': time_ns, 'event': event, 'packet_type': packet_type, 'length': length,
+                        'stream_id': stream_id, 'offset': offset, 'connection_id': connection_id})
+    return header, records
+
+
+def qlog_frame(record):
+    packet_type, stream_id, offset = record['packet_type'], record['stream_id'], record['offset']
+    if packet_type == api.DATA:
+        return {'frame_type': "stream", 'stream_id': stream_id, 'offset': offset, 'length': record['length']}
+    if packet_type == frames.STREAM | frames.FIN_BIT:
+        return {'frame_type': "stream", 'stream_id': stream_id, 'offset': offset, 'length': record['length'], 'fin': True}
+    if packet_type == api.END_STREAM:
+        return {'frame_type': "stream", 'stream_id': stream_id, 'offset': offset, 'length': 0, 'fin': True}
+    if packet_type == api.ACK:
+        return {'frame_type': "ack", 'stream_id': stream_id, 'largest_acknowledged': offset}
+    if packet_type == api.MAX_DATA:
+        return {'frame_type': "max_data", 'maximum': offset}
+    if packet_type == api.MAX_STREAM_DATA:
+        return {'frame_type': "max_stream_data", 'stream_id': stream_id, 'maximum': offset}
+    if packet_type == api.DATA_BLOCKED:
+        return {'frame_type': "data_blocked", 'limit': offset}
+    if packet_type == api.STREAM_DATA_BLOCKED:
+        return {'frame_type': "stream_data_blocked", 'stream_id': stream_id, 'limit': offset}
+    if packet_type == api.PMTU_PROBE:
+        return {'frame_type': "ping"}
+    if packet_type == api.PMTU_PROBE_ACK:
+        return {'frame_type': "ack", 'stream_id': stream_id, 'acked_probe_size': offset}
+    if packet_type == api.END_CONNECTION:
+        return {'frame_type': "connection_close"}
+    if packet_type == api.FEC_PARITY:
+        return {'frame_type': "fec_parity", 'group': stream_id, 'datagrams': offset}
+    if packet_type == frames.FEC_LOSS:
+        return {'frame_type': "fec_loss", 'datagrams': stream_id, 'missing': offset}
+    return {'frame_type': "unknown", 'raw_frame_type': packet_type}
+
+
+def to_qlog(header, records, title=""):
+    events = []
+    datagram_frames = None          # Frames list of the last coalesced datagram, its frame records follow it
+    for record in records:
+        if record['event'] & FRAME_RECORD:
+            # Dropped if the ring buffer overwrote the datagram's own record
+            if datagram_frames is not None:
+                datagram_frames.append(qlog_frame(record))
+            continue
+        packet = {'header': {'packet_type': "initial" if api.HEADER_FORMS.get(record['packet_type']) == api.LONG_HEADER else "1RTT",
+                             'dcid': f"{record['connection_id']:016x}"}}
+        datagram_frames = None
+        if record['packet_type'] == api.FRAMES:
+            packet['frames'] = datagram_frames = []
+        elif record['packet_type'] != api.HANDSHAKE:
+            packet['frames'] = [qlog_frame(record)]
+        if record['event'] == api.PACKET_LOST:
+            name = "recovery:packet_lost"
+        else:
+            name = "transport:packet_sent" if record['event'] == api.PACKET_SENT else "transport:packet_received"
+            packet['raw'] = {'payload_length': record['length']}
+        events.append({'time': record['time_ns'] / 1e6, 'name': name, 'data': packet})
+    return {
+        'qlog_version': "0.3",
+        'qlog_format': "JSON",
+        'title': title,
+        'traces': [{
+            'vantage_point': {'type': header['vantage_point']},
+            'common_fields': {'time_format': "relative", 'reference_time': header['start_time'] * 1000},
+            'events': events,
+        }],
+    }
+# endregion
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Decode a binary packet trace.")
+    arg_parser.add_argument("trace", type=str, help="The trace file.")
+    arg_parser.add_argument("-o", "--output", type=str,
+                            default=None, help="Write qlog JSON to this file (by default the records are printed as text).")
+
+    args = arg_parser.parse_args()
+
+    header, records = read_trace(args.trace)
+    if args.output is None:
+        print(f"{header['vantage_point']} trace, {header['written']:,} records ({header['dropped']:,} overwritten)")
+        for record in records:
+            event = "  frame" if record['event'] & FRAME_RECORD else api.PACKET_EVENT_NAMES.get(record['event'], record['event'])
+            print(f"{record['time_ns'] / 1e6:12.3f} ms {event:<8} type {record['packet_type']:<2} "
+                  f"stream {record['stream_id']} offset {record['offset']} length {record['length']} dcid {record['connection_id']:016x}")
+    else:
+        with open(args.output, "w") as file:
+            json.dump(to_qlog(header, records, os.path.basename(args.trace)), file)
+        print(f"Wrote {len(records):,} events to {args.output}")